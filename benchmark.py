@@ -0,0 +1,306 @@
+"""Нагрузочный бенчмарк: настоящий Application и хендлеры bot.py против поддельного Bot API.
+
+Запуск:
+    python benchmark.py --users 1000 --concurrency 100 --output report.json
+    python benchmark.py --compare old.json new.json
+
+Каждый пользователь проходит сценарий /start -> Instagram (спин) -> повторный
+/spin -> /mycoupons, параллельно админ запрашивает статистику, список
+пользователей и экспорт. База создается во временном каталоге, запросы к
+Telegram отвечает FakeBotRequest (с задержкой --api-latency). Лимиты Telegram
+по умолчанию сняты, чтобы мерить сам бот (--telegram-limits включает их).
+
+Отчет в JSON: задержка обработки обновлений p50/p95/p99 по шагам,
+операции с базой в секунду и число вызовов Bot API на один спин.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+ADMIN_ID = 1
+FIRST_USER_ID = 10_000_000
+
+USER_STEPS = ('start', 'instagram_spin', 'repeat_spin', 'mycoupons')
+ADMIN_STEPS = ('admin_stats', 'admin_users', 'admin_export')
+
+# Метрики, по которым --compare ищет регрессии: (путь в отчете, больше - лучше)
+COMPARED_METRICS = (
+    (('spins_per_s',), True),
+    (('latency_ms', 'all', 'p50'), False),
+    (('latency_ms', 'all', 'p95'), False),
+    (('latency_ms', 'all', 'p99'), False),
+    (('db', 'ops_per_s'), True),
+    (('telegram', 'calls_per_spin'), False),
+)
+
+
+def percentile(sorted_values, q):
+    """Перцентиль методом ближайшего ранга"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(values):
+    """Сводка задержек в миллисекундах"""
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 50) * 1000, 3),
+        'p95': round(percentile(values, 95) * 1000, 3),
+        'p99': round(percentile(values, 99) * 1000, 3),
+        'max': round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def configure_environment(args, db_path, admin_id=ADMIN_ID):
+    """Настройки бота для прогона; вызывать до импорта config"""
+    os.environ['DB_PATH'] = db_path
+    os.environ['BOT_TOKEN'] = os.environ.get('BOT_TOKEN') or '123456:benchmark'
+    os.environ['ADMIN_ID'] = str(admin_id)
+    os.environ['RECORD_UPDATES_PATH'] = ''
+    if args.animation_frames is not None:
+        os.environ['SPIN_ANIMATION_FRAMES'] = str(args.animation_frames)
+    if args.animation_interval is not None:
+        os.environ['SPIN_ANIMATION_INTERVAL'] = str(args.animation_interval)
+    if not args.telegram_limits:
+        os.environ['TELEGRAM_OVERALL_RATE'] = '1000000'
+        os.environ['TELEGRAM_CHAT_RATE'] = '1000000'
+        os.environ['TELEGRAM_CHAT_BURST'] = '1000000'
+
+
+class Benchmark:
+    """Сценарии пользователей и админа поверх запущенного Application"""
+
+    def __init__(self, application, args):
+        from telegram import Update
+
+        self.Update = Update
+        self.application = application
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.latencies = defaultdict(list)
+        self.errors = 0
+
+    async def count_error(self, update, context):
+        self.errors += 1
+
+    async def process(self, step, data):
+        """Обрабатывает одно обновление тем же путем, что и при работе бота"""
+        application = self.application
+        update = self.Update.de_json(data, application.bot)
+        start = time.perf_counter()
+        await application.update_processor.process_update(
+            update, application.process_update(update)
+        )
+        self.latencies[step].append(time.perf_counter() - start)
+        if self.args.think_time:
+            await asyncio.sleep(self.args.think_time)
+
+    async def user_session(self, user_id, semaphore):
+        from fake_bot_api import message_update
+
+        async with semaphore:
+            await self.process('start', message_update(next(self.update_ids), user_id, '/start'))
+            await self.process('instagram_spin', message_update(
+                next(self.update_ids), user_id, f'bench_user_{user_id}'
+            ))
+            await self.process('repeat_spin', message_update(next(self.update_ids), user_id, '/spin'))
+            await self.process('mycoupons', message_update(next(self.update_ids), user_id, '/mycoupons'))
+
+    async def admin_session(self, stop_event):
+        from fake_bot_api import callback_update
+
+        while not stop_event.is_set():
+            for step in ADMIN_STEPS:
+                await self.process(step, callback_update(next(self.update_ids), ADMIN_ID, step))
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=self.args.admin_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        stop_event = asyncio.Event()
+        admin = None
+        if self.args.admin_interval > 0:
+            admin = asyncio.create_task(self.admin_session(stop_event))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            self.user_session(FIRST_USER_ID + i, semaphore)
+            for i in range(self.args.users)
+        ))
+        stop_event.set()
+        if admin:
+            await admin
+
+        # Результаты спинов отправляются фоновыми анимациями - дожидаемся их
+        import bot
+        while bot.spin_animations:
+            await asyncio.gather(*list(bot.spin_animations.values()), return_exceptions=True)
+        return time.perf_counter() - start
+
+
+async def run_benchmark(args):
+    from bot import build_application
+    from database import adb
+    from fake_bot_api import FakeBotRequest
+    from webhook import running
+
+    request = FakeBotRequest(latency=args.api_latency)
+    application = build_application(updater=False, request=request)
+    benchmark = Benchmark(application, args)
+    application.add_error_handler(benchmark.count_error)
+
+    async with running(application):
+        request.reset()
+        adb.calls.clear()
+        duration = await benchmark.run()
+
+        telegram_calls = dict(request.calls)
+        db_calls = dict(adb.calls)
+        spins = adb.database.get_connection().execute('SELECT COUNT(*) FROM coupons').fetchone()[0]
+
+    all_latencies = [value for values in benchmark.latencies.values() for value in values]
+    updates = len(all_latencies)
+    db_ops = sum(db_calls.values())
+    telegram_total = sum(telegram_calls.values())
+
+    return {
+        'benchmark': 'spin_flow',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+        },
+        'parameters': vars(args),
+        'duration_s': round(duration, 3),
+        'updates': updates,
+        'updates_per_s': round(updates / duration, 2),
+        'spins': spins,
+        'spins_per_s': round(spins / duration, 2),
+        'errors': benchmark.errors,
+        'latency_ms': {
+            'all': latency_summary(all_latencies),
+            **{step: latency_summary(benchmark.latencies[step])
+               for step in USER_STEPS + ADMIN_STEPS if benchmark.latencies[step]},
+        },
+        'db': {
+            'ops': db_ops,
+            'ops_per_s': round(db_ops / duration, 2),
+            'by_method': db_calls,
+        },
+        'telegram': {
+            'calls': telegram_total,
+            'calls_per_spin': round(telegram_total / spins, 3) if spins else None,
+            'by_method': telegram_calls,
+        },
+    }
+
+
+def metric(report, path):
+    value = report
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare_reports(old, new, max_regression):
+    """Печатает изменения ключевых метрик; True, если регрессия больше max_regression %"""
+    regressed = False
+    for path, higher_is_better in COMPARED_METRICS:
+        before, after = metric(old, path), metric(new, path)
+        if not before or after is None:
+            continue
+        change = (after - before) / before * 100
+        worse = -change if higher_is_better else change
+        mark = ''
+        if worse > max_regression:
+            mark = '  <- регрессия'
+            regressed = True
+        print(f"{'.'.join(path):28} {before:>12} -> {after:>12} ({change:+.1f}%){mark}")
+    return regressed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный бенчмарк бота с поддельным Bot API')
+    parser.add_argument('--users', type=int, default=500, help='число пользователей')
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='сколько пользователей проходят сценарий одновременно')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='пауза пользователя между шагами, с')
+    parser.add_argument('--admin-interval', type=float, default=1.0,
+                        help='период запросов админа, с (0 - без админа)')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='задержка ответа поддельного Bot API, с')
+    parser.add_argument('--animation-frames', type=int, default=None,
+                        help='кадров анимации спина (по умолчанию из config)')
+    parser.add_argument('--animation-interval', type=float, default=None,
+                        help='интервал кадров анимации, с (по умолчанию из config)')
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help='соблюдать лимиты Telegram из config')
+    parser.add_argument('--output', help='файл отчета JSON (по умолчанию stdout)')
+    parser.add_argument('--keep-db', action='store_true', help='не удалять базу прогона')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='сравнить два отчета вместо прогона')
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        help='допустимое ухудшение метрик при --compare, %%')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], encoding='utf-8') as f:
+            old = json.load(f)
+        with open(args.compare[1], encoding='utf-8') as f:
+            new = json.load(f)
+        return 1 if compare_reports(old, new, args.max_regression) else 0
+
+    workdir = tempfile.mkdtemp(prefix='wheel-bench-')
+    configure_environment(args, os.path.join(workdir, 'benchmark.db'))
+    try:
+        import bot  # noqa: F401 - настраивает логирование бота
+        logging.getLogger().setLevel(logging.WARNING)
+        report = asyncio.run(run_benchmark(args))
+    finally:
+        if args.keep_db:
+            print(f"База прогона: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    latency = report['latency_ms']['all']
+    print(
+        f"{report['spins']} спинов за {report['duration_s']} с ({report['spins_per_s']}/с), "
+        f"p50 {latency['p50']} мс, p95 {latency['p95']} мс, p99 {latency['p99']} мс, "
+        f"БД {report['db']['ops_per_s']} оп/с, "
+        f"Bot API {report['telegram']['calls_per_spin']} вызовов/спин, ошибок {report['errors']}",
+        file=sys.stderr
+    )
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""Микро-бенчмарк выбора приза: таблица алиасов против random.choices.
+
+Запуск:
+    python benchmark_prize_sampler.py [кол-во выборок]
+
+Перед замером проверяет распределение критерием хи-квадрат (как
+tests/test_prize_sampler.py, но на большей выборке) и завершается с кодом 1,
+если оно не соответствует весам chance из COUPON_CONFIG.
+"""
+import sys
+import time
+from prize_sampler import PrizeSampler, check_distribution
+
+# Порог p-значения, ниже которого распределение считается неверным
+MIN_P_VALUE = 0.001
+
+
+def benchmark(sampler, draws):
+    """Время выбора одного приза: таблица алиасов против random.choices"""
+    coupons = list(sampler.coupon_config)
+    weights = sampler.weights
+    rng = sampler.rng
+
+    start = time.perf_counter()
+    for _ in range(draws):
+        sampler.draw_index()
+    alias_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(draws):
+        rng.choices(range(len(coupons)), weights=weights, k=1)
+    choices_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sampler.sample(draws)
+    batch_time = time.perf_counter() - start
+
+    return alias_time, choices_time, batch_time
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    draws = int(argv[0]) if argv else 2_000_000
+    sampler = PrizeSampler()
+
+    chi_square, p_value, rows = check_distribution(sampler, draws)
+    print(f"Выборок: {draws}")
+    for coupon, expected, observed in rows:
+        print(f"  {coupon:>5}: ожидается {expected:.4%}, получено {observed:.4%}")
+    print(f"Хи-квадрат: {chi_square:.2f}, p = {p_value:.4f}")
+
+    alias_time, choices_time, batch_time = benchmark(sampler, draws)
+    print(f"Алиасы:         {alias_time / draws * 1e9:.0f} нс/выбор")
+    print(f"random.choices: {choices_time / draws * 1e9:.0f} нс/выбор")
+    print(f"sample(n):      {batch_time / draws * 1e9:.0f} нс/приз")
+
+    if p_value < MIN_P_VALUE:
+        print("ОШИБКА: распределение не соответствует весам chance")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,8 @@
 import logging
 import asyncio
-import csv
-import io
+import os
+import re
+import time
 from datetime import datetime, timedelta
 from telegram import Update, Bot
 from telegram.ext import (
@@ -11,24 +12,50 @@ from telegram.ext import (
     filters, 
     ContextTypes, 
     ConversationHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.error import BadRequest, RetryAfter
 import config
-from database import db
+import logging_setup
+import metrics
+from database import adb, campaign_datetime, format_timestamp
+from update_processor import PerUserUpdateProcessor
+from export import build_export
+from bulk_redeem import redeem_file
+from rate_limiter import PriorityRateLimiter, PRIORITY_RESULT, PRIORITY_ANIMATION
+from prize_sampler import config_fingerprint
+from render_wheel import load_manifest
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    filename='bot_debug.log'  # Добавляем запись в файл
-)
+# Настройка логирования (очередь и поток записи с ротацией)
+logging_setup.setup_logging()
 logger = logging.getLogger(__name__)
 
 # Состояния
 INSTAGRAM_USERNAME = 1
 ADMIN_MENU = 2
 ADMIN_MARK_COUPON = 3 
+ADMIN_SEARCH = 4
+
+# Типы обновлений, которые бот обрабатывает (остальные Telegram не присылает)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Ошибки Bot API, означающие, что сохраненный file_id больше не действителен
+# (остальные BadRequest, например ошибка разметки подписи, к file_id не относятся)
+FILE_ID_ERROR = re.compile(
+    r'wrong (remote )?file (identifier|id)|file reference|type of file mismatch|failed to get http url content',
+    re.IGNORECASE
+)
+
+# Фоновые анимации спина: telegram_id -> asyncio.Task
+spin_animations = {}
+
+# Манифест отрендеренных анимаций колеса (загружается при первом спине)
+wheel_manifest = None
+# Первая загрузка анимации приза: (купон, отпечаток) -> asyncio.Lock,
+# чтобы одновременные спины не загружали один и тот же GIF
+wheel_upload_locks = {}
 
 # Эмодзи для оформления
 EMOJIS = {
@@ -52,6 +79,7 @@ EMOJIS = {
     'cross': '❌'
 }
 
+@metrics.timed_handler
 async def show_active_coupons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /mycoupons - показать активные купоны пользователя"""
     # Проверка на None
@@ -78,8 +106,9 @@ async def show_active_coupons(update: Update, context: ContextTypes.DEFAULT_TYPE
     telegram_id = user.id
     
     # Получаем активные купоны
-    active_coupons = db.get_active_coupons(telegram_id)
-    user_stats = db.get_user_stats(telegram_id)
+    summary = await adb.get_user_summary(telegram_id)
+    active_coupons = summary['active_coupons']
+    user_stats = summary['stats']
     
     if not active_coupons:
         # Если нет активных купонов
@@ -112,17 +141,16 @@ async def show_active_coupons(update: Update, context: ContextTypes.DEFAULT_TYPE
     message += f"• Использовано: {user_stats['used']}\n\n"
     message += "=" * 30 + "\n\n"
     
+    today = campaign_datetime(adb.database.clock()).date()
+    
     for i, coupon in enumerate(active_coupons, 1):
-        # Парсим даты
-        created_date = datetime.strptime(str(coupon['created_at']).split('.')[0], '%Y-%m-%d %H:%M:%S').date()
-        valid_until_date = datetime.strptime(str(coupon['valid_until']).split('.')[0], '%Y-%m-%d %H:%M:%S').date()
-
-        # Форматируем даты
-        created_str = created_date.strftime('%d.%m.%Y')
+        # Даты хранятся в секундах Unix и показываются в часовом поясе кампании
+        valid_until_date = campaign_datetime(coupon.valid_until).date()
+        created_str = format_timestamp(coupon.created_at)
         valid_until_str = (valid_until_date - timedelta(days=1)).strftime('%d.%m.%Y')
         
         # Считаем сколько дней осталось
-        days_left = (valid_until_date - datetime.now().date()).days + 1
+        days_left = (valid_until_date - today).days + 1
         if days_left > 0:
             days_text = f"{days_left} дн."
         else:
@@ -138,8 +166,8 @@ async def show_active_coupons(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         message += (
             f"🎄 *Купон #{i}*\n"
-            f"{EMOJIS['gift']} *Скидка:* {coupon['coupon']}\n"
-            f"🔤 *Кодовое слово:* {coupon['code_word']}\n"
+            f"{EMOJIS['gift']} *Скидка:* {coupon.coupon}\n"
+            f"🔤 *Кодовое слово:* {coupon.code_word}\n"
             f"📅 *Получен:* {created_str}\n"
             f"⏳ *Действует по:* {valid_until_str}\n"
             f"{time_emoji} *Осталось:* {days_text}\n"
@@ -167,6 +195,7 @@ async def show_active_coupons(update: Update, context: ContextTypes.DEFAULT_TYPE
         parse_mode='Markdown'
     )
 
+@metrics.timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start - точка входа для всех пользователей"""
     
@@ -184,7 +213,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = user.id
     
     # Проверяем, новый ли пользователь
-    if not db.user_exists(telegram_id):
+    if not await adb.user_exists(telegram_id):
         # НОВЫЙ ПОЛЬЗОВАТЕЛЬ - просим Instagram
         await message.reply_text(
             f"{EMOJIS['wheel']} *Привет, {user.first_name}!* 👋\n\n"
@@ -198,6 +227,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_user_menu(update, context)
         return ConversationHandler.END
 
+@metrics.timed_handler
 async def handle_instagram_username(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка Instagram username для новых пользователей с автоматическим запуском spin"""
     
@@ -254,7 +284,7 @@ async def show_user_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     can_spin_today = True
     
     # Получаем последний использованный Instagram
-    last_instagram = db.get_last_instagram(telegram_id)
+    last_instagram = await adb.get_last_instagram(telegram_id)
     
     if can_spin_today:
         # Можно крутить сегодня - предлагаем крутить
@@ -304,6 +334,7 @@ async def show_user_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif update.message:
         await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
 
+@metrics.timed_handler
 async def spin_wheel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /spin для существующих пользователей"""
     
@@ -320,26 +351,17 @@ async def spin_wheel_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     telegram_id = user.id
     
     # Проверяем, существует ли пользователь
-    if not db.user_exists(telegram_id):
+    if not await adb.user_exists(telegram_id):
         await message.reply_text(
             "Вы еще не зарегистрированы! Используйте /start для начала.",
             parse_mode='Markdown'
         )
         return
     
-    # Проверяем, можно ли крутить сегодня
-    if db.has_user_played_today(telegram_id):
-        await message.reply_text(
-            f"⏳ *Вы уже крутили колесо сегодня!*\n\n"
-            f"Новый купон будет доступен завтра.\n"
-            f"Используйте /mycoupons чтобы посмотреть активные купоны.",
-            parse_mode='Markdown'
-        )
-        return
-    
-    # Запускаем spin_wheel_handler
+    # Дневной лимит проверяется атомарно в spin_wheel_handler
     await spin_wheel_handler(update, context)
 
+@metrics.timed_handler
 async def spin_wheel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE, username: str = None):
     """Универсальный обработчик кручения колеса (для новых и существующих)"""
     
@@ -359,9 +381,41 @@ async def spin_wheel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
     
     telegram_id = user.id
     
-    # Если username не передан (существующий пользователь), берем из базы
-    if not username:
-        username = db.get_last_instagram(telegram_id)
+    # Резервируем спин и выбираем приз до анимации одной транзакцией.
+    # Если username не передан (существующий пользователь), база возьмет последний
+    spin = await adb.reserve_spin(telegram_id, username)
+    
+    if spin is None:
+        # Уже крутил сегодня
+        await message_func(
+            f"⏳ *Вы уже крутили колесо сегодня!*\n\n"
+            f"Новый купон будет доступен завтра.\n"
+            f"Используйте /mycoupons чтобы посмотреть активные купоны.",
+            parse_mode='Markdown'
+        )
+        return ConversationHandler.END
+    
+    bot = context.bot if context else original_message.get_bot()
+    
+    # Предыдущая анимация пользователя сразу выдает свой результат
+    previous = spin_animations.pop(telegram_id, None)
+    if previous:
+        previous.cancel()
+    
+    if config.WHEEL_ANIMATION == 'gif':
+        try:
+            if await send_wheel_animation(bot, chat_id, spin):
+                return ConversationHandler.END
+        except Exception as e:
+            # Купон уже сохранен: без анимации отдаем результат текстом
+            logger.error(f"Не удалось отправить анимацию колеса в чат {chat_id}: {e}")
+            await send_spin_result(bot, chat_id, spin)
+            return ConversationHandler.END
+    
+    if config.SPIN_ANIMATION_FRAMES <= 0:
+        # Режим без анимации (пиковая нагрузка): сразу отправляем результат
+        await send_spin_result(bot, chat_id, spin)
+        return ConversationHandler.END
     
     # Симуляция кручения колеса с анимацией
     wheel_message = await original_message.reply_text(
@@ -369,39 +423,72 @@ async def spin_wheel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
         "🎄🎁🌟⛄❄️🎄🎁🌟⛄❄️"
     )
     
-    # Анимация кручения
-    wheel_frames = [
-        "🎄...🎁...🌟...⛄...❄️",
-        "❄️...🎄...🎁...🌟...⛄",
-        "⛄...❄️...🎄...🎁...🌟",
-        "🌟...⛄...❄️...🎄...🎁",
-        "🎁...🌟...⛄...❄️...🎄"
-    ]
+    # Анимация идет в фоне, обработчик освобождается сразу после записи купона
+    # (не через Application.create_task: остановка бота не должна ждать конца анимации)
+    task = asyncio.create_task(
+        run_spin_animation(bot, chat_id, wheel_message.message_id, spin)
+    )
+    spin_animations[telegram_id] = task
     
-    for frame in wheel_frames:
-        await wheel_message.edit_text(f"{EMOJIS['wheel']} *Крутим новогоднее колесо...*\n{frame}")
-        await asyncio.sleep(0.5)
+    def forget_animation(done_task):
+        if spin_animations.get(telegram_id) is done_task:
+            del spin_animations[telegram_id]
     
-    await asyncio.sleep(1)
-    await wheel_message.edit_text(f"{EMOJIS['wheel']} *Колесо остановилось!*")
-    await asyncio.sleep(0.5)
+    task.add_done_callback(forget_animation)
     
-    # Генерация купона
-    coupon_data = db.generate_coupon()
-    save_result = db.save_coupon(telegram_id, username, coupon_data)
+    return ConversationHandler.END
+
+async def run_spin_animation(bot: Bot, chat_id: int, message_id: int, spin: dict):
+    """Фоновая анимация колеса; результат отправляется и при отмене анимации"""
+    # Кадры анимации: символы колеса, сдвинутые на один шаг в каждом кадре
+    symbols = ["🎄", "🎁", "🌟", "⛄", "❄️"]
+    interval = config.SPIN_ANIMATION_INTERVAL
     
+    try:
+        # Кадры идут с низким приоритетом: при перегрузке планировщик их пропускает
+        for i in range(config.SPIN_ANIMATION_FRAMES):
+            shift = i % len(symbols)
+            frame = "...".join(symbols[-shift:] + symbols[:-shift])
+            await bot.edit_message_text(
+                f"{EMOJIS['wheel']} *Крутим новогоднее колесо...*\n{frame}",
+                chat_id=chat_id,
+                message_id=message_id,
+                rate_limit_args=PRIORITY_ANIMATION
+            )
+            await asyncio.sleep(interval)
+        
+        await asyncio.sleep(interval * 2)
+        await bot.edit_message_text(
+            f"{EMOJIS['wheel']} *Колесо остановилось!*",
+            chat_id=chat_id,
+            message_id=message_id,
+            rate_limit_args=PRIORITY_ANIMATION
+        )
+        await asyncio.sleep(interval)
+    except asyncio.CancelledError:
+        # Повторный спин или остановка бота: купон уже сохранен, отдаем результат без анимации
+        logger.info(f"Анимация спина для чата {chat_id} прервана")
+    except Exception as e:
+        logger.error(f"Ошибка анимации спина для чата {chat_id}: {e}")
+    finally:
+        try:
+            await send_spin_result(bot, chat_id, spin)
+        except Exception as e:
+            logger.error(f"Не удалось отправить результат спина в чат {chat_id}: {e}")
+
+def format_spin_result(spin: dict):
+    """Текст сообщения с выигранным купоном"""
     # Форматирование дат
-    created_date = save_result['created_at'].strftime("%d.%m.%Y")
-    valid_until_date = save_result['valid_until'].strftime("%d.%m.%Y")
+    created_date = format_timestamp(spin['created_at'])
+    valid_until_date = format_timestamp(spin['valid_until'])
     
-    # Сообщение с результатом
-    result_message = (
-        f"{coupon_data['emoji']} *🎉 ПОЗДРАВЛЯЕМ! 🎉*\n\n"
+    return (
+        f"{spin['emoji']} *🎉 ПОЗДРАВЛЯЕМ! 🎉*\n\n"
         f"✨ *Ваш новогодний подарок:*\n"
-        f"📊 *Скидка:* {coupon_data['coupon']}\n"
-        f"🎭 *Кодовое слово:* {coupon_data['code_word']}\n"
+        f"📊 *Скидка:* {spin['coupon']}\n"
+        f"🎭 *Кодовое слово:* {spin['code_word']}\n"
         f"📅 *Действует:* с {created_date} до {valid_until_date}\n"
-        f"📱 *Instagram:* `@{username}`\n\n"
+        f"📱 *Instagram:* `@{spin['username']}`\n\n"
         f"🎄 *Как использовать:*\n"
         f"1. Сделайте заказ\n"
         f"2. Назовите кодовое слово\n"
@@ -413,17 +500,18 @@ async def spin_wheel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
         f"{EMOJIS['gift']} *Счастливого Нового Года!*"
     )
 
-    # Отправляем результат
-    if context and hasattr(context, 'bot'):
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=result_message,
-            parse_mode='Markdown'
-        )
-    else:
-        await original_message.reply_text(result_message, parse_mode='Markdown')
-    
-    # Кнопки для быстрого доступа
+async def send_spin_result(bot: Bot, chat_id: int, spin: dict):
+    """Отправить сообщение с выигранным купоном и подсказку"""
+    await bot.send_message(
+        chat_id=chat_id,
+        text=format_spin_result(spin),
+        parse_mode='Markdown',
+        rate_limit_args=PRIORITY_RESULT
+    )
+    await send_spin_reminder(bot, chat_id)
+
+async def send_spin_reminder(bot: Bot, chat_id: int):
+    """Подсказка с кнопками после результата спина"""
     reminder_keyboard = [[
         InlineKeyboardButton(f"{EMOJIS['coupon']} Мои купоны", callback_data="show_my_coupons"),
         InlineKeyboardButton(f"{EMOJIS['stats']} Статистика", callback_data="show_stats")
@@ -436,22 +524,92 @@ async def spin_wheel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE,
         f"• Удачных покупок!"
     )
     
-    if context and hasattr(context, 'bot'):
-        await context.bot.send_message(
+    await bot.send_message(
+        chat_id=chat_id,
+        text=reminder_message,
+        reply_markup=InlineKeyboardMarkup(reminder_keyboard),
+        parse_mode='Markdown',
+        rate_limit_args=PRIORITY_RESULT
+    )
+
+def get_wheel_media(coupon: str):
+    """Путь к заранее отрендеренной анимации приза и отпечаток конфигурации.
+
+    None, если рендер не выполнялся или COUPON_CONFIG изменился после него.
+    """
+    global wheel_manifest
+    if wheel_manifest is None:
+        wheel_manifest = load_manifest() or {}
+        if wheel_manifest.get('fingerprint') != config_fingerprint(config.COUPON_CONFIG):
+            logger.warning(
+                "Анимации колеса отсутствуют или устарели - используется покадровая анимация. "
+                "Выполните python render_wheel.py"
+            )
+            wheel_manifest = {}
+    
+    filename = wheel_manifest.get('files', {}).get(coupon)
+    if not filename:
+        return None
+    return os.path.join(config.WHEEL_MEDIA_DIR, filename), wheel_manifest['fingerprint']
+
+async def send_wheel_animation(bot: Bot, chat_id: int, spin: dict):
+    """Отправить результат одним сообщением с GIF колеса.
+
+    Файл загружается в Telegram только один раз, дальше отправляется по file_id.
+    Пока идет первая загрузка, другие спины с этим призом ждут ее file_id.
+    Если Telegram отклонил сохраненный file_id как недействительный, он удаляется
+    и файл загружается заново; остальные BadRequest пробрасываются. Возвращает
+    False, если анимации для приза нет.
+    """
+    media = get_wheel_media(spin['coupon'])
+    if media is None:
+        return False
+    path, fingerprint = media
+    coupon = spin['coupon']
+
+    async def send(animation, **kwargs):
+        return await bot.send_animation(
             chat_id=chat_id,
-            text=reminder_message,
-            reply_markup=InlineKeyboardMarkup(reminder_keyboard),
-            parse_mode='Markdown'
-        )
-    else:
-        await original_message.reply_text(
-            reminder_message,
-            reply_markup=InlineKeyboardMarkup(reminder_keyboard),
-            parse_mode='Markdown'
+            animation=animation,
+            caption=format_spin_result(spin),
+            parse_mode='Markdown',
+            rate_limit_args=PRIORITY_RESULT,
+            **kwargs
         )
-    
-    return ConversationHandler.END
 
+    file_id = await adb.get_media_file_id(coupon, fingerprint)
+    if file_id:
+        try:
+            await send(file_id)
+        except BadRequest as e:
+            # Другие ошибки (разметка подписи, чат не найден) повторная загрузка не исправит
+            if not FILE_ID_ERROR.search(e.message):
+                raise
+            # Недействительный file_id не пробуем снова на каждом спине
+            logger.warning(f"Telegram отклонил file_id анимации {coupon}: {e}")
+            await adb.delete_media_file_id(coupon, fingerprint, file_id)
+            file_id = None
+        else:
+            await send_spin_reminder(bot, chat_id)
+            return True
+
+    lock = wheel_upload_locks.setdefault((coupon, fingerprint), asyncio.Lock())
+    async with lock:
+        # Пока ждали, файл мог загрузить другой спин
+        file_id = await adb.get_media_file_id(coupon, fingerprint)
+        if not file_id:
+            with open(path, 'rb') as f:
+                message = await send(f, filename=os.path.basename(path))
+            uploaded = message.animation or message.document
+            if uploaded:
+                await adb.save_media_file_id(coupon, fingerprint, uploaded.file_id)
+    if file_id:
+        await send(file_id)
+
+    await send_spin_reminder(bot, chat_id)
+    return True
+
+@metrics.timed_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отмена операции"""
     await update.message.reply_text(
@@ -460,6 +618,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # АДМИН КОМАНДЫ
+@metrics.timed_handler
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Админ-панель (команда /admin)"""
     user = update.effective_user
@@ -473,6 +632,7 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton(f"{EMOJIS['users']} Пользователи", callback_data="admin_users")],
         [InlineKeyboardButton(f"{EMOJIS['export']} Экспорт", callback_data="admin_export")],
         [InlineKeyboardButton(f"{EMOJIS['check']} Пометить купон", callback_data="admin_mark_used")],
+        [InlineKeyboardButton(f"{EMOJIS['search']} Поиск купонов", callback_data="admin_search")],
     ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -488,9 +648,17 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ADMIN_MENU
 
+@metrics.timed_handler
 async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик callback для админ-панели"""
     query = update.callback_query
+
+    # Кнопки админки зарегистрированы и вне диалога: callback_data может
+    # прислать любой пользователь, поэтому проверяем права на каждое нажатие
+    if str(update.effective_user.id) != config.ADMIN_ID:
+        await query.answer("⛔ Доступ запрещен.", show_alert=True)
+        return ConversationHandler.END
+
     await query.answer()
     
     if query.data == "admin_stats":
@@ -499,12 +667,20 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
         # Показываем первую страницу пользователей
         await show_admin_users(query, page=0)
     elif query.data.startswith("admin_users_page_"):
-        # Обработка пагинации
+        # Первая страница (кнопка «Обновить»)
+        await show_admin_users(query, page=0)
+    elif query.data.startswith(("admin_users_next_", "admin_users_prev_")):
+        # Обработка пагинации: admin_users_<next|prev>_<страница>_<telegram_id>
         try:
-            page_num = int(query.data.split("_")[-1])
-            await show_admin_users(query, page=page_num)
-        except (ValueError, IndexError):
+            _, _, direction, page_num, telegram_id = query.data.split("_")
+            page_num, telegram_id = int(page_num), int(telegram_id)
+        except ValueError:
             await show_admin_users(query, page=0)
+        else:
+            if direction == "next":
+                await show_admin_users(query, page=page_num, after=telegram_id)
+            else:
+                await show_admin_users(query, page=page_num, before=telegram_id)
     elif query.data == "admin_export":
         await export_data(query)
     elif query.data == "admin_mark_used":
@@ -515,16 +691,39 @@ async def admin_callback_handler(update: Update, context: ContextTypes.DEFAULT_T
             f"*Пример:*\n"
             f"`username123 15%`\n\n"
             f"Бот найдет активный купон этого пользователя с указанной скидкой "
-            f"и пометит один любой купон как использованный.",
+            f"и пометит один любой купон как использованный.\n\n"
+            f"Чтобы отметить сразу много купонов, загрузите файл CSV или TXT: "
+            f"одна строка `instagram_username скидка` на каждый купон. "
+            f"В ответ придет отчет по каждой строке.",
             parse_mode='Markdown'
         )
         context.user_data['awaiting_mark_coupon'] = True
         return ADMIN_MARK_COUPON
+    elif query.data == "admin_search":
+        await query.edit_message_text(
+            f"{EMOJIS['search']} *Поиск купонов*\n\n"
+            f"Отправьте Instagram, скидку или кодовое слово.\n\n"
+            f"*Пример:*\n"
+            f"`username123`",
+            parse_mode='Markdown'
+        )
+        return ADMIN_SEARCH
+    elif query.data.startswith("admin_search_page_"):
+        # Обработка пагинации результатов поиска
+        try:
+            page_num = int(query.data.split("_")[-1])
+        except (ValueError, IndexError):
+            page_num = 0
+        search_query = context.user_data.get('admin_search_query', '')
+        result = await adb.search_coupons(search_query, page=page_num)
+        message, reply_markup = format_search_results(search_query, result, page_num)
+        await query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
     elif query.data == "back_to_admin":
         await show_admin_menu(update, context)
     
     return ADMIN_MENU
 
+@metrics.timed_handler
 async def handle_admin_mark_coupon(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка пометки купона использованным"""
 
@@ -550,14 +749,14 @@ async def handle_admin_mark_coupon(update: Update, context: ContextTypes.DEFAULT
         coupon_value = coupon_value + '%'
     
     # Ищем активный купон
-    result = db.mark_coupon_used_by_instagram(instagram, coupon_value)
+    result = await adb.mark_coupon_used_by_instagram(instagram, coupon_value)
     
     if result['success']:
         message = (
             f"{EMOJIS['check']} *Купон отмечен использованным!*\n\n"
             f"👤 Instagram: `@{instagram}`\n"
             f"🎁 Скидка: {coupon_value}\n"
-            f"📅 Дата создания: {result['created_at']}\n"
+            f"📅 Дата создания: {format_timestamp(result['created_at'], '%d.%m.%Y %H:%M')}\n"
             f"🏷️ ID купона: {result['coupon_id']}\n\n"
             f"✅ Купон успешно помечен как использованный."
         )
@@ -590,6 +789,105 @@ async def handle_admin_mark_coupon(update: Update, context: ContextTypes.DEFAULT
     
     return ADMIN_MENU
 
+@metrics.timed_handler
+async def handle_admin_mark_coupon_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Массовая пометка купонов из загруженного файла со строками `instagram скидка`"""
+    document = update.message.document
+    
+    if document.file_size and document.file_size > config.BULK_REDEEM_MAX_BYTES:
+        await update.message.reply_text(
+            f"❌ Файл слишком большой (максимум {config.BULK_REDEEM_MAX_BYTES // 1024} КБ)."
+        )
+        return ADMIN_MARK_COUPON
+    
+    telegram_file = await document.get_file()
+    data = bytes(await telegram_file.download_as_bytearray())
+    
+    # Разбор, отметка одной транзакцией и отчет - в пуле потоков БД
+    try:
+        report_file, filename, summary = await adb.run(redeem_file, adb.database, data)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return ADMIN_MARK_COUPON
+    
+    try:
+        await update.message.reply_document(
+            document=InputFile(report_file, filename=filename, read_file_handle=False),
+            caption=(
+                f"{EMOJIS['check']} Отмечено купонов: {summary['redeemed']} из {summary['lines']}\n"
+                f"Не найдено: {summary['not_found']}\n"
+                f"Строк с ошибкой формата: {summary['invalid']}"
+            )
+        )
+    finally:
+        report_file.close()
+    
+    context.user_data['awaiting_mark_coupon'] = False
+    
+    keyboard = [[
+        InlineKeyboardButton(f"{EMOJIS['back']} В админ-меню", callback_data="back_to_admin")
+    ]]
+    
+    await update.message.reply_text(
+        "Выберите действие:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    
+    return ADMIN_MENU
+
+@metrics.timed_handler
+async def handle_admin_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка поискового запроса админа"""
+    search_query = update.message.text.strip()
+    context.user_data['admin_search_query'] = search_query
+    
+    result = await adb.search_coupons(search_query, page=0)
+    message, reply_markup = format_search_results(search_query, result, 0)
+    
+    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+    
+    return ADMIN_MENU
+
+def format_search_results(search_query, result, page):
+    """Текст и клавиатура страницы результатов поиска купонов"""
+    per_page = 10
+    safe_query = search_query.replace('`', '')
+    
+    if not result['coupons']:
+        message = (
+            f"{EMOJIS['search']} *Поиск:* `{safe_query}`\n\n"
+            f"Ничего не найдено."
+        )
+    else:
+        message = f"{EMOJIS['search']} *Поиск:* `{safe_query}`\n"
+        message += f"Страница {page + 1}\n\n"
+        
+        for i, coupon in enumerate(result['coupons'], page * per_page + 1):
+            used = EMOJIS['check'] if coupon.used else '🕒'
+            message += (
+                f"{i}. `@{coupon.username}` - {coupon.coupon} ({coupon.code_word})\n"
+                f"   📅 {format_timestamp(coupon.created_at, '%d.%m.%Y %H:%M')} {used}\n"
+            )
+    
+    keyboard = []
+    nav_buttons = []
+    
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton(f"⬅️ Предыдущая", callback_data=f"admin_search_page_{page - 1}"))
+    
+    if result['has_next']:
+        nav_buttons.append(InlineKeyboardButton(f"Следующая ➡️", callback_data=f"admin_search_page_{page + 1}"))
+    
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    
+    keyboard.append([
+        InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back_to_admin"),
+        InlineKeyboardButton(f"{EMOJIS['search']} Новый поиск", callback_data="admin_search")
+    ])
+    
+    return message, InlineKeyboardMarkup(keyboard)
+
 async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать админ-меню (для callback)"""
     query = update.callback_query
@@ -604,6 +902,7 @@ async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton(f"{EMOJIS['users']} Пользователи", callback_data="admin_users")],
         [InlineKeyboardButton(f"{EMOJIS['export']} Экспорт", callback_data="admin_export")],
         [InlineKeyboardButton(f"{EMOJIS['check']} Пометить купон", callback_data="admin_mark_used")],
+        [InlineKeyboardButton(f"{EMOJIS['search']} Поиск купонов", callback_data="admin_search")],
     ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -629,13 +928,14 @@ async def show_admin_stats(query=None, update=None, context=None):
     else:
         return
     
-    stats = db.get_admin_stats()
+    stats = await adb.get_admin_stats()
     
     message_text = f"{EMOJIS['stats']} *Статистика бота*\n\n"
     message_text += f"📊 *Общая статистика:*\n"
     message_text += f"• Всего купонов: {stats['total_coupons']}\n"
     message_text += f"• Уникальных пользователей: {stats['unique_users']}\n"
-    message_text += f"• Купонов сегодня: {stats['today_coupons']}\n\n"
+    message_text += f"• Купонов сегодня: {stats['today_coupons']}\n"
+    message_text += f"• Использовано: {stats['used_coupons']}\n\n"
     
     message_text += f"🎯 *Распределение купонов:*\n"
     for item in stats['coupon_distribution']:
@@ -670,28 +970,35 @@ async def show_admin_stats(query=None, update=None, context=None):
                 parse_mode='Markdown'
             )
 
-async def show_admin_users(query, page=0):
+async def show_admin_users(query, page=0, after=None, before=None):
     """Показать пользователей с активными купонами с пагинацией"""
     try:
-        users = db.get_all_users()
+        # Настройки пагинации
+        users_per_page = 10
+        
+        # Одна страница пользователей вместе с купонами - один запрос к базе
+        users_page = await adb.get_users_page(after=after, before=before, limit=users_per_page)
+        users = users_page['users']
         
         if not users:
-            await query.edit_message_text("Пользователей нет.")
-            return
+            if page > 0:
+                # Страница опустела (например, пользователя удалили) - начинаем сначала
+                users_page = await adb.get_users_page(limit=users_per_page)
+                users = users_page['users']
+                page = 0
+            if not users:
+                await query.edit_message_text("Пользователей нет.")
+                return
         
-        # Настройки пагинации
-        users_per_page = 10
-        total_pages = (len(users) + users_per_page - 1) // users_per_page
-        current_page = page
+        total_pages = max(1, (users_page['total_users'] + users_per_page - 1) // users_per_page)
+        current_page = min(page, total_pages - 1)
         start_idx = current_page * users_per_page
-        end_idx = min(start_idx + users_per_page, len(users))
         
         message = f"{EMOJIS['users']} *Все пользователи:*\n"
         message += f"Страница {current_page + 1} из {total_pages}\n\n"
         
-        for i, user in enumerate(users[start_idx:end_idx], start_idx + 1):
-            # Получаем активные купоны пользователя
-            active_coupons = db.get_active_coupons(user['telegram_id'])
+        for i, user in enumerate(users, start_idx + 1):
+            active_coupons = user['active_coupons']
             
             message += (
                 f"{i}. *ID:* {user['telegram_id']}\n"
@@ -701,16 +1008,14 @@ async def show_admin_users(query, page=0):
             
             if active_coupons:
                 message += f"   🎁 *Активные купоны:*\n"
-                for coupon in active_coupons[:3]:  # Показываем до 3 активных купонов
-                    created_date = datetime.strptime(str(coupon['created_at']).split('.')[0], '%Y-%m-%d %H:%M:%S')
-                    valid_until_date = datetime.strptime(str(coupon['valid_until']).split('.')[0], '%Y-%m-%d %H:%M:%S')
-                    
+                for coupon in active_coupons:  # База возвращает до 3 активных купонов
                     message += (
-                        f"      • {coupon['coupon']} (с {created_date.strftime('%d.%m')} до {valid_until_date.strftime('%d.%m')})\n"
+                        f"      • {coupon.coupon} (с {format_timestamp(coupon.created_at, '%d.%m')} "
+                        f"до {format_timestamp(coupon.valid_until, '%d.%m')})\n"
                     )
                 
-                if len(active_coupons) > 3:
-                    message += f"      ... и еще {len(active_coupons) - 3} активных\n"
+                if user['active_count'] > 3:
+                    message += f"      ... и еще {user['active_count'] - 3} активных\n"
             else:
                 message += f"   📭 Нет активных купонов\n"
             
@@ -719,14 +1024,20 @@ async def show_admin_users(query, page=0):
         # Создаем клавиатуру с кнопками пагинации
         keyboard = []
         
-        # Кнопки навигации
+        # Кнопки навигации: в callback передаем номер страницы и ключ соседнего пользователя
         nav_buttons = []
         
         if current_page > 0:
-            nav_buttons.append(InlineKeyboardButton(f"⬅️ Предыдущая", callback_data=f"admin_users_page_{current_page - 1}"))
+            nav_buttons.append(InlineKeyboardButton(
+                f"⬅️ Предыдущая",
+                callback_data=f"admin_users_prev_{current_page - 1}_{users[0]['telegram_id']}"
+            ))
         
-        if current_page < total_pages - 1:
-            nav_buttons.append(InlineKeyboardButton(f"Следующая ➡️", callback_data=f"admin_users_page_{current_page + 1}"))
+        if current_page < total_pages - 1 and len(users) == users_per_page:
+            nav_buttons.append(InlineKeyboardButton(
+                f"Следующая ➡️",
+                callback_data=f"admin_users_next_{current_page + 1}_{users[-1]['telegram_id']}"
+            ))
         
         if nav_buttons:
             keyboard.append(nav_buttons)
@@ -753,74 +1064,21 @@ async def show_admin_users(query, page=0):
 
 async def export_data(query):
     """Экспорт данных"""
-    data = db.export_data()
-    
-    # Создаем CSV файл с купонами с UTF-8 BOM для Excel
-    coupons_csv = io.BytesIO()  # Изменяем на BytesIO
-    coupons_writer = csv.writer(io.StringIO(), delimiter=',', quoting=csv.QUOTE_MINIMAL)
-    
-    # Создаем список строк для записи
-    coupons_lines = []
-    
-    # Заголовки для купонов с BOM
-    header = ['Дата создания', 'Пользователь', 'Instagram', 
-              'Скидка', 'Кодовое слово', 'Действует по', 'Использован']
-    
-    # Добавляем UTF-8 BOM для корректного отображения в Excel
-    coupons_lines.append('\ufeff' + ','.join(header))
-    
-    for coupon in data['coupons']:
-        # Экранируем значения
-        created_at = str(coupon['created_at']).replace(',', ' ')
-        user_name = str(coupon['user_name']).replace(',', ' ')
-        instagram = str(coupon['instagram']).replace(',', ' ')
-        coupon_code = str(coupon['coupon']).replace(',', ' ')
-        code_word = str(coupon['code_word']).replace(',', ' ')
-        valid_until = str(coupon['valid_until']).replace(',', ' ')
-        used = str(coupon['used']).replace(',', ' ')
-        
-        line = f'"{created_at}","{user_name}","{instagram}","{coupon_code}","{code_word}","{valid_until}","{used}"'
-        coupons_lines.append(line)
-    
-    # Объединяем строки
-    coupons_content = '\n'.join(coupons_lines)
-    
-    # Создаем CSV файл с пользователями с UTF-8 BOM
-    users_lines = []
-    
-    # Заголовки для пользователей с BOM
-    header = ['Telegram ID', 'Username', 'Имя', 'Фамилия', 
-              'Дата регистрации', 'Всего спинов']
-    
-    users_lines.append('\ufeff' + ','.join(header))
-    
-    for user in data['users']:
-        # Экранируем значения
-        telegram_id = str(user['telegram_id']).replace(',', ' ')
-        username = str(user['username'] or '').replace(',', ' ')
-        first_name = str(user['first_name'] or '').replace(',', ' ')
-        last_name = str(user['last_name'] or '').replace(',', ' ')
-        joined_at = str(user['joined_at']).replace(',', ' ')
-        total_spins = str(user['total_spins']).replace(',', ' ')
-        
-        line = f'"{telegram_id}","{username}","{first_name}","{last_name}","{joined_at}","{total_spins}"'
-        users_lines.append(line)
-    
-    # Объединяем строки
-    users_content = '\n'.join(users_lines)
-    
-    # Отправляем файлы
-    await query.message.reply_document(
-        document=io.BytesIO(coupons_content.encode('utf-8-sig')),  # utf-8-sig добавляет BOM
-        filename='coupons_export.csv',
-        caption="📤 Экспорт купонов (кодировка UTF-8)"
-    )
-    
-    await query.message.reply_document(
-        document=io.BytesIO(users_content.encode('utf-8-sig')),  # utf-8-sig добавляет BOM
-        filename='users_export.csv',
-        caption="📤 Экспорт пользователей (кодировка UTF-8)"
-    )
+    # Файлы формируются потоково в пуле потоков БД, не блокируя других пользователей
+    for kind, caption in (
+        ('coupons', "📤 Экспорт купонов (кодировка UTF-8)"),
+        ('users', "📤 Экспорт пользователей (кодировка UTF-8)"),
+    ):
+        export_file, filename = await adb.run(build_export, adb.database, kind)
+        try:
+            # У файла в памяти нет имени (name=None), поэтому имя передаем явно
+            # и не даем библиотеке читать файл целиком: он уйдет потоком
+            await query.message.reply_document(
+                document=InputFile(export_file, filename=filename, read_file_handle=False),
+                caption=caption
+            )
+        finally:
+            export_file.close()
     
     # Возвращаем в админ-панель
     keyboard = [[
@@ -833,6 +1091,20 @@ async def export_data(query):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+@metrics.timed_handler
+async def rebuild_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /rebuild_stats - пересчитать счетчики статистики (только для админа)"""
+    if str(update.effective_user.id) != config.ADMIN_ID:
+        await update.message.reply_text("⛔ Доступ запрещен.")
+        return
+    
+    await adb.rebuild_stats_counters()
+    
+    await update.message.reply_text(
+        f"{EMOJIS['check']} Счетчики статистики пересчитаны."
+    )
+
+@metrics.timed_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
     help_text = (
@@ -860,6 +1132,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
 # CALLBACK HANDLERS ДЛЯ ПОЛЬЗОВАТЕЛЕЙ
+@metrics.timed_handler
 async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик callback для пользовательских кнопок"""
     query = update.callback_query
@@ -880,7 +1153,7 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
         await show_active_coupons(simple_update, context)
         
     elif query.data == "show_stats":
-        stats = db.get_user_stats(user_id)
+        stats = (await adb.get_user_summary(user_id))['stats']
         
         message = f"{EMOJIS['stats']} *Ваша статистика:*\n\n"
         message += f"🎯 Всего купонов: {stats['total']}\n"
@@ -900,16 +1173,8 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
         )
         
     elif query.data == "spin_wheel":
-        # Проверяем, можно ли крутить сегодня
-        if db.has_user_played_today(user_id):
-            await query.edit_message_text(
-                "Вы уже получали купон сегодня!\n"
-                "Используйте /mycoupons чтобы посмотреть активные купоны.\n"
-                "Новый купон будет доступен завтра.",
-                parse_mode='Markdown'
-            )
-        else:
-            await spin_wheel_handler(update, context)
+        # Дневной лимит проверяется атомарно в spin_wheel_handler
+        await spin_wheel_handler(update, context)
     
     elif query.data == "refresh_coupons":
         class SimpleUpdate:
@@ -967,15 +1232,56 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     logger.error(f"Ошибка: {context.error}")
     
+    # Флуд-контроль Telegram: еще одно сообщение только усугубит ситуацию
+    if isinstance(context.error, RetryAfter):
+        return
+    
     if update and update.effective_message:
         await update.effective_message.reply_text(
             "❌ Произошла ошибка. Пожалуйста, попробуйте позже."
         )
 
-def main():
-    """Запуск бота"""
-    # Создание Application
-    application = Application.builder().token(config.BOT_TOKEN).build()
+async def post_stop(application: Application):
+    """Прерывает анимации спина при остановке: результаты отправляются сразу"""
+    tasks = list(spin_animations.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def post_shutdown(application: Application):
+    """Освобождение ресурсов при остановке бота"""
+    adb.close()
+
+def build_application(updater=True, overall_rate=None, request=None):
+    """Создает Application со всеми хендлерами.
+
+    updater=False - без встроенного Updater: обновления кладутся в
+    application.update_queue извне (webhook-сервер, процесс-шард).
+    overall_rate - общий лимит сообщений в секунду для этого процесса
+    (по умолчанию TELEGRAM_OVERALL_RATE).
+    request - свой транспорт Bot API (например, FakeBotRequest в бенчмарке)
+    """
+    builder = Application.builder()
+    if not updater:
+        builder = builder.updater(None)
+    if request is not None:
+        builder = builder.request(request)
+    
+    application = (
+        builder
+        .token(config.BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(config.MAX_CONCURRENT_UPDATES))
+        .rate_limiter(PriorityRateLimiter(
+            overall_rate=overall_rate or config.TELEGRAM_OVERALL_RATE,
+            chat_rate=config.TELEGRAM_CHAT_RATE,
+            chat_burst=config.TELEGRAM_CHAT_BURST,
+            max_retries=config.TELEGRAM_MAX_RETRIES,
+            animation_max_wait=config.TELEGRAM_ANIMATION_MAX_WAIT
+        ))
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Conversation Handler для ПОЛЬЗОВАТЕЛЕЙ (только /start)
     user_conv_handler = ConversationHandler(
@@ -996,7 +1302,11 @@ def main():
                 CallbackQueryHandler(admin_callback_handler)
             ],
             ADMIN_MARK_COUPON: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_mark_coupon)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_mark_coupon),
+                MessageHandler(filters.Document.ALL, handle_admin_mark_coupon_file)
+            ],
+            ADMIN_SEARCH: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_search)
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
@@ -1010,11 +1320,12 @@ def main():
     application.add_handler(CommandHandler('mycoupons', show_active_coupons))
     application.add_handler(CommandHandler('spin', spin_wheel_command))
     application.add_handler(CommandHandler('help', help_command))
+    application.add_handler(CommandHandler('rebuild_stats', rebuild_stats_command))
     
     # Обработчики callback - отдельно для админа
     application.add_handler(CallbackQueryHandler(
         admin_callback_handler,
-        pattern="^(admin_stats|admin_users|admin_users_page_.*|admin_export|admin_mark_used|back_to_admin)$"
+        pattern="^(admin_stats|admin_users|admin_users_page_.*|admin_users_next_.*|admin_users_prev_.*|admin_export|admin_mark_used|admin_search|admin_search_page_.*|back_to_admin)$"
     ))
     # Обработчики callback для пользователей
     application.add_handler(CallbackQueryHandler(
@@ -1022,14 +1333,38 @@ def main():
         pattern="^(show_my_coupons|show_stats|spin_wheel|refresh_coupons|show_rules|back_to_coupons)$"
     ))
     
+    # Запись входящих обновлений для воспроизведения (replay.py)
+    if config.RECORD_UPDATES_PATH:
+        from replay import UpdateRecorder
+        recorder = UpdateRecorder(config.RECORD_UPDATES_PATH, config.RECORD_SECRET, config.ADMIN_ID)
+        application.add_handler(TypeHandler(Update, recorder.record), group=-1)
+    
     # Обработчик ошибок
     application.add_error_handler(error_handler)
     
+    return application
+
+def main():
+    """Запуск бота"""
+    webhook_mode = config.BOT_MODE == 'webhook'
+    # Локальный webhook-режим (без WEBHOOK_URL) запускает свой Updater без set_webhook
+    local_webhook = webhook_mode and not config.WEBHOOK_URL
+    application = build_application(updater=not local_webhook)
+    
     # Запуск бота
     print(f"🚀 {config.BOT_NAME} запускается в {datetime.now()}...")
-    
-    # Запуск polling
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if config.METRICS_PORT:
+        metrics.start_http_server(config.METRICS_PORT, config.METRICS_LISTEN)
+    
+    if local_webhook:
+        import webhook
+        asyncio.run(webhook.serve_local(application, ALLOWED_UPDATES))
+    elif webhook_mode:
+        import webhook
+        application.run_webhook(**webhook.webhook_options(ALLOWED_UPDATES))
+    else:
+        # Запуск polling
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
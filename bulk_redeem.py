@@ -0,0 +1,118 @@
+import csv
+import io
+import re
+import tempfile
+import config
+from database import format_timestamp
+
+# Заголовки отчета о массовой отметке купонов
+REPORT_HEADERS = ['Строка', 'Instagram', 'Скидка', 'Результат',
+                  'ID купона', 'Кодовое слово', 'Дата создания', 'Причина']
+
+# Разделители полей по убыванию приоритета: CSV из Excel (точка с запятой или
+# запятая), TSV, иначе пробелы
+DELIMITERS = (';', ',', '\t')
+DISCOUNT = re.compile(r'^\d+%$')
+
+
+def decode_file(data):
+    """Текст файла: UTF-8 (с BOM или без), иначе Windows-1251 из Excel"""
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp1251', errors='replace')
+
+
+def split_fields(line):
+    """Поля строки через csv.reader: кавычки снимаются одинаково для всех полей"""
+    delimiter = next((d for d in DELIMITERS if d in line), ' ')
+    fields = next(csv.reader([line], delimiter=delimiter, skipinitialspace=True))
+    return [field.strip().strip('"\'').strip() for field in fields if field.strip()]
+
+
+def parse_redemptions(data, max_lines=None):
+    """Разбирает файл со строками `instagram скидка`.
+
+    Возвращает (запросы, ошибки): запросы - список (номер строки, instagram,
+    скидка), ошибки - список (номер строки, исходная строка, причина). Пустые
+    строки и комментарии (#) пропускаются, как и заголовок в первой непустой
+    строке.
+    """
+    max_lines = max_lines or config.BULK_REDEEM_MAX_LINES
+    requests = []
+    errors = []
+    header_checked = False
+
+    for line_number, line in enumerate(decode_file(data).splitlines(), 1):
+        line = line.strip().lstrip('\ufeff').strip()
+        if not line or line.startswith('#'):
+            continue
+        if len(requests) + len(errors) >= max_lines:
+            raise ValueError(f"В файле больше {max_lines} строк")
+
+        parts = split_fields(line)
+        if len(parts) >= 2:
+            instagram = parts[0].replace('@', '')  # Убираем @ если есть
+            coupon_value = parts[1]
+            # Добавляем % если его нет
+            if not coupon_value.endswith('%'):
+                coupon_value = coupon_value + '%'
+            if instagram and DISCOUNT.match(coupon_value):
+                requests.append((line_number, instagram, coupon_value))
+                header_checked = True
+                continue
+
+        if not header_checked:
+            # Заголовок CSV (например, «instagram;скидка») - первая непустая строка
+            header_checked = True
+            continue
+        errors.append((line_number, line, 'Неверный формат, нужно: instagram скидка'))
+
+    return requests, errors
+
+
+def redeem_file(database, data):
+    """Отмечает купоны из загруженного файла и формирует отчет по каждой строке.
+
+    Функция блокирующая - вызывать из пула потоков БД.
+    Возвращает (файл отчета CSV, имя файла, сводка); файл перемотан в начало.
+    """
+    requests, errors = parse_redemptions(data)
+    results = database.mark_coupons_used_bulk(requests) if requests else []
+
+    rows = []
+    for result in results:
+        if result['success']:
+            rows.append((result['line'], [
+                result['line'], result['instagram'], result['coupon'], 'Отмечен',
+                result['coupon_id'], result['code_word'],
+                format_timestamp(result['created_at'], '%d.%m.%Y %H:%M'), ''
+            ]))
+        else:
+            rows.append((result['line'], [
+                result['line'], result['instagram'], result['coupon'], 'Не найден',
+                '', '', '', result['reason']
+            ]))
+    for line_number, line, reason in errors:
+        rows.append((line_number, [line_number, line, '', 'Ошибка', '', '', '', reason]))
+    rows.sort(key=lambda row: row[0])
+
+    output = tempfile.SpooledTemporaryFile(max_size=config.EXPORT_SPOOL_SIZE)
+    # utf-8-sig добавляет BOM для корректного отображения в Excel
+    text = io.TextIOWrapper(output, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(REPORT_HEADERS)
+    writer.writerows(row for _, row in rows)
+    text.flush()
+    # Отсоединяем обертку, чтобы она не закрыла временный файл
+    text.detach()
+    output.seek(0)
+
+    redeemed = sum(1 for result in results if result['success'])
+    summary = {
+        'lines': len(rows),
+        'redeemed': redeemed,
+        'not_found': len(results) - redeemed,
+        'invalid': len(errors),
+    }
+    return output, 'redeem_report.csv', summary
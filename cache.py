@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+# Маркер отсутствия значения (None - допустимое значение в кэше)
+MISSING = object()
+
+
+class TTLCache:
+    """Ограниченный по размеру кэш с вытеснением LRU и временем жизни записей.
+
+    Потокобезопасен: используется из потоков пула базы данных. clock - источник
+    времени (секунды Unix), для воспроизведения записи подменяется.
+    """
+
+    def __init__(self, name, max_size=10000, ttl=300, clock=time.time):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        metrics.track_cache(self)
+
+    def get(self, key, default=MISSING):
+        """Значение по ключу или default, если записи нет или она устарела"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > self.clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, expires_at=None):
+        """Сохранить значение; expires_at - момент устаревания (по умолчанию через ttl)"""
+        ttl_expiry = self.clock() + self.ttl
+        expires_at = ttl_expiry if expires_at is None else min(expires_at, ttl_expiry)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        """Удалить запись"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Удалить все записи"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -4,6 +4,102 @@ import os
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = os.getenv('ADMIN_ID')
 
+# Часовой пояс кампании: граница дня для «одного купона в день» и статистики
+CAMPAIGN_TIMEZONE = os.getenv('CAMPAIGN_TIMEZONE', 'Europe/Moscow')
+
+# Сколько обновлений обрабатывать одновременно (обновления одного
+# пользователя всегда обрабатываются по очереди)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '64'))
+
+# Ограничение исходящих запросов к Telegram: сообщений в секунду всего и на чат,
+# допустимый всплеск на чат, повторы после RetryAfter и сколько кадр анимации
+# может ждать в очереди, прежде чем его пропустят
+TELEGRAM_OVERALL_RATE = float(os.getenv('TELEGRAM_OVERALL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '3'))
+TELEGRAM_ANIMATION_MAX_WAIT = float(os.getenv('TELEGRAM_ANIMATION_MAX_WAIT', '1.0'))
+
+# Анимация колеса: количество кадров (0 - без анимации, для пиковой нагрузки)
+# и интервал между кадрами в секундах
+SPIN_ANIMATION_FRAMES = int(os.getenv('SPIN_ANIMATION_FRAMES', '5'))
+SPIN_ANIMATION_INTERVAL = float(os.getenv('SPIN_ANIMATION_INTERVAL', '0.5'))
+
+# Вид анимации спина: frames - редактирование сообщения по кадрам,
+# gif - один заранее отрендеренный GIF (python render_wheel.py)
+WHEEL_ANIMATION = os.getenv('WHEEL_ANIMATION', 'frames')
+WHEEL_MEDIA_DIR = os.getenv('WHEEL_MEDIA_DIR', 'wheel_media')
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Webhook: сервер слушает WEBHOOK_LISTEN:WEBHOOK_PORT за обратным прокси с TLS,
+# WEBHOOK_URL - публичный https-адрес (пустой - set_webhook не вызывается)
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+# Сертификат и ключ для прямого TLS без прокси
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT', '')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY', '')
+
+# Шардирование по telegram_id (python sharding.py): число процессов-обработчиков;
+# SHARD_INLINE=1 - все шарды в одном процессе (для тестов и отладки)
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '2'))
+SHARD_INLINE = os.getenv('SHARD_INLINE', '0') == '1'
+
+# Запись входящих обновлений для воспроизведения (python replay.py): путь к файлу
+# (.gz - со сжатием, {pid} - номер процесса; пустой - не записывать) и ключ
+# обезличивания id (пустой - случайный на каждый запуск)
+RECORD_UPDATES_PATH = os.getenv('RECORD_UPDATES_PATH', '')
+RECORD_SECRET = os.getenv('RECORD_SECRET', '')
+
+# Метрики Prometheus: адрес эндпоинта /metrics (0 - не запускать).
+# При шардировании процесс-шард i слушает METRICS_PORT + i
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Логирование (logging_setup.py): записи пишет в файл отдельный поток.
+# LOG_FORMAT: text или json (одна запись - одна строка JSON).
+# Ротация по размеру LOG_MAX_BYTES, при LOG_MAX_BYTES=0 - по времени LOG_ROTATE_WHEN
+LOG_FILE = os.getenv('LOG_FILE', 'bot_debug.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(50 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '10'))
+# Максимум записей в очереди; при переполнении записи отбрасываются
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Прореживание шумных логгеров ниже WARNING: логгер=доля записей через запятую
+# (httpx пишет строку на каждый запрос к Bot API)
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', 'httpx=0.01')
+
+# Настройки базы данных
+DB_PATH = os.getenv('DB_PATH', 'coupons.db')
+# Количество потоков для асинхронного доступа к базе данных
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '4'))
+# Сколько ждать снятия блокировки записи (секунды)
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '5'))
+# Размер кэша страниц SQLite на соединение (КБ)
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '16384'))
+# Размер memory-mapped I/O (байты, 0 - отключить)
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(64 * 1024 * 1024)))
+# Количество подготовленных запросов в кэше соединения
+DB_STATEMENT_CACHE = int(os.getenv('DB_STATEMENT_CACHE', '128'))
+# Профилирование запросов (query_profiler.py): 1 - замерять каждый запрос,
+# запросы дольше DB_SLOW_QUERY_MS миллисекунд пишутся в DB_SLOW_QUERY_LOG
+DB_PROFILE = os.getenv('DB_PROFILE', '0') == '1'
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '50'))
+DB_SLOW_QUERY_LOG = os.getenv('DB_SLOW_QUERY_LOG', 'slow_queries.log')
+# Кэши горячих чтений по пользователю: максимум записей в каждом кэше
+CACHE_MAX_SIZE = int(os.getenv('CACHE_MAX_SIZE', '10000'))
+# Время жизни записей кэша (регистрация, последний Instagram, «крутил сегодня»), секунды
+CACHE_TTL = int(os.getenv('CACHE_TTL', '600'))
+# Максимальное время жизни кэша сводки пользователя (секунды)
+USER_SUMMARY_TTL = int(os.getenv('USER_SUMMARY_TTL', '300'))
+
 # Конфигурация купонов с кодовыми словами
 COUPON_CONFIG = {
     "5%": {
@@ -28,6 +124,20 @@ COUPON_CONFIG = {
     }
 }
 
+# Экспорт данных: сжатие (none, gzip или zip), размер порции чтения из базы
+# и сколько байт держать в памяти, прежде чем временный файл уйдет на диск
+EXPORT_COMPRESSION = os.getenv('EXPORT_COMPRESSION', 'none')
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '1000'))
+EXPORT_SPOOL_SIZE = int(os.getenv('EXPORT_SPOOL_SIZE', str(4 * 1024 * 1024)))
+
+# Массовая отметка купонов из файла (строки «instagram скидка»):
+# максимальный размер файла (байты) и число строк
+BULK_REDEEM_MAX_BYTES = int(os.getenv('BULK_REDEEM_MAX_BYTES', str(1024 * 1024)))
+BULK_REDEEM_MAX_LINES = int(os.getenv('BULK_REDEEM_MAX_LINES', '20000'))
+
+# Выбирать призы криптографически стойким генератором (secrets.SystemRandom)
+PRIZE_SECURE_RANDOM = os.getenv('PRIZE_SECURE_RANDOM', '0') == '1'
+
 # Название и описание для админ-панели
 BOT_NAME = "Новогоднее Колесо Удачи"
 BOT_DESCRIPTION = "Бот для генерации новогодних скидочных купонов"
\ No newline at end of file
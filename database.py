@@ -1,19 +1,236 @@
 import sqlite3
-from datetime import datetime, timedelta
-import random
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+from collections import Counter
+import secrets
+import pytz
 import config
+import metrics
+from cache import TTLCache, MISSING
+from query_profiler import QueryProfiler, ProfilingConnection
+from prize_sampler import PrizeSampler
 from contextlib import contextmanager
 
-class Database:
-    def __init__(self, db_path='coupons.db'):
+# Часовой пояс кампании: «сегодня» для дневного лимита и статистики считается в нем
+CAMPAIGN_TZ = pytz.timezone(config.CAMPAIGN_TIMEZONE)
+
+# Срок действия купона, секунды
+COUPON_LIFETIME = 3 * 24 * 60 * 60
+
+# Формат дат в экспорте CSV
+EXPORT_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def campaign_day(moment=None):
+    """День кампании (YYYY-MM-DD) для момента времени.
+
+    moment - секунды Unix или datetime (наивное время считается локальным)
+    """
+    if moment is None:
+        moment = time.time()
+    if isinstance(moment, (int, float)):
+        return datetime.fromtimestamp(moment, CAMPAIGN_TZ).date().isoformat()
+    return moment.astimezone(CAMPAIGN_TZ).date().isoformat()
+
+def campaign_datetime(timestamp):
+    """Момент времени (секунды Unix) в часовом поясе кампании"""
+    return datetime.fromtimestamp(timestamp, CAMPAIGN_TZ)
+
+def format_timestamp(timestamp, fmt='%d.%m.%Y'):
+    """Дата из секунд Unix для показа (в часовом поясе кампании)"""
+    if timestamp is None:
+        return ''
+    return campaign_datetime(timestamp).strftime(fmt)
+
+def normalize_instagram(username):
+    """Нормализованный Instagram для поиска: без пробелов и @, в нижнем регистре"""
+    return str(username or '').strip().lstrip('@').lower()
+
+def redeem_failure_reason(total, same_coupon):
+    """Причина, по которой не нашелся активный купон: total - всего купонов
+    с этим Instagram, same_coupon - из них с нужной скидкой"""
+    if same_coupon:
+        return 'Все купоны с этой скидкой уже использованы или истекли'
+    if total:
+        return 'У пользователя нет купонов с такой скидкой'
+    return 'Пользователь с таким Instagram не найден'
+
+# Временная таблица строк массовой отметки купонов (своя у каждого соединения)
+BULK_REDEEM_TABLE = '''
+    CREATE TEMP TABLE IF NOT EXISTS bulk_redeem (
+        line INTEGER PRIMARY KEY,
+        instagram TEXT NOT NULL,
+        coupon TEXT NOT NULL,
+        coupon_id INTEGER
+    )
+'''
+
+# Колонки купона в порядке полей Coupon (для SELECT ... FROM coupons c)
+COUPON_COLUMNS = '''c.id, c.telegram_id, c.username, c.coupon, c.code_word,
+    c.created_at, c.valid_until, c.used'''
+
+class Coupon:
+    """Купон, один раз декодированный из строки базы.
+
+    Даты - целые секунды Unix. Строка должна содержать COUPON_COLUMNS
+    в том же порядке, дальше могут идти first_name и last_name из users.
+    """
+
+    __slots__ = ('id', 'telegram_id', 'username', 'coupon', 'code_word',
+                 'created_at', 'valid_until', 'used', 'first_name', 'last_name')
+
+    def __init__(self, id=None, telegram_id=None, username=None, coupon=None,
+                 code_word=None, created_at=None, valid_until=None, used=False,
+                 first_name=None, last_name=None):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.username = username
+        self.coupon = coupon
+        self.code_word = code_word
+        self.created_at = created_at
+        self.valid_until = valid_until
+        self.used = bool(used)
+        self.first_name = first_name
+        self.last_name = last_name
+
+    def __repr__(self):
+        return f'Coupon(id={self.id}, coupon={self.coupon!r}, username={self.username!r})'
+
+    @classmethod
+    def from_rows(cls, rows):
+        return [cls(*row) for row in rows]
+
+class ConnectionPool:
+    """Пул постоянных соединений SQLite: одно настроенное соединение на поток"""
+
+    def __init__(self, db_path, busy_timeout=5.0, cache_size_kb=16384,
+                 mmap_size=67108864, statement_cache=128, profiler=None):
         self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.statement_cache = statement_cache
+        # QueryProfiler: соединения замеряют каждый запрос (DB_PROFILE=1)
+        self.profiler = profiler
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Открывает и настраивает новое соединение"""
+        # Соединение используется только своим потоком, но закрывается
+        # из основного потока при остановке бота
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            cached_statements=self.statement_cache,
+            check_same_thread=False,
+            factory=ProfilingConnection if self.profiler else sqlite3.Connection
+        )
+        if self.profiler:
+            conn.attach(self.profiler)
+        conn.row_factory = sqlite3.Row  # Для доступа к колонкам по имени
+        
+        # WAL позволяет читать параллельно с записью, а synchronous=NORMAL
+        # в режиме WAL убирает fsync на каждый коммит
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(self.busy_timeout * 1000)}')
+        # Отрицательное значение cache_size задается в килобайтах
+        conn.execute(f'PRAGMA cache_size=-{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def get(self):
+        """Возвращает соединение текущего потока, создавая его при необходимости"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """Закрывает все открытые соединения"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.execute('PRAGMA optimize')
+                conn.close()
+            except sqlite3.Error:
+                pass
+        # Потоки, которые продолжат работу, откроют новые соединения
+        self._local = threading.local()
+
+class Database:
+    # Миграции схемы по порядку; номер применённой миграции хранится в PRAGMA user_version
+    MIGRATIONS = (
+        '_migration_spin_day',
+        '_migration_campaign_timezone',
+        '_migration_instagram_lookup',
+        '_migration_search_index',
+        '_migration_users_page',
+        '_migration_stats_counters',
+        '_migration_media_file_ids',
+        '_migration_epoch_timestamps',
+    )
+    
+    def __init__(self, db_path=None, clock=time.time):
+        self.db_path = db_path or config.DB_PATH
+        # Источник текущего времени (секунды Unix): «сегодня», сроки купонов, кэши
+        self.clock = clock
+        self.profiler = None
+        if config.DB_PROFILE:
+            self.profiler = QueryProfiler(config.DB_SLOW_QUERY_MS, config.DB_SLOW_QUERY_LOG)
+        self.pool = ConnectionPool(
+            self.db_path,
+            busy_timeout=config.DB_BUSY_TIMEOUT,
+            cache_size_kb=config.DB_CACHE_SIZE_KB,
+            mmap_size=config.DB_MMAP_SIZE,
+            statement_cache=config.DB_STATEMENT_CACHE,
+            profiler=self.profiler
+        )
+        # Выбор приза: таблица алиасов строится один раз из COUPON_CONFIG
+        # и перестраивается, только если словарь конфигурации заменили
+        self.prize_sampler = PrizeSampler(
+            rng=secrets.SystemRandom() if config.PRIZE_SECURE_RANDOM else None
+        )
+        # file_id анимаций колеса: (ключ, отпечаток конфигурации) -> file_id
+        self.media_file_ids = {}
+        # Кэши горячих чтений по пользователю
+        # (при шардировании процессы держат кэши своих пользователей,
+        # invalidation_hook сообщает о сбросе сводки чужого пользователя)
+        self.invalidation_hook = None
+        self.user_summary_cache = TTLCache('user_summary', config.CACHE_MAX_SIZE, config.USER_SUMMARY_TTL, clock)
+        self.registered_cache = TTLCache('registered', config.CACHE_MAX_SIZE, config.CACHE_TTL, clock)
+        self.last_instagram_cache = TTLCache('last_instagram', config.CACHE_MAX_SIZE, config.CACHE_TTL, clock)
+        self.spun_today_cache = TTLCache('spun_today', config.CACHE_MAX_SIZE, config.CACHE_TTL, clock)
         self.init_db()
     
+    def use_clock(self, clock):
+        """Подменяет источник времени базы и ее кэшей (воспроизведение записи)"""
+        self.clock = clock
+        for cache in (self.user_summary_cache, self.registered_cache,
+                      self.last_instagram_cache, self.spun_today_cache):
+            cache.clock = clock
+    
     def get_connection(self):
-        """Создает соединение с базой данных"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row  # Для доступа к колонкам по имени
-        return conn
+        """Возвращает постоянное соединение текущего потока из пула"""
+        return self.pool.get()
+    
+    def close(self):
+        """Закрывает все соединения с базой данных"""
+        self.pool.close()
+        if self.profiler:
+            self.profiler.log_report()
     
     def init_db(self):
         """Инициализация таблиц"""
@@ -47,159 +264,570 @@ class Database:
             ''')
             
             # Индексы
-            cursor.execute('''
-                CREATE INDEX IF NOT EXISTS idx_user_date 
-                ON coupons(telegram_id, date(created_at))
-            ''')
-            
             cursor.execute('''
                 CREATE INDEX IF NOT EXISTS idx_valid_until 
                 ON coupons(valid_until)
             ''')
             
             conn.commit()
+            
+            self.migrate(conn)
+    
+    def migrate(self, conn):
+        """Применяет недостающие миграции схемы, каждую в своей транзакции"""
+        for number, name in enumerate(self.MIGRATIONS, 1):
+            cursor = conn.cursor()
+            # IMMEDIATE сразу берет блокировку записи, чтобы миграцию
+            # не применили одновременно из двух процессов
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                version = cursor.execute('PRAGMA user_version').fetchone()[0]
+                if version < number:
+                    getattr(self, name)(cursor)
+                    cursor.execute(f'PRAGMA user_version = {number}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def _migration_spin_day(self, cursor):
+        """День спина и уникальное ограничение «один купон в день»"""
+        cursor.execute('ALTER TABLE coupons ADD COLUMN spin_day TEXT')
+        
+        # Заполняем день только для первого купона пользователя за день:
+        # старые дубликаты остаются с NULL и не мешают уникальному индексу
+        cursor.execute('''
+            UPDATE coupons SET spin_day = date(created_at)
+            WHERE id IN (
+                SELECT MIN(id) FROM coupons
+                GROUP BY telegram_id, date(created_at)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_coupons_user_day
+            ON coupons(telegram_id, spin_day)
+        ''')
+    
+    def _migration_campaign_timezone(self, cursor):
+        """Пересчет spin_day в часовом поясе кампании и индексы для диапазонов по дню"""
+        cursor.execute('UPDATE coupons SET spin_day = NULL')
+        
+        # created_at хранится в локальном времени сервера; первый купон
+        # пользователя за день кампании получает spin_day
+        cursor.execute('SELECT id, telegram_id, created_at FROM coupons ORDER BY id')
+        seen = set()
+        updates = []
+        for row in cursor.fetchall():
+            day = campaign_day(datetime.fromisoformat(str(row['created_at'])))
+            if (row['telegram_id'], day) not in seen:
+                seen.add((row['telegram_id'], day))
+                updates.append((day, row['id']))
+        cursor.executemany('UPDATE coupons SET spin_day = ? WHERE id = ?', updates)
+        
+        # Индекс по выражению date(created_at) больше не используется
+        cursor.execute('DROP INDEX IF EXISTS idx_user_date')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_coupons_spin_day
+            ON coupons(spin_day)
+        ''')
+    
+    def _migration_instagram_lookup(self, cursor):
+        """Нормализованный Instagram и индекс для погашения купонов"""
+        cursor.execute('ALTER TABLE coupons ADD COLUMN instagram TEXT')
+        
+        cursor.connection.create_function(
+            'normalize_instagram', 1, normalize_instagram, deterministic=True
+        )
+        cursor.execute('UPDATE coupons SET instagram = normalize_instagram(username)')
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_coupons_instagram
+            ON coupons(instagram, coupon, used, valid_until)
+        ''')
+    
+    def _migration_search_index(self, cursor):
+        """Полнотекстовый trigram-индекс для поиска купонов в админке"""
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS coupons_fts USING fts5(
+                username, coupon, code_word,
+                content='coupons', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+        self._create_search_triggers(cursor)
+        cursor.execute("INSERT INTO coupons_fts(coupons_fts) VALUES ('rebuild')")
+    
+    def _migration_users_page(self, cursor):
+        """Индекс для постраничного списка пользователей и счетчик пользователей"""
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_users_joined
+            ON users(joined_at, telegram_id)
+        ''')
+        
+        # Таблица счетчиков, которые обновляются триггерами в той же транзакции
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            INSERT OR REPLACE INTO stats_counters (name, value)
+            SELECT 'users', COUNT(*) FROM users
+        ''')
+        self._create_users_counter_triggers(cursor)
+    
+    def _migration_stats_counters(self, cursor):
+        """Счетчики купонов для статистики админа, обновляемые триггерами"""
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_users_total_spins
+            ON users(total_spins)
+        ''')
+        self._create_counter_triggers(cursor)
+        self._fill_stats_counters(cursor)
+    
+    def _migration_media_file_ids(self, cursor):
+        """file_id загруженных в Telegram анимаций колеса"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_file_ids (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                file_id TEXT NOT NULL
+            )
+        ''')
+    
+    def _migration_epoch_timestamps(self, cursor):
+        """Даты купонов и пользователей - целые секунды Unix вместо строк.
+        
+        Тип колонки в SQLite не меняется, поэтому таблицы пересоздаются с переносом
+        данных, а индексы и триггеры создаются заново. created_at и valid_until
+        купонов записаны в локальном времени сервера, joined_at - в UTC.
+        """
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'coupons'")
+        row = cursor.fetchone()
+        sequence = row[0] if row else 0
+        
+        cursor.execute('''
+            CREATE TABLE coupons_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                coupon TEXT NOT NULL,
+                code_word TEXT NOT NULL,
+                created_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                valid_until INTEGER NOT NULL,
+                used INTEGER NOT NULL DEFAULT 0,
+                spin_day TEXT,
+                instagram TEXT
+            )
+        ''')
+        cursor.execute('''
+            INSERT INTO coupons_new
+            SELECT
+                id, telegram_id, username, coupon, code_word,
+                CAST(strftime('%s', created_at, 'utc') AS INTEGER),
+                CAST(strftime('%s', valid_until, 'utc') AS INTEGER),
+                COALESCE(used, 0), spin_day, instagram
+            FROM coupons
+        ''')
+        cursor.execute('DROP TABLE coupons')
+        cursor.execute('ALTER TABLE coupons_new RENAME TO coupons')
+        
+        # Номера удаленных купонов не должны выдаваться повторно
+        cursor.execute('''
+            UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'coupons'
+        ''', (sequence,))
+        cursor.execute('''
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT 'coupons', ? WHERE ? > 0 AND NOT EXISTS (
+                SELECT 1 FROM sqlite_sequence WHERE name = 'coupons'
+            )
+        ''', (sequence, sequence))
+        
+        cursor.execute('CREATE INDEX idx_valid_until ON coupons(valid_until)')
+        cursor.execute('''
+            CREATE UNIQUE INDEX idx_coupons_user_day
+            ON coupons(telegram_id, spin_day)
+        ''')
+        cursor.execute('CREATE INDEX idx_coupons_spin_day ON coupons(spin_day)')
+        cursor.execute('''
+            CREATE INDEX idx_coupons_instagram
+            ON coupons(instagram, coupon, used, valid_until)
+        ''')
+        # Купоны пользователя по дате - без сортировки (сводка, последний Instagram)
+        cursor.execute('''
+            CREATE INDEX idx_coupons_user_created
+            ON coupons(telegram_id, created_at)
+        ''')
+        # Строки coupons_fts ссылаются на те же id, индекс поиска перестраивать не нужно
+        self._create_search_triggers(cursor)
+        self._create_counter_triggers(cursor)
+        
+        cursor.execute('''
+            CREATE TABLE users_new (
+                telegram_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                joined_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                total_spins INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            INSERT INTO users_new
+            SELECT
+                telegram_id, username, first_name, last_name,
+                CAST(strftime('%s', joined_at) AS INTEGER),
+                total_spins
+            FROM users
+        ''')
+        cursor.execute('DROP TABLE users')
+        cursor.execute('ALTER TABLE users_new RENAME TO users')
+        cursor.execute('''
+            CREATE INDEX idx_users_joined
+            ON users(joined_at, telegram_id)
+        ''')
+        cursor.execute('CREATE INDEX idx_users_total_spins ON users(total_spins)')
+        self._create_users_counter_triggers(cursor)
+    
+    def _create_users_counter_triggers(self, cursor):
+        """Триггеры счетчика пользователей в stats_counters"""
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS users_counter_insert AFTER INSERT ON users BEGIN
+                UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS users_counter_delete AFTER DELETE ON users BEGIN
+                UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+            END
+        ''')
+
+    def _create_counter_triggers(self, cursor):
+        """Триггеры, поддерживающие stats_counters в той же транзакции, что и запись купона.
+        
+        Счетчики: coupons - всего купонов, coupon_users - пользователей с купонами,
+        used - использованных, prize:<скидка> - по скидкам, day:<spin_day> - по дням.
+        """
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS coupons_counter_insert AFTER INSERT ON coupons BEGIN
+                INSERT INTO stats_counters (name, value) VALUES ('coupons', 1)
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                INSERT INTO stats_counters (name, value) VALUES ('prize:' || new.coupon, 1)
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                INSERT INTO stats_counters (name, value)
+                    SELECT 'day:' || new.spin_day, 1 WHERE new.spin_day IS NOT NULL
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                INSERT INTO stats_counters (name, value)
+                    SELECT 'used', 1 WHERE new.used
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                INSERT INTO stats_counters (name, value)
+                    SELECT 'coupon_users', 1 WHERE NOT EXISTS (
+                        SELECT 1 FROM coupons
+                        WHERE telegram_id = new.telegram_id AND id <> new.id
+                    )
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS coupons_counter_used
+            AFTER UPDATE OF used ON coupons WHEN new.used <> old.used BEGIN
+                INSERT INTO stats_counters (name, value)
+                    VALUES ('used', CASE WHEN new.used THEN 1 ELSE -1 END)
+                    ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS coupons_counter_delete AFTER DELETE ON coupons BEGIN
+                UPDATE stats_counters SET value = value - 1
+                    WHERE name IN ('coupons', 'prize:' || old.coupon, 'day:' || old.spin_day);
+                UPDATE stats_counters SET value = value - 1
+                    WHERE name = 'used' AND old.used;
+                UPDATE stats_counters SET value = value - 1
+                    WHERE name = 'coupon_users' AND NOT EXISTS (
+                        SELECT 1 FROM coupons WHERE telegram_id = old.telegram_id
+                    );
+            END
+        ''')
+    
+    def _fill_stats_counters(self, cursor):
+        """Пересчитывает все счетчики по исходным таблицам"""
+        cursor.execute('DELETE FROM stats_counters')
+        cursor.execute('''
+            INSERT INTO stats_counters (name, value)
+            SELECT 'users', COUNT(*) FROM users
+            UNION ALL
+            SELECT 'coupons', COUNT(*) FROM coupons
+            UNION ALL
+            SELECT 'coupon_users', COUNT(DISTINCT telegram_id) FROM coupons
+            UNION ALL
+            SELECT 'used', COUNT(*) FROM coupons WHERE used
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_counters (name, value)
+            SELECT 'prize:' || coupon, COUNT(*) FROM coupons GROUP BY coupon
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_counters (name, value)
+            SELECT 'day:' || spin_day, COUNT(*) FROM coupons
+            WHERE spin_day IS NOT NULL GROUP BY spin_day
+        ''')
+    
+    def rebuild_stats_counters(self):
+        """Восстановить счетчики статистики по исходным данным"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self._fill_stats_counters(cursor)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    def _create_search_triggers(self, cursor):
+        """Триггеры, поддерживающие coupons_fts в актуальном состоянии"""
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS coupons_fts_insert AFTER INSERT ON coupons BEGIN
+                INSERT INTO coupons_fts(rowid, username, coupon, code_word)
+                VALUES (new.id, new.username, new.coupon, new.code_word);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS coupons_fts_delete AFTER DELETE ON coupons BEGIN
+                INSERT INTO coupons_fts(coupons_fts, rowid, username, coupon, code_word)
+                VALUES ('delete', old.id, old.username, old.coupon, old.code_word);
+            END
+        ''')
+        # Пометка купона использованным не меняет индексируемые поля и триггер не вызывает
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS coupons_fts_update
+            AFTER UPDATE OF username, coupon, code_word ON coupons BEGIN
+                INSERT INTO coupons_fts(coupons_fts, rowid, username, coupon, code_word)
+                VALUES ('delete', old.id, old.username, old.coupon, old.code_word);
+                INSERT INTO coupons_fts(rowid, username, coupon, code_word)
+                VALUES (new.id, new.username, new.coupon, new.code_word);
+            END
+        ''')
+    
+    def cache_stats(self):
+        """Размер и счетчики попаданий/промахов кэшей"""
+        caches = (
+            self.user_summary_cache,
+            self.registered_cache,
+            self.last_instagram_cache,
+            self.spun_today_cache
+        )
+        return {cache.name: cache.stats() for cache in caches}
     
     def has_user_played_today(self, telegram_id):
         """Проверяет, получал ли пользователь купон сегодня (без учета времени)"""
+        today = campaign_day(self.clock())  # Только дата в часовом поясе кампании
+        
+        played = self.spun_today_cache.get((telegram_id, today))
+        if played is not MISSING:
+            return played
+        
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            today = datetime.now().date()  # Только дата, без времени
-            
             cursor.execute('''
                 SELECT id FROM coupons 
                 WHERE telegram_id = ? 
-                AND date(created_at) = ?
+                AND spin_day = ?
                 LIMIT 1
             ''', (telegram_id, today))
             
-            return cursor.fetchone() is not None
+            played = cursor.fetchone() is not None
+        
+        self.spun_today_cache.set((telegram_id, today), played)
+        return played
     
     def get_active_coupons(self, telegram_id):
         """Получает активные купоны пользователя (не истекшие и не использованные)"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            now = datetime.now()
+            now = int(self.clock())
             
-            cursor.execute('''
-                SELECT * FROM coupons 
+            cursor.execute(f'''
+                SELECT {COUPON_COLUMNS} FROM coupons c
                 WHERE telegram_id = ? 
                 AND valid_until >= ?
                 AND used = 0
                 ORDER BY created_at DESC
             ''', (telegram_id, now))
             
-            return cursor.fetchall()
+            return Coupon.from_rows(cursor.fetchall())
+    
+    def _query_user_stats(self, cursor, telegram_id, now):
+        """Статистика пользователя одним запросом с условной агрегацией"""
+        cursor.execute('''
+            SELECT 
+                COUNT(*) AS total,
+                COALESCE(SUM(used = 1), 0) AS used,
+                COALESCE(SUM(used = 0 AND valid_until >= ?), 0) AS active,
+                MIN(created_at) AS first_spin,
+                MIN(CASE WHEN used = 0 AND valid_until >= ? THEN valid_until END) AS next_expiry
+            FROM coupons 
+            WHERE telegram_id = ?
+        ''', (now, now, telegram_id))
+        return dict(cursor.fetchone())
     
     def get_user_stats(self, telegram_id):
         """Получает статистику пользователя"""
+        with self.get_connection() as conn:
+            stats = self._query_user_stats(conn.cursor(), telegram_id, int(self.clock()))
+            del stats['next_expiry']
+            return stats
+    
+    def get_user_summary(self, telegram_id):
+        """Статистика и активные купоны пользователя (с кэшированием в процессе).
+        
+        Кэш сбрасывается при спине и погашении купона, а также когда истекает
+        ближайший активный купон пользователя, но не позже USER_SUMMARY_TTL.
+        """
+        summary = self.user_summary_cache.get(telegram_id)
+        if summary is not MISSING:
+            return summary
+        
+        now = int(self.clock())
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            stats = self._query_user_stats(cursor, telegram_id, now)
             
-            # Общее количество купонов
-            cursor.execute('SELECT COUNT(*) FROM coupons WHERE telegram_id = ?', (telegram_id,))
-            total = cursor.fetchone()[0]
-            
-            # Использованные купоны
-            cursor.execute('SELECT COUNT(*) FROM coupons WHERE telegram_id = ? AND used = 1', (telegram_id,))
-            used = cursor.fetchone()[0]
-            
-            # Активные купоны
-            cursor.execute('''
-                SELECT COUNT(*) FROM coupons 
+            cursor.execute(f'''
+                SELECT {COUPON_COLUMNS} FROM coupons c
                 WHERE telegram_id = ? 
-                AND valid_until >= datetime('now')
+                AND valid_until >= ?
                 AND used = 0
-            ''', (telegram_id,))
-            active = cursor.fetchone()[0]
-            
-            # Первый спин
-            cursor.execute('''
-                SELECT MIN(created_at) FROM coupons WHERE telegram_id = ?
-            ''', (telegram_id,))
-            first_spin = cursor.fetchone()[0]
-            
-            return {
-                'total': total,
-                'used': used,
-                'active': active,
-                'first_spin': first_spin
-            }
+                ORDER BY created_at DESC
+            ''', (telegram_id, now))
+            active_coupons = Coupon.from_rows(cursor.fetchall())
+        
+        # Сводка устаревает, когда истекает ближайший активный купон
+        expires_at = stats.pop('next_expiry')
+        
+        summary = {
+            'stats': stats,
+            'active_coupons': active_coupons
+        }
+        self.user_summary_cache.set(telegram_id, summary, expires_at)
+        return summary
+    
+    def invalidate_user_summary(self, telegram_id, propagate=True):
+        """Сбросить кэшированную сводку пользователя"""
+        self.user_summary_cache.pop(telegram_id)
+        if propagate and self.invalidation_hook:
+            self.invalidation_hook(telegram_id)
     
     def generate_coupon(self):
         """Генерация купона с учетом вероятностей и кодовых слов"""
-        coupons = []
-        weights = []
-        code_words = []
+        self.prize_sampler.ensure_current()
+        return self.prize_sampler.draw()
+    
+    def reserve_spin(self, telegram_id, username=None):
+        """Атомарно резервирует спин: проверяет дневной лимит, выбирает приз и сохраняет купон.
         
-        for coupon, data in config.COUPON_CONFIG.items():
-            coupons.append(coupon)
-            weights.append(data['chance'])
-            code_words.append(data['code_word'])
+        Возвращает данные купона или None, если пользователь уже крутил колесо сегодня.
+        Если username не передан, используется последний Instagram пользователя.
+        """
+        created_at = int(self.clock())
+        valid_until = created_at + COUPON_LIFETIME
+        spin_day = campaign_day(created_at)
         
-        random_index = random.choices(range(len(coupons)), weights=weights, k=1)[0]
+        # Уже известно, что пользователь крутил сегодня, - в базу не идем
+        if self.spun_today_cache.get((telegram_id, spin_day)) is True:
+            return None
         
-        return {
-            'coupon': coupons[random_index],
-            'code_word': code_words[random_index],
-            'emoji': config.COUPON_CONFIG[coupons[random_index]]['emoji']
-        }
-    
-    def save_coupon(self, telegram_id, username, coupon_data):
-        """Сохранение купона в базу данных"""
-        created_at = datetime.now()
-        valid_until = created_at + timedelta(days=3)
+        coupon_data = self.generate_coupon()
+        if not username:
+            username = self.last_instagram_cache.get(telegram_id, None)
         
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            if not username:
+                cursor.execute('''
+                    SELECT username FROM coupons 
+                    WHERE telegram_id = ? 
+                    ORDER BY created_at DESC 
+                    LIMIT 1
+                ''', (telegram_id,))
+                result = cursor.fetchone()
+                username = result[0] if result else "не указан"
             
-            # Сохраняем купон
-            cursor.execute('''
-                INSERT INTO coupons 
-                (telegram_id, username, coupon, code_word, created_at, valid_until)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                telegram_id, 
-                username, 
-                coupon_data['coupon'], 
-                coupon_data['code_word'],
-                created_at, 
-                valid_until
-            ))
+            # Уникальный индекс (telegram_id, spin_day) не даст выдать второй купон за день,
+            # даже если два обновления пришли одновременно
+            try:
+                cursor.execute('''
+                    INSERT INTO coupons 
+                    (telegram_id, username, instagram, coupon, code_word,
+                     created_at, valid_until, spin_day)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    telegram_id, 
+                    username, 
+                    normalize_instagram(username),
+                    coupon_data['coupon'], 
+                    coupon_data['code_word'],
+                    created_at, 
+                    valid_until,
+                    spin_day
+                ))
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                self.spun_today_cache.set((telegram_id, spin_day), True)
+                return None
+            coupon_id = cursor.lastrowid
             
             # Обновляем статистику пользователя
             cursor.execute('''
-                INSERT OR REPLACE INTO users 
-                (telegram_id, username, total_spins)
-                VALUES (?, ?, COALESCE(
-                    (SELECT total_spins FROM users WHERE telegram_id = ?), 
-                    0
-                ) + 1)
-            ''', (telegram_id, username, telegram_id))
+                INSERT INTO users (telegram_id, username, total_spins)
+                VALUES (?, ?, 1)
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    username = excluded.username,
+                    total_spins = total_spins + 1
+            ''', (telegram_id, username))
             
             conn.commit()
-            
-            return {
-                'id': cursor.lastrowid,
-                'created_at': created_at,
-                'valid_until': valid_until
-            }
+        except Exception:
+            conn.rollback()
+            raise
+        
+        # Обновляем кэши сразу после записи
+        self.invalidate_user_summary(telegram_id)
+        self.registered_cache.set(telegram_id, True)
+        self.last_instagram_cache.set(telegram_id, username)
+        self.spun_today_cache.set((telegram_id, spin_day), True)
+        metrics.SPINS.labels(prize=coupon_data['coupon']).inc()
+        
+        return {
+            **coupon_data,
+            'id': coupon_id,
+            'username': username,
+            'created_at': created_at,
+            'valid_until': valid_until
+        }
     
     def mark_coupon_used_by_instagram(self, instagram, coupon_value):
         """Пометить один активный купон пользователя как использованный"""
+        instagram = normalize_instagram(instagram)
+        
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
             # Ищем активный купон пользователя с указанной скидкой
+            # (поиск по индексу idx_coupons_instagram)
             cursor.execute('''
-                SELECT id, code_word, created_at 
+                SELECT id, telegram_id, code_word, created_at 
                 FROM coupons 
-                WHERE username = ? 
+                WHERE instagram = ? 
                 AND coupon = ? 
                 AND used = 0 
-                AND valid_until >= datetime('now')
+                AND valid_until >= ?
                 ORDER BY created_at ASC
                 LIMIT 1
-            ''', (instagram, coupon_value))
+            ''', (instagram, coupon_value, int(self.clock())))
             
             coupon = cursor.fetchone()
             
@@ -207,6 +835,8 @@ class Database:
                 # Помечаем купон как использованный
                 cursor.execute('UPDATE coupons SET used = 1 WHERE id = ?', (coupon['id'],))
                 conn.commit()
+                self.invalidate_user_summary(coupon['telegram_id'])
+                metrics.REDEMPTIONS.inc()
                 
                 return {
                     'success': True,
@@ -214,34 +844,125 @@ class Database:
                     'code_word': coupon['code_word'],
                     'created_at': coupon['created_at']
                 }
+            
+            # Причину отказа определяем одним запросом по префиксу того же индекса
+            cursor.execute('''
+                SELECT COUNT(*) AS total, COALESCE(SUM(coupon = ?), 0) AS same_coupon
+                FROM coupons 
+                WHERE instagram = ?
+            ''', (coupon_value, instagram))
+            found = cursor.fetchone()
+            
+            return {
+                'success': False,
+                'reason': redeem_failure_reason(found['total'], found['same_coupon'])
+            }
+    
+    def mark_coupons_used_bulk(self, requests):
+        """Пометить использованными купоны по списку (номер строки, instagram, скидка).
+        
+        Все строки обрабатываются одной транзакцией: строки пишутся во временную
+        таблицу через executemany, а купоны подбираются одним запросом. n-я строка
+        с одинаковыми instagram и скидкой получает n-й по дате создания активный
+        купон - как при поочередной отметке. Возвращает результат по каждой
+        строке в порядке номеров строк.
+        """
+        now = int(self.clock())
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute(BULK_REDEEM_TABLE)
+            cursor.execute('DELETE FROM bulk_redeem')
+            cursor.executemany(
+                'INSERT INTO bulk_redeem (line, instagram, coupon) VALUES (?, ?, ?)',
+                [(line, normalize_instagram(instagram), coupon)
+                 for line, instagram, coupon in requests]
+            )
+            
+            # Активные купоны каждой пары ищутся по индексу idx_coupons_instagram
+            cursor.execute('''
+                WITH wanted AS (
+                    SELECT line, instagram, coupon,
+                        ROW_NUMBER() OVER (PARTITION BY instagram, coupon ORDER BY line) AS n
+                    FROM bulk_redeem
+                ),
+                available AS (
+                    SELECT c.id, c.instagram, c.coupon,
+                        ROW_NUMBER() OVER (
+                            PARTITION BY c.instagram, c.coupon ORDER BY c.created_at, c.id
+                        ) AS n
+                    FROM (SELECT DISTINCT instagram, coupon FROM bulk_redeem) AS k
+                    JOIN coupons c
+                        ON c.instagram = k.instagram
+                        AND c.coupon = k.coupon
+                        AND c.used = 0
+                        AND c.valid_until >= ?
+                )
+                UPDATE bulk_redeem SET coupon_id = a.id
+                FROM wanted AS w
+                JOIN available AS a
+                    ON a.instagram = w.instagram AND a.coupon = w.coupon AND a.n = w.n
+                WHERE bulk_redeem.line = w.line
+            ''', (now,))
+            
+            cursor.execute('''
+                UPDATE coupons SET used = 1
+                WHERE id IN (SELECT coupon_id FROM bulk_redeem WHERE coupon_id IS NOT NULL)
+            ''')
+            redeemed = cursor.rowcount
+            
+            # Причины отказа для всех ненайденных пар - одним запросом
+            cursor.execute('''
+                SELECT k.instagram, k.coupon,
+                    COUNT(c.id) AS total, COALESCE(SUM(c.coupon = k.coupon), 0) AS same_coupon
+                FROM (
+                    SELECT DISTINCT instagram, coupon FROM bulk_redeem WHERE coupon_id IS NULL
+                ) AS k
+                LEFT JOIN coupons c ON c.instagram = k.instagram
+                GROUP BY k.instagram, k.coupon
+            ''')
+            reasons = {
+                (row['instagram'], row['coupon']):
+                    redeem_failure_reason(row['total'], row['same_coupon'])
+                for row in cursor.fetchall()
+            }
+            
+            cursor.execute('''
+                SELECT b.line, b.instagram, b.coupon,
+                    c.id, c.telegram_id, c.code_word, c.created_at
+                FROM bulk_redeem b
+                LEFT JOIN coupons c ON c.id = b.coupon_id
+                ORDER BY b.line
+            ''')
+            rows = cursor.fetchall()
+            cursor.execute('DELETE FROM bulk_redeem')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        results = []
+        telegram_ids = set()
+        for row in rows:
+            result = {'line': row['line'], 'instagram': row['instagram'], 'coupon': row['coupon']}
+            if row['id'] is not None:
+                telegram_ids.add(row['telegram_id'])
+                result.update(
+                    success=True,
+                    coupon_id=row['id'],
+                    code_word=row['code_word'],
+                    created_at=row['created_at']
+                )
             else:
-                # Проверяем, есть ли вообще пользователь с таким инстаграмом
-                cursor.execute('SELECT COUNT(*) FROM coupons WHERE username = ?', (instagram,))
-                user_exists = cursor.fetchone()[0] > 0
-                
-                if user_exists:
-                    # Проверяем, есть ли купоны с такой скидкой (даже использованные)
-                    cursor.execute('''
-                        SELECT COUNT(*) FROM coupons 
-                        WHERE username = ? AND coupon = ?
-                    ''', (instagram, coupon_value))
-                    coupon_exists = cursor.fetchone()[0] > 0
-                    
-                    if coupon_exists:
-                        return {
-                            'success': False,
-                            'reason': 'Все купоны с этой скидкой уже использованы или истекли'
-                        }
-                    else:
-                        return {
-                            'success': False,
-                            'reason': 'У пользователя нет купонов с такой скидкой'
-                        }
-                else:
-                    return {
-                        'success': False,
-                        'reason': 'Пользователь с таким Instagram не найден'
-                    }
+                result.update(success=False, reason=reasons[(row['instagram'], row['coupon'])])
+            results.append(result)
+        
+        for telegram_id in telegram_ids:
+            self.invalidate_user_summary(telegram_id)
+        metrics.REDEMPTIONS.inc(redeemed)
+        
+        return results
     
     # АДМИН МЕТОДЫ
     def get_admin_stats(self):
@@ -249,34 +970,37 @@ class Database:
         with self.get_connection() as conn:
             cursor = conn.cursor()
             
-            # Общая статистика
-            cursor.execute('SELECT COUNT(*) FROM coupons')
-            total_coupons = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(DISTINCT telegram_id) FROM coupons')
-            unique_users = cursor.fetchone()[0]
+            # Общая статистика из счетчиков (обновляются триггерами)
+            today_key = 'day:' + campaign_day(self.clock())
+            cursor.execute('''
+                SELECT name, value FROM stats_counters
+                WHERE name IN ('coupons', 'coupon_users', 'used', ?)
+            ''', (today_key,))
+            counters = {row['name']: row['value'] for row in cursor.fetchall()}
             
-            cursor.execute('SELECT COUNT(*) FROM coupons WHERE date(created_at) = date("now")')
-            today_coupons = cursor.fetchone()[0]
+            total_coupons = counters.get('coupons', 0)
+            unique_users = counters.get('coupon_users', 0)
+            used_coupons = counters.get('used', 0)
+            today_coupons = counters.get(today_key, 0)
             
-            # Распределение купонов
+            # Распределение купонов (диапазон по первичному ключу 'prize:...')
             cursor.execute('''
-                SELECT coupon, COUNT(*) as count 
-                FROM coupons 
-                GROUP BY coupon 
-                ORDER BY count DESC
+                SELECT substr(name, 7) AS coupon, value AS count
+                FROM stats_counters
+                WHERE name >= 'prize:' AND name < 'prize;' AND value > 0
+                ORDER BY value DESC
             ''')
             coupon_distribution = cursor.fetchall()
             
             # Последние 10 купонов
-            cursor.execute('''
-                SELECT c.*, u.first_name, u.last_name 
+            cursor.execute(f'''
+                SELECT {COUPON_COLUMNS}, u.first_name, u.last_name 
                 FROM coupons c
                 LEFT JOIN users u ON c.telegram_id = u.telegram_id
-                ORDER BY c.created_at DESC 
+                ORDER BY c.id DESC 
                 LIMIT 10
             ''')
-            recent_coupons = cursor.fetchall()
+            recent_coupons = Coupon.from_rows(cursor.fetchall())
             
             # Активные пользователи
             cursor.execute('''
@@ -294,94 +1018,249 @@ class Database:
                 'total_coupons': total_coupons,
                 'unique_users': unique_users,
                 'today_coupons': today_coupons,
+                'used_coupons': used_coupons,
                 'coupon_distribution': coupon_distribution,
                 'recent_coupons': recent_coupons,
                 'top_users': top_users
             }
     
-    def get_all_users(self):
-        """Получить список всех пользователей"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT u.*, COUNT(c.id) as total_coupons
-                FROM users u
-                LEFT JOIN coupons c ON u.telegram_id = c.telegram_id
-                GROUP BY u.telegram_id
-                ORDER BY u.joined_at DESC
-            ''')
-            return cursor.fetchall()
-    
-    def search_coupons(self, query):
-        """Поиск купонов по username или купону"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT c.*, u.first_name, u.last_name 
-                FROM coupons c
-                LEFT JOIN users u ON c.telegram_id = u.telegram_id
-                WHERE c.username LIKE ? OR c.coupon LIKE ? OR c.code_word LIKE ?
-                ORDER BY c.created_at DESC
-                LIMIT 50
-            ''', (f'%{query}%', f'%{query}%', f'%{query}%'))
-            return cursor.fetchall()
-    
-    def export_data(self):
-        """Экспорт данных для админа"""
+    def get_users_page(self, after=None, before=None, limit=10):
+        """Страница пользователей (новые сначала) одним запросом.
+        
+        Пагинация по ключу (joined_at, telegram_id): after - telegram_id последнего
+        пользователя предыдущей страницы, before - первого пользователя следующей.
+        Для каждого пользователя возвращается общее число купонов и до 3 активных.
+        """
+        if before is not None:
+            condition = '''WHERE (joined_at, telegram_id) >
+                (SELECT joined_at, telegram_id FROM users WHERE telegram_id = ?)'''
+            order = 'ASC'
+            params = (before,)
+        elif after is not None:
+            condition = '''WHERE (joined_at, telegram_id) <
+                (SELECT joined_at, telegram_id FROM users WHERE telegram_id = ?)'''
+            order = 'DESC'
+            params = (after,)
+        else:
+            condition = ''
+            order = 'DESC'
+            params = ()
+        
+        now = int(self.clock())
+        
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            cursor.execute(f'''
+                WITH page AS (
+                    SELECT * FROM users
+                    {condition}
+                    ORDER BY joined_at {order}, telegram_id {order}
+                    LIMIT ?
+                )
+                SELECT
+                    p.*,
+                    (SELECT COUNT(*) FROM coupons c
+                     WHERE c.telegram_id = p.telegram_id) AS total_coupons,
+                    (SELECT COUNT(*) FROM coupons c
+                     WHERE c.telegram_id = p.telegram_id
+                     AND c.used = 0 AND c.valid_until >= ?) AS active_count,
+                    (SELECT json_group_array(json_object(
+                        'coupon', a.coupon,
+                        'created_at', a.created_at,
+                        'valid_until', a.valid_until))
+                     FROM (SELECT coupon, created_at, valid_until FROM coupons c
+                           WHERE c.telegram_id = p.telegram_id
+                           AND c.used = 0 AND c.valid_until >= ?
+                           ORDER BY c.created_at DESC
+                           LIMIT 3) a) AS active_coupons,
+                    (SELECT value FROM stats_counters WHERE name = 'users') AS total_users
+                FROM page p
+                ORDER BY p.joined_at DESC, p.telegram_id DESC
+            ''', params + (limit, now, now))
+            rows = cursor.fetchall()
             
-            # Все купоны
-            cursor.execute('''
-                SELECT 
-                    c.created_at,
-                    u.first_name || ' ' || COALESCE(u.last_name, '') as user_name,
-                    c.username as instagram,
-                    c.coupon,
-                    c.code_word,
-                    c.valid_until,
-                    CASE WHEN c.used = 1 THEN 'Да' ELSE 'Нет' END as used
-                FROM coupons c
-                LEFT JOIN users u ON c.telegram_id = u.telegram_id
-                ORDER BY c.created_at DESC
-            ''')
+            if rows:
+                total_users = rows[0]['total_users']
+            else:
+                cursor.execute("SELECT value FROM stats_counters WHERE name = 'users'")
+                total_users = cursor.fetchone()[0]
             
-            coupons = cursor.fetchall()
+            users = []
+            for row in rows:
+                user = dict(row)
+                user['active_coupons'] = [
+                    Coupon(**coupon) for coupon in json.loads(row['active_coupons'])
+                ]
+                users.append(user)
             
-            # Все пользователи
-            cursor.execute('''
-                SELECT 
-                    telegram_id,
-                    username,
-                    first_name,
-                    last_name,
-                    joined_at,
-                    total_spins
-                FROM users
-                ORDER BY joined_at DESC
-            ''')
+            return {
+                'users': users,
+                'total_users': total_users
+            }
+    
+    def search_coupons(self, query, page=0, per_page=10):
+        """Поиск купонов по username, купону или кодовому слову.
+        
+        Возвращает страницу результатов (сначала самые релевантные) и признак
+        наличия следующей страницы.
+        """
+        query = query.strip()
+        offset = page * per_page
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
             
-            users = cursor.fetchall()
+            if len(query) >= 3:
+                # Trigram-индекс ищет подстроку; запрос передаем как фразу
+                phrase = '"' + query.replace('"', '""') + '"'
+                cursor.execute(f'''
+                    SELECT {COUPON_COLUMNS}, u.first_name, u.last_name 
+                    FROM coupons_fts f
+                    JOIN coupons c ON c.id = f.rowid
+                    LEFT JOIN users u ON c.telegram_id = u.telegram_id
+                    WHERE coupons_fts MATCH ?
+                    ORDER BY f.rank, c.id DESC
+                    LIMIT ? OFFSET ?
+                ''', (phrase, per_page + 1, offset))
+            else:
+                # Для 1-2 символов trigram-индекс не применим
+                cursor.execute(f'''
+                    SELECT {COUPON_COLUMNS}, u.first_name, u.last_name 
+                    FROM coupons c
+                    LEFT JOIN users u ON c.telegram_id = u.telegram_id
+                    WHERE c.username LIKE ? OR c.coupon LIKE ? OR c.code_word LIKE ?
+                    ORDER BY c.id DESC
+                    LIMIT ? OFFSET ?
+                ''', (f'%{query}%', f'%{query}%', f'%{query}%', per_page + 1, offset))
             
+            rows = Coupon.from_rows(cursor.fetchall())
             return {
-                'coupons': coupons,
-                'users': users
+                'coupons': rows[:per_page],
+                'has_next': len(rows) > per_page
             }
+    
+    def get_media_file_id(self, key, fingerprint):
+        """file_id ранее загруженного файла или None, если его нет или он устарел"""
+        if (key, fingerprint) in self.media_file_ids:
+            return self.media_file_ids[(key, fingerprint)]
+        
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT file_id FROM media_file_ids 
+                WHERE key = ? AND fingerprint = ?
+            ''', (key, fingerprint))
+            result = cursor.fetchone()
+        
+        file_id = result[0] if result else None
+        if file_id:
+            self.media_file_ids[(key, fingerprint)] = file_id
+        return file_id
+    
+    def save_media_file_id(self, key, fingerprint, file_id):
+        """Сохранить file_id загруженного файла"""
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO media_file_ids (key, fingerprint, file_id)
+                VALUES (?, ?, ?)
+            ''', (key, fingerprint, file_id))
+        self.media_file_ids[(key, fingerprint)] = file_id
+    
+    def delete_media_file_id(self, key, fingerprint, file_id):
+        """Удалить file_id, который Telegram больше не принимает"""
+        with self.get_connection() as conn:
+            conn.execute('''
+                DELETE FROM media_file_ids
+                WHERE key = ? AND fingerprint = ? AND file_id = ?
+            ''', (key, fingerprint, file_id))
+        if self.media_file_ids.get((key, fingerprint)) == file_id:
+            del self.media_file_ids[(key, fingerprint)]
+    
+    def clear_media_file_ids(self):
+        """Удалить все сохраненные file_id (после повторного рендера анимаций)"""
+        with self.get_connection() as conn:
+            conn.execute('DELETE FROM media_file_ids')
+        self.media_file_ids.clear()
+    
+    def _iter_rows(self, sql, chunk_size):
+        """Построчно отдает результат запроса, читая его порциями по chunk_size"""
+        cursor = self.get_connection().cursor()
+        try:
+            cursor.execute(sql)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+    
+    def iter_export_coupons(self, chunk_size=1000):
+        """Купоны для экспорта (новые сначала) без загрузки всей таблицы в память"""
+        rows = self._iter_rows('''
+            SELECT 
+                c.created_at,
+                u.first_name || ' ' || COALESCE(u.last_name, '') as user_name,
+                c.username as instagram,
+                c.coupon,
+                c.code_word,
+                c.valid_until,
+                CASE WHEN c.used = 1 THEN 'Да' ELSE 'Нет' END as used
+            FROM coupons c
+            LEFT JOIN users u ON c.telegram_id = u.telegram_id
+            ORDER BY c.id DESC
+        ''', chunk_size)
+        for created_at, user_name, instagram, coupon, code_word, valid_until, used in rows:
+            yield (
+                format_timestamp(created_at, EXPORT_TIME_FORMAT),
+                user_name, instagram, coupon, code_word,
+                format_timestamp(valid_until, EXPORT_TIME_FORMAT),
+                used
+            )
+    
+    def iter_export_users(self, chunk_size=1000):
+        """Пользователи для экспорта без загрузки всей таблицы в память"""
+        rows = self._iter_rows('''
+            SELECT 
+                telegram_id,
+                username,
+                first_name,
+                last_name,
+                joined_at,
+                total_spins
+            FROM users
+            ORDER BY joined_at DESC, telegram_id DESC
+        ''', chunk_size)
+        for telegram_id, username, first_name, last_name, joined_at, total_spins in rows:
+            yield (
+                telegram_id, username, first_name, last_name,
+                format_timestamp(joined_at, EXPORT_TIME_FORMAT),
+                total_spins
+            )
 
     def user_exists(self, telegram_id):
         """Проверяет, есть ли пользователь в базе"""
+        exists = self.registered_cache.get(telegram_id)
+        if exists is not MISSING:
+            return exists
+        
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT COUNT(*) FROM coupons 
-                WHERE telegram_id = ? 
-                LIMIT 1
+                SELECT EXISTS(SELECT 1 FROM coupons WHERE telegram_id = ?)
             ''', (telegram_id,))
             
-            return cursor.fetchone()[0] > 0
+            exists = bool(cursor.fetchone()[0])
+        
+        self.registered_cache.set(telegram_id, exists)
+        return exists
     
     def get_last_instagram(self, telegram_id):
         """Получить последний использованный Instagram пользователя"""
+        instagram = self.last_instagram_cache.get(telegram_id)
+        if instagram is not MISSING:
+            return instagram
+        
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -392,7 +1271,66 @@ class Database:
             ''', (telegram_id,))
             
             result = cursor.fetchone()
-            return result[0] if result else "не указан"
         
+        if not result:
+            return "не указан"
+        
+        self.last_instagram_cache.set(telegram_id, result[0])
+        return result[0]
+        
+class AsyncDatabase:
+    """Асинхронный фасад над Database.
+
+    Каждый метод Database доступен как корутина: вызов выполняется в
+    ограниченном пуле потоков и не блокирует event loop бота.
+    """
+
+    def __init__(self, database, max_workers=4):
+        self.database = database
+        # Число вызовов по именам методов (для бенчмарков и мониторинга)
+        self.calls = Counter()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='db'
+        )
+
+    def __getattr__(self, name):
+        attr = getattr(self.database, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        # Кэшируем обертку, чтобы не создавать ее на каждый вызов
+        setattr(self, name, method)
+        return method
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнить произвольную синхронную функцию в пуле БД.
+
+        Функция выполняется в копии текущего контекста, чтобы логи из потока БД
+        сохраняли update_id и telegram_id обрабатываемого обновления.
+        """
+        name = getattr(func, '__name__', 'run')
+        self.calls[name] += 1
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(
+                self.executor,
+                functools.partial(context.run, func, *args, **kwargs)
+            )
+        finally:
+            metrics.DB_SECONDS.labels(method=name).observe(time.perf_counter() - start)
+
+    def close(self):
+        """Дождаться завершения запросов, остановить пул и закрыть соединения"""
+        self.executor.shutdown(wait=True)
+        self.database.close()
+
 # Глобальный экземпляр базы данных
-db = Database()
\ No newline at end of file
+db = Database()
+adb = AsyncDatabase(db, max_workers=config.DB_EXECUTOR_WORKERS)
\ No newline at end of file
@@ -0,0 +1,66 @@
+import csv
+import gzip
+import io
+import tempfile
+import zipfile
+import config
+
+# Заголовки CSV для каждого вида экспорта
+HEADERS = {
+    'coupons': ['Дата создания', 'Пользователь', 'Instagram',
+                'Скидка', 'Кодовое слово', 'Действует по', 'Использован'],
+    'users': ['Telegram ID', 'Username', 'Имя', 'Фамилия',
+              'Дата регистрации', 'Всего спинов'],
+}
+
+
+def build_export(database, kind, compression=None):
+    """Потоково записывает экспорт в CSV-файл с постоянным расходом памяти.
+
+    Строки читаются из базы порциями и сразу пишутся модулем csv во временный
+    файл (в памяти до EXPORT_SPOOL_SIZE байт, дальше на диске), при необходимости
+    со сжатием gzip или zip. Функция блокирующая - вызывать из пула потоков БД.
+
+    Возвращает (файл, имя файла); файл открыт и перемотан в начало.
+    """
+    compression = compression or config.EXPORT_COMPRESSION
+    rows = getattr(database, f'iter_export_{kind}')(config.EXPORT_CHUNK_SIZE)
+    filename = f'{kind}_export.csv'
+
+    output = tempfile.SpooledTemporaryFile(max_size=config.EXPORT_SPOOL_SIZE)
+    archive = None
+
+    if compression == 'gzip':
+        stream = gzip.GzipFile(filename=filename, mode='wb', fileobj=output)
+        result_name = filename + '.gz'
+    elif compression == 'zip':
+        archive = zipfile.ZipFile(output, mode='w', compression=zipfile.ZIP_DEFLATED)
+        stream = archive.open(filename, mode='w', force_zip64=True)
+        result_name = f'{kind}_export.zip'
+    else:
+        stream = output
+        result_name = filename
+
+    try:
+        # utf-8-sig добавляет BOM для корректного отображения в Excel
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        writer = csv.writer(text, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(HEADERS[kind])
+        writer.writerows(
+            ['' if value is None else value for value in row]
+            for row in rows
+        )
+        text.flush()
+        # Отсоединяем обертку, чтобы она не закрыла временный файл
+        text.detach()
+
+        if stream is not output:
+            stream.close()
+        if archive is not None:
+            archive.close()
+    except Exception:
+        output.close()
+        raise
+
+    output.seek(0)
+    return output, result_name
@@ -0,0 +1,197 @@
+"""Поддельный Telegram Bot API для бенчмарков и воспроизведения трафика.
+
+FakeBotRequest подключается к Application вместо HTTP-клиента
+(build_application(request=...)): запросы не уходят в сеть, а отвечаются
+правдоподобными объектами, число вызовов считается по методам API.
+Обновления для getUpdates (long polling) добавляются add_update, файлы для
+скачивания - add_file. Функции message_update, callback_update и
+document_update собирают обновления в формате JSON, который присылает Telegram.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from http import HTTPStatus
+from telegram.request import BaseRequest
+
+BOT_USER = {
+    'id': 1000000001,
+    'is_bot': True,
+    'first_name': 'Benchmark',
+    'username': 'benchmark_bot'
+}
+
+# Методы, которые возвращают отправленное или измененное сообщение
+MESSAGE_METHODS = {
+    'sendMessage', 'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup',
+    'sendDocument', 'sendAnimation', 'sendPhoto'
+}
+
+
+class FakeBotRequest(BaseRequest):
+    """Bot API в памяти: считает вызовы и имитирует задержку сети"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self.updates = []
+        self.files = {}
+        self._update_added = asyncio.Event()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def reset(self):
+        self.calls.clear()
+
+    def add_update(self, data):
+        """Обновление, которое вернет следующий getUpdates"""
+        self.updates.append(data)
+        self._update_added.set()
+
+    def add_file(self, content):
+        """Файл для getFile и скачивания; возвращает file_id"""
+        file_id = f'fake-upload-{next(self._file_ids)}'
+        self.files[file_id] = bytes(content)
+        return file_id
+
+    @property
+    def total_calls(self):
+        """Число вызовов, не считая служебного getMe"""
+        return sum(count for method, count in self.calls.items() if method != 'getMe')
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        if endpoint in self.files:
+            # Скачивание файла по file_path из getFile
+            self.calls['download'] += 1
+            return HTTPStatus.OK, self.files[endpoint]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == 'getUpdates':
+            result = await self._get_updates(parameters)
+        else:
+            result = self._result(endpoint, parameters)
+        body = {'ok': True, 'result': result}
+        return HTTPStatus.OK, json.dumps(body).encode('utf-8')
+
+    async def _get_updates(self, parameters):
+        """Long polling: обновления начиная с offset, ожидание до timeout секунд"""
+        offset = parameters.get('offset') or 0
+        self.updates = [data for data in self.updates if data['update_id'] >= offset]
+        if not self.updates and parameters.get('timeout'):
+            self._update_added.clear()
+            try:
+                await asyncio.wait_for(self._update_added.wait(), parameters['timeout'])
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:parameters.get('limit') or 100]
+
+    def _result(self, endpoint, parameters):
+        if endpoint == 'getMe':
+            return BOT_USER
+        if endpoint == 'getFile':
+            file_id = parameters['file_id']
+            return {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_size': len(self.files.get(file_id, b'')),
+                'file_path': f'documents/{file_id}'
+            }
+        if endpoint not in MESSAGE_METHODS:
+            return True
+
+        chat_id = parameters.get('chat_id') or 0
+        message = {
+            'message_id': parameters.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if 'text' in parameters:
+            message['text'] = parameters['text']
+        if 'caption' in parameters:
+            message['caption'] = parameters['caption']
+
+        if endpoint in ('sendDocument', 'sendAnimation'):
+            file_id = f'fake-file-{next(self._file_ids)}'
+            message['document'] = {'file_id': file_id, 'file_unique_id': file_id}
+            if endpoint == 'sendAnimation':
+                message['animation'] = {
+                    'file_id': file_id, 'file_unique_id': file_id,
+                    'width': 320, 'height': 320, 'duration': 3
+                }
+        return message
+
+
+def _user(user_id, first_name='User'):
+    return {'id': user_id, 'is_bot': False, 'first_name': first_name}
+
+
+def message_update(update_id, user_id, text, first_name='User'):
+    """Обновление с текстовым сообщением (команда, если начинается с /)"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id, first_name),
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{
+            'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])
+        }]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id, user_id, data, first_name='User'):
+    """Обновление с нажатием inline-кнопки под сообщением бота"""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': _user(user_id, first_name),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': '...'
+            }
+        }
+    }
+
+
+def document_update(update_id, user_id, file_id, file_name, file_size):
+    """Обновление с файлом, загруженным пользователем (file_id из FakeBotRequest.add_file)"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': _user(user_id),
+            'document': {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_name': file_name,
+                'file_size': file_size
+            }
+        }
+    }
@@ -0,0 +1,221 @@
+"""Неблокирующее логирование с ротацией.
+
+Хендлеры и event loop только кладут запись в очередь (QueueHandler), а пишет
+в файл отдельный поток QueueListener, поэтому медленный диск не задерживает
+обработку обновлений. Если очередь переполнена, запись отбрасывается
+(счетчик dropped_records, метрика wheel_log_dropped_total), а не ждет места.
+
+Настройки (config.py): LOG_FILE, LOG_LEVEL, LOG_FORMAT (text или json),
+ротация по размеру LOG_MAX_BYTES или, при LOG_MAX_BYTES=0, по времени
+LOG_ROTATE_WHEN, LOG_BACKUP_COUNT архивов, размер очереди LOG_QUEUE_SIZE и
+прореживание шумных логгеров LOG_SAMPLING (например, httpx=0.01 - писать 1%
+записей httpx ниже WARNING).
+
+К каждой записи добавляются update_id, telegram_id и имя хендлера, если запись
+сделана во время обработки обновления (контекст задают bind_update и
+metrics.timed_handler через contextvars).
+
+При шардировании процессы-шарды передают записи в очередь фронтового
+процесса (setup_logging(queue, listen=False)), и в файл пишет один процесс.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from datetime import datetime
+import config
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s -%(context)s %(message)s'
+
+# Контекст обрабатываемого обновления
+update_id_var = contextvars.ContextVar('update_id', default=None)
+telegram_id_var = contextvars.ContextVar('telegram_id', default=None)
+handler_var = contextvars.ContextVar('handler', default=None)
+
+_queue_handler = None
+_listener = None
+_exception_formatter = logging.Formatter()
+
+
+def parse_sampling(spec):
+    """'httpx=0.01,telegram.ext=0.1' -> {'httpx': 0.01, 'telegram.ext': 0.1}"""
+    rates = {}
+    for item in spec.split(','):
+        if '=' in item:
+            name, rate = item.split('=', 1)
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи контекст обновления (в потоке, где запись сделана)"""
+
+    def filter(self, record):
+        record.update_id = update_id_var.get()
+        record.telegram_id = telegram_id_var.get()
+        record.handler = handler_var.get()
+        parts = [
+            f"{name}={value}"
+            for name, value in (('update', record.update_id),
+                                ('user', record.telegram_id),
+                                ('handler', record.handler))
+            if value is not None
+        ]
+        record.context = f" [{' '.join(parts)}]" if parts else ''
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю rate записей шумных логгеров; WARNING и выше - всегда"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return random.random() < rate
+            name = name.rpartition('.')[0]
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не ждет места в очереди, а отбрасывает запись"""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Копия записи без несериализуемых полей; traceback - отдельно в exc_text"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in ('update_id', 'telegram_id', 'handler'):
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний формат bot_debug.log с контекстом обновления перед сообщением"""
+
+    def format(self, record):
+        if not hasattr(record, 'context'):
+            record.context = ''
+        return super().format(record)
+
+
+def create_file_handler():
+    """Файловый хендлер с ротацией по размеру или по времени"""
+    if config.LOG_MAX_BYTES > 0:
+        handler = logging.handlers.RotatingFileHandler(
+            config.LOG_FILE, maxBytes=config.LOG_MAX_BYTES,
+            backupCount=config.LOG_BACKUP_COUNT, encoding='utf-8', delay=True
+        )
+    else:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            config.LOG_FILE, when=config.LOG_ROTATE_WHEN,
+            backupCount=config.LOG_BACKUP_COUNT, encoding='utf-8', delay=True
+        )
+    if config.LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter(TEXT_FORMAT))
+    return handler
+
+
+def setup_logging(log_queue=None, listen=True):
+    """Настраивает корневой логгер; повторный вызов ничего не делает.
+
+    log_queue - своя очередь (например, multiprocessing.Queue для шардов),
+    listen=False - только отправлять записи в очередь, файл пишет другой процесс.
+    Возвращает очередь записей.
+    """
+    global _queue_handler, _listener
+    if _queue_handler is not None:
+        return _queue_handler.queue
+
+    if log_queue is None:
+        log_queue = queue.Queue(config.LOG_QUEUE_SIZE)
+
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(SamplingFilter(parse_sampling(config.LOG_SAMPLING)))
+    _queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(config.LOG_LEVEL.upper())
+    root.addHandler(_queue_handler)
+
+    if listen:
+        _listener = logging.handlers.QueueListener(
+            log_queue, create_file_handler(), respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(stop_logging)
+    return log_queue
+
+
+def stop_logging():
+    """Дописывает оставшиеся записи и останавливает поток записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def dropped_records():
+    """Сколько записей отброшено из-за переполненной очереди"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def bind_update(update):
+    """Задает контекст логирования для обработки обновления; возвращает токены для reset_update"""
+    user = getattr(update, 'effective_user', None)
+    return (
+        update_id_var.set(getattr(update, 'update_id', None)),
+        telegram_id_var.set(user.id if user else None),
+    )
+
+
+def reset_update(tokens):
+    update_id_var.reset(tokens[0])
+    telegram_id_var.reset(tokens[1])
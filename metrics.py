@@ -0,0 +1,157 @@
+"""Метрики бота для Prometheus (prometheus_client).
+
+Счетчики, гистограммы и gauge - объекты prometheus_client: обновляются на
+горячем пути за одну операцию под блокировкой значения, потокобезопасно и
+для пула потоков БД. Дочернее значение с метками можно получить заранее
+(HISTOGRAM.labels(...)), чтобы не разбирать метки на каждый вызов. Значения,
+которые уже считают другие компоненты (попадания в кэши, RetryAfter, очередь
+исходящих), собирает CallbackCollector только в момент запроса /metrics.
+
+Эндпоинт: start_http_server(METRICS_PORT, METRICS_LISTEN) - поток
+prometheus_client, отвечает на GET /metrics.
+"""
+import functools
+import logging
+import time
+import weakref
+import prometheus_client
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+import logging_setup
+
+logger = logging.getLogger(__name__)
+
+# Серии *_created удваивают вывод счетчиков и не нужны для rate()
+prometheus_client.disable_created_metrics()
+
+# Границы корзин гистограмм задержек (секунды)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CallbackCollector:
+    """Метрика, значения которой вычисляет функция в момент запроса /metrics.
+
+    func возвращает пары (метки, значение); type - counter или gauge.
+    """
+
+    def __init__(self, name, documentation, type, func, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.family = CounterMetricFamily if type == 'counter' else GaugeMetricFamily
+        self.func = func
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def collect(self):
+        family = self.family(self.name, self.documentation, labels=self.labelnames)
+        try:
+            for labels, value in self.func():
+                family.add_metric([str(labels[name]) for name in self.labelnames], value)
+        except Exception as e:
+            logger.error(f"Не удалось собрать метрику {self.name}: {e}")
+            return
+        yield family
+
+
+# Отслеживаемые объекты для метрик, вычисляемых при запросе
+_caches = weakref.WeakSet()
+_rate_limiters = weakref.WeakSet()
+
+
+def track_cache(cache):
+    """Учитывать попадания, промахи и размер кэша (TTLCache)"""
+    _caches.add(cache)
+
+
+def track_rate_limiter(rate_limiter):
+    """Учитывать RetryAfter, пропуски и очередь планировщика исходящих запросов"""
+    _rate_limiters.add(rate_limiter)
+
+
+def _cache_stats(field):
+    def collect():
+        for cache in list(_caches):
+            yield {'cache': cache.name}, cache.stats()[field]
+    return collect
+
+
+def _rate_limiter_sum(attribute):
+    def collect():
+        yield {}, sum(getattr(limiter, attribute) for limiter in list(_rate_limiters))
+    return collect
+
+
+# Обновления и хендлеры
+UPDATES = Counter('wheel_updates_total', 'Обработанные обновления Telegram')
+UPDATES_IN_FLIGHT = Gauge('wheel_updates_in_flight', 'Обновления в обработке (включая ожидание очереди пользователя)')
+HANDLER_SECONDS = Histogram('wheel_handler_duration_seconds', 'Время работы хендлера', ['handler'],
+                            buckets=DEFAULT_BUCKETS)
+HANDLER_ERRORS = Counter('wheel_handler_errors_total', 'Исключения в хендлерах', ['handler'])
+
+# База данных
+DB_SECONDS = Histogram('wheel_db_duration_seconds', 'Время вызова метода базы, включая ожидание пула', ['method'],
+                       buckets=DEFAULT_BUCKETS)
+SPINS = Counter('wheel_spins_total', 'Выданные купоны по призам', ['prize'])
+REDEMPTIONS = Counter('wheel_redemptions_total', 'Купоны, отмеченные использованными')
+CACHE_HITS = CallbackCollector('wheel_cache_hits_total', 'Попадания в кэши базы', 'counter',
+                               _cache_stats('hits'), ['cache'])
+CACHE_MISSES = CallbackCollector('wheel_cache_misses_total', 'Промахи кэшей базы', 'counter',
+                                 _cache_stats('misses'), ['cache'])
+CACHE_SIZE = CallbackCollector('wheel_cache_entries', 'Записей в кэшах базы', 'gauge',
+                               _cache_stats('size'), ['cache'])
+
+# Запросы к Telegram
+TELEGRAM_REQUESTS = Counter('wheel_telegram_requests_total', 'Запросы к Bot API по методам', ['method'])
+TELEGRAM_SECONDS = Histogram('wheel_telegram_request_duration_seconds', 'Время запроса к Bot API', ['method'],
+                             buckets=DEFAULT_BUCKETS)
+TELEGRAM_RETRY_AFTER = CallbackCollector(
+    'wheel_telegram_retry_after_total', 'Ответы RetryAfter (429) от Bot API', 'counter',
+    _rate_limiter_sum('retry_after_count')
+)
+TELEGRAM_DROPPED = CallbackCollector(
+    'wheel_telegram_dropped_total', 'Пропущенные кадры анимации', 'counter',
+    _rate_limiter_sum('dropped_count')
+)
+TELEGRAM_PENDING = CallbackCollector(
+    'wheel_telegram_pending', 'Исходящие запросы, ожидающие отправки', 'gauge',
+    _rate_limiter_sum('pending')
+)
+
+# Логирование
+LOG_DROPPED = CallbackCollector(
+    'wheel_log_dropped_total', 'Записи лога, отброшенные из-за переполненной очереди', 'counter',
+    lambda: [({}, logging_setup.dropped_records())]
+)
+
+
+def timed_handler(func):
+    """Декоратор хендлера: время работы и исключения с меткой по имени функции.
+
+    Имя хендлера также попадает в контекст записей лога (logging_setup).
+    """
+    name = func.__name__
+    observe = HANDLER_SECONDS.labels(handler=name).observe
+    errors = HANDLER_ERRORS.labels(handler=name)
+    handler_var = logging_setup.handler_var
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = handler_var.set(name)
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            observe(time.perf_counter() - start)
+            handler_var.reset(token)
+
+    return wrapper
+
+
+def start_http_server(port, listen='127.0.0.1'):
+    """Запускает эндпоинт /metrics в фоновом потоке; возвращает сервер"""
+    server, _ = prometheus_client.start_http_server(port, addr=listen)
+    logger.info(f"Метрики доступны на http://{listen}:{port}/metrics")
+    return server
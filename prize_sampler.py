@@ -0,0 +1,135 @@
+import hashlib
+import json
+import math
+import random
+from collections import Counter
+import config
+
+
+def config_fingerprint(coupon_config):
+    """Отпечаток конфигурации призов: меняется при любом изменении шансов или кодовых слов"""
+    data = json.dumps(coupon_config, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class PrizeSampler:
+    """Выбор приза по весам chance из COUPON_CONFIG за O(1) методом алиасов (Vose).
+
+    Таблица строится один раз из конфигурации. Без явной coupon_config
+    сэмплер следует за config.COUPON_CONFIG: если словарь заменили (например,
+    при перезагрузке модуля config), таблица перестраивается при следующем
+    выборе. После изменения словаря на месте вызовите reload(). Источник
+    случайности можно подменить, например на secrets.SystemRandom() или
+    random.Random(seed) для воспроизводимости.
+    """
+
+    def __init__(self, coupon_config=None, rng=None):
+        self.follow_config = coupon_config is None
+        self.coupon_config = config.COUPON_CONFIG if self.follow_config else coupon_config
+        self.rng = rng or random.Random()
+        self.fingerprint = None
+        self.build()
+
+    def build(self):
+        """Строит таблицы вероятностей и алиасов"""
+        prizes = []
+        weights = []
+        for coupon, data in self.coupon_config.items():
+            if data['chance'] < 0:
+                raise ValueError(f"Отрицательный шанс для купона {coupon}")
+            prizes.append({
+                'coupon': coupon,
+                'code_word': data['code_word'],
+                'emoji': data['emoji']
+            })
+            weights.append(data['chance'])
+
+        total = sum(weights)
+        if not prizes or total <= 0:
+            raise ValueError("В COUPON_CONFIG нет призов с положительным шансом")
+
+        count = len(prizes)
+        scaled = [weight * count / total for weight in weights]
+        prob = [0.0] * count
+        alias = list(range(count))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+
+        # Остатки равны 1 с точностью до погрешности округления
+        for i in large + small:
+            prob[i] = 1.0
+
+        self.prizes = prizes
+        self.weights = weights
+        self.prob = prob
+        self.alias = alias
+        self.fingerprint = config_fingerprint(self.coupon_config)
+
+    def ensure_current(self):
+        """Перестраивает таблицу, если config.COUPON_CONFIG заменили другим словарем.
+
+        Вызывается на каждый спин, поэтому только сравнивает ссылки: O(1).
+        """
+        if self.follow_config and config.COUPON_CONFIG is not self.coupon_config:
+            self.reload(config.COUPON_CONFIG)
+
+    def reload(self, coupon_config=None):
+        """Перестраивает таблицу после изменения конфигурации призов"""
+        if coupon_config is not None:
+            self.coupon_config = coupon_config
+        self.build()
+
+    def draw_index(self):
+        """Индекс приза: одно случайное число на выбор"""
+        u = self.rng.random() * len(self.prob)
+        i = int(u)
+        return i if u - i < self.prob[i] else self.alias[i]
+
+    def draw(self):
+        """Один приз: словарь с coupon, code_word и emoji"""
+        return dict(self.prizes[self.draw_index()])
+
+    def sample(self, n):
+        """Список из n призов"""
+        prizes = self.prizes
+        draw_index = self.draw_index
+        return [dict(prizes[draw_index()]) for _ in range(n)]
+
+
+def chi_square_p_value(chi_square, df):
+    """p-значение критерия хи-квадрат (вероятность получить не меньшее значение),
+    приближение Уилсона-Хилферти"""
+    if df <= 0:
+        return 1.0
+    z = ((chi_square / df) ** (1 / 3) - (1 - 2 / (9 * df))) / math.sqrt(2 / (9 * df))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def check_distribution(sampler, draws):
+    """Сравнивает наблюдаемое распределение с весами chance критерием хи-квадрат.
+
+    Возвращает (хи-квадрат, p-значение, строки (купон, ожидаемая доля, наблюдаемая доля)).
+    """
+    counts = Counter(sampler.draw_index() for _ in range(draws))
+    total = sum(sampler.weights)
+    chi_square = 0.0
+    rows = []
+    for i, prize in enumerate(sampler.prizes):
+        expected = draws * sampler.weights[i] / total
+        observed = counts.get(i, 0)
+        if expected > 0:
+            chi_square += (observed - expected) ** 2 / expected
+        rows.append((prize['coupon'], expected / draws, observed / draws))
+    p_value = chi_square_p_value(chi_square, len(sampler.prizes) - 1)
+    return chi_square, p_value, rows
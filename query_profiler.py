@@ -0,0 +1,475 @@
+"""Профилирование SQL-запросов и проверка планов запросов.
+
+Профилирование включается DB_PROFILE=1: пул создает соединения класса
+ProfilingConnection, и каждый запрос (execute/executemany вместе с чтением
+результата) замеряется: время, число шагов виртуальной машины SQLite (через
+progress handler, приближенная оценка просмотренных строк), возвращенные строки
+и метод Database, из которого запрос выполнен. Запросы дольше DB_SLOW_QUERY_MS
+пишутся в DB_SLOW_QUERY_LOG, сводка по запросам - туда же при закрытии базы.
+Без DB_PROFILE соединения обычные, и профилирование ничего не стоит.
+
+Проверка планов (для тестов и CI):
+
+    python query_profiler.py --check-plans
+
+На временной базе с тестовыми данными выполняет EXPLAIN QUERY PLAN для всех
+запросов из database.py - найденных в исходном коде и выполненных прогоном
+методов Database - и завершается с кодом 1, если запрос горячего пути
+(проверка спина за день, активные купоны, погашение, последний Instagram)
+просматривает таблицу целиком.
+"""
+import argparse
+import ast
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Progress handler вызывается раз в столько инструкций виртуальной машины
+PROGRESS_STEPS = 100
+
+# Методы Database на пути каждого пользователя: здесь полный просмотр таблицы недопустим
+HOT_PATH_METHODS = (
+    'has_user_played_today',
+    'reserve_spin',
+    'get_active_coupons',
+    'get_user_summary',
+    'get_user_stats',
+    'mark_coupon_used_by_instagram',
+    'get_last_instagram',
+    'user_exists',
+)
+
+# Служебные методы, запросы которых не проверяются (схема, миграции)
+SKIPPED_METHODS = ('init_db', 'migrate')
+
+SQL_START = re.compile(r'^\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+SQL_KEYWORDS = {
+    'where', 'join', 'left', 'inner', 'cross', 'on', 'order', 'group', 'limit',
+    'set', 'values', 'using', 'natural', 'union', 'having', 'select', 'as',
+}
+
+
+def normalize_sql(sql):
+    """Запрос в одну строку с одиночными пробелами"""
+    return ' '.join(sql.split())
+
+
+class StatementStats:
+    """Накопленная статистика одного запроса одного метода"""
+
+    __slots__ = ('count', 'total', 'max', 'steps', 'rows', 'parameters')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.steps = 0
+        self.rows = 0
+        self.parameters = None
+
+
+class QueryProfiler:
+    """Сбор статистики запросов и журнал медленных запросов"""
+
+    def __init__(self, slow_ms=50.0, slow_log_path=None):
+        self.slow_ms = slow_ms
+        self.stats = {}
+        self._lock = threading.Lock()
+        self.slow_log = logging.getLogger('slow_queries')
+        if slow_log_path:
+            handler = logging.FileHandler(slow_log_path, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.slow_log.addHandler(handler)
+            self.slow_log.setLevel(logging.INFO)
+            self.slow_log.propagate = False
+
+    def record(self, method, sql, parameters, elapsed, steps, rows):
+        key = (method, normalize_sql(sql))
+        with self._lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = StatementStats()
+            stats.count += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            stats.steps += steps
+            stats.rows += rows
+            stats.parameters = parameters
+
+        if elapsed * 1000 >= self.slow_ms:
+            self.slow_log.warning(
+                f"{elapsed * 1000:.1f} мс {method} шагов~{steps} строк={rows} | "
+                f"{key[1]} | {parameters!r:.200}"
+            )
+
+    def report(self, limit=None):
+        """Запросы по убыванию суммарного времени"""
+        with self._lock:
+            items = sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)
+        return [
+            {
+                'method': method,
+                'sql': sql,
+                'count': stats.count,
+                'total_ms': round(stats.total * 1000, 3),
+                'avg_ms': round(stats.total * 1000 / stats.count, 3),
+                'max_ms': round(stats.max * 1000, 3),
+                'steps': stats.steps,
+                'rows': stats.rows,
+            }
+            for (method, sql), stats in items[:limit]
+        ]
+
+    def log_report(self, limit=20):
+        """Пишет сводку самых дорогих запросов в журнал медленных запросов"""
+        for item in self.report(limit):
+            self.slow_log.info(
+                f"итого {item['total_ms']} мс, {item['count']} раз, "
+                f"в среднем {item['avg_ms']} мс, максимум {item['max_ms']} мс, "
+                f"шагов~{item['steps']}, строк {item['rows']}: {item['method']} | {item['sql']}"
+            )
+
+
+def calling_method():
+    """Имя метода, выполнившего запрос: первый публичный метод в цепочке вызовов
+    за пределами этого модуля (вспомогательные _методы того же файла пропускаются)"""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    code = frame.f_code
+    while code.co_name.startswith('_') and frame.f_back is not None \
+            and frame.f_back.f_code.co_filename == code.co_filename:
+        frame = frame.f_back
+        code = frame.f_code
+    return code.co_name
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """Соединение, курсоры которого замеряют запросы (factory для sqlite3.connect)"""
+
+    def attach(self, profiler):
+        self.profiler = profiler
+        self.progress_ticks = 0
+        self.set_progress_handler(self._progress, PROGRESS_STEPS)
+
+    def _progress(self):
+        self.progress_ticks += 1
+        return 0
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or ProfilingCursor)
+
+    # Встроенные execute соединения вызывают execute курсора в обход Python
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """Курсор, который учитывает время выполнения и чтения результата запроса"""
+
+    _statement = None
+
+    def _begin(self, sql, parameters):
+        self._finish()
+        self._statement = [calling_method(), sql, parameters, 0.0, self.connection.progress_ticks, 0]
+
+    def _account(self, start, rows=0):
+        statement = self._statement
+        if statement is not None:
+            statement[3] += time.perf_counter() - start
+            statement[5] += rows
+
+    def _finish(self):
+        statement = self._statement
+        if statement is not None:
+            self._statement = None
+            method, sql, parameters, elapsed, ticks, rows = statement
+            steps = (self.connection.progress_ticks - ticks) * PROGRESS_STEPS
+            self.connection.profiler.record(method, sql, parameters, elapsed, steps, rows)
+
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._account(start)
+            if self.description is None:
+                # Запрос без результата (INSERT, UPDATE...) завершен
+                self._statement[5] = max(self.rowcount, 0)
+                self._finish()
+
+    def executemany(self, sql, seq_of_parameters):
+        self._begin(sql, None)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._account(start)
+            self._statement[5] = max(self.rowcount, 0)
+            self._finish()
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._account(start, 0 if row is None else 1)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._account(start, len(rows))
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._account(start, len(rows))
+        self._finish()
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+# Проверка планов запросов
+
+def static_queries(path, namespace):
+    """Запросы из исходного кода: [(метод, sql)].
+
+    f-строки подставляются, если все их выражения - имена из namespace
+    (например, COUPON_COLUMNS); остальные проверяются только прогоном.
+    """
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+
+    queries = []
+    for function in ast.walk(tree):
+        if not isinstance(function, ast.FunctionDef):
+            continue
+        # Части f-строк проверяются только в составе всей строки
+        fragments = {
+            id(value)
+            for node in ast.walk(function) if isinstance(node, ast.JoinedStr)
+            for value in node.values
+        }
+        for node in ast.walk(function):
+            sql = None
+            if id(node) in fragments:
+                continue
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                sql = node.value
+            elif isinstance(node, ast.JoinedStr):
+                parts = []
+                for value in node.values:
+                    if isinstance(value, ast.Constant):
+                        parts.append(value.value)
+                    elif isinstance(value.value, ast.Name) and value.value.id in namespace:
+                        parts.append(str(namespace[value.value.id]))
+                    else:
+                        parts = None
+                        break
+                sql = ''.join(parts) if parts is not None else None
+            if sql and SQL_START.match(sql):
+                queries.append((function.name, sql))
+    return queries
+
+
+def count_placeholders(sql):
+    """Число параметров ? вне строковых литералов"""
+    return re.sub(r"'[^']*'", '', sql).count('?')
+
+
+def full_scans(conn, sql, parameters=None):
+    """Таблицы, которые план запроса просматривает целиком"""
+    if parameters is None:
+        parameters = [None] * count_placeholders(sql)
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    aliases = {}
+    for table, alias in TABLE_REFERENCE.findall(sql):
+        if table in tables:
+            aliases[table] = table
+            if alias and alias.lower() not in SQL_KEYWORDS:
+                aliases[alias] = table
+
+    plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+    scans = []
+    for detail in plan:
+        match = re.match(r'SCAN (\w+)', detail)
+        if match and 'VIRTUAL TABLE' not in detail and match.group(1) in aliases:
+            scans.append(aliases[match.group(1)])
+    return scans, plan
+
+
+def seed_data(path, users=2000, coupons_per_user=3):
+    """Тестовые данные, похожие на боевые, и статистика планировщика (ANALYZE)"""
+    import database
+
+    now = int(time.time())
+    day = 24 * 60 * 60
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            'INSERT INTO users (telegram_id, username, first_name, joined_at, total_spins) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(1000 + i, f'user{i}', f'Имя {i}', now - i * 60, coupons_per_user) for i in range(users)]
+        )
+        conn.executemany(
+            'INSERT INTO coupons (telegram_id, username, instagram, coupon, code_word, '
+            'created_at, valid_until, used, spin_day) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (1000 + i, f'insta_{i}', database.normalize_instagram(f'insta_{i}'),
+                 coupon, code_word, now - (k + 1) * day, now + (2 - k) * day, k % 2,
+                 database.campaign_day(now - (k + 1) * day))
+                for i in range(users)
+                for k, (coupon, code_word) in zip(
+                    range(coupons_per_user),
+                    [(name, data['code_word']) for name, data in database.config.COUPON_CONFIG.items()] * coupons_per_user
+                )
+            ]
+        )
+    # Боевая база получает статистику через PRAGMA optimize при закрытии
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def run_workload(db):
+    """Вызывает методы Database, чтобы профайлер увидел их запросы с параметрами"""
+    def fresh():
+        for cache in (db.user_summary_cache, db.registered_cache,
+                      db.last_instagram_cache, db.spun_today_cache):
+            cache.clear()
+
+    user = 1000
+    calls = [
+        lambda: db.user_exists(user),
+        lambda: db.has_user_played_today(user),
+        lambda: db.get_last_instagram(user),
+        lambda: db.get_active_coupons(user),
+        lambda: db.get_user_stats(user),
+        lambda: db.get_user_summary(user),
+        lambda: db.reserve_spin(user),
+        lambda: db.reserve_spin(user),
+        lambda: db.reserve_spin(999_999, 'new_user'),
+        lambda: db.mark_coupon_used_by_instagram('insta_1', '5%'),
+        lambda: db.mark_coupon_used_by_instagram('insta_1', '99%'),
+        lambda: db.mark_coupon_used_by_instagram('nobody', '5%'),
+        lambda: db.mark_coupons_used_bulk([(1, 'insta_2', '5%'), (2, 'insta_2', '5%'), (3, 'nobody', '5%')]),
+        lambda: db.get_admin_stats(),
+        lambda: db.get_users_page(),
+        lambda: db.get_users_page(after=1500),
+        lambda: db.get_users_page(before=1500),
+        lambda: db.search_coupons('insta_12'),
+        lambda: db.search_coupons('12'),
+        lambda: db.save_media_file_id('wheel_5%', 'fingerprint', 'file'),
+        lambda: db.get_media_file_id('wheel_10%', 'fingerprint'),
+        lambda: list(db.iter_export_coupons(500)),
+        lambda: list(db.iter_export_users(500)),
+    ]
+    for call in calls:
+        fresh()
+        call()
+
+
+def check_plans(users=2000):
+    """Проверка планов всех запросов database.py; возвращает код выхода"""
+    workdir = tempfile.mkdtemp(prefix='wheel-plans-')
+    os.environ['DB_PATH'] = os.path.join(workdir, 'plans.db')
+    os.environ['DB_PROFILE'] = '1'
+    os.environ['DB_SLOW_QUERY_LOG'] = ''
+    try:
+        import database
+
+        db = database.db
+        seed_data(db.db_path, users)
+        run_workload(db)
+
+        queries = {}
+        for method, sql in static_queries(database.__file__, vars(database)):
+            queries.setdefault((method, normalize_sql(sql)), None)
+        for (method, sql), stats in db.profiler.stats.items():
+            if SQL_START.match(sql):
+                queries[(method, sql)] = stats.parameters
+
+        conn = sqlite3.connect(db.db_path)
+        # Временные таблицы существуют только в своем соединении
+        conn.execute(database.BULK_REDEEM_TABLE)
+        failures = 0
+        for (method, sql), parameters in sorted(queries.items()):
+            if method in SKIPPED_METHODS or method.startswith('_migration'):
+                continue
+            hot = method in HOT_PATH_METHODS
+            try:
+                scans, plan = full_scans(conn, sql, parameters)
+            except sqlite3.Error as e:
+                # План горячего запроса нельзя проверить - считаем это ошибкой
+                if hot:
+                    failures += 1
+                print(f"{'❌' if hot else '? '} {method}: не удалось получить план ({e}): {sql[:100]}")
+                continue
+            if scans and hot:
+                failures += 1
+                mark = '❌'
+            elif scans:
+                mark = '⚠️ '
+            else:
+                mark = '✅'
+            print(f"{mark} {method}: {'; '.join(plan) or 'без чтения таблиц'}")
+            if scans:
+                print(f"     полный просмотр {', '.join(sorted(set(scans)))}: {sql[:160]}")
+        conn.close()
+        db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        print(f"\nЗапросов горячего пути с полным просмотром таблицы или без плана: {failures}")
+        return 1
+    print("\nЗапросы горячего пути используют индексы")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Проверка планов SQL-запросов database.py')
+    parser.add_argument('--check-plans', action='store_true', help='проверить планы запросов')
+    parser.add_argument('--users', type=int, default=2000, help='пользователей в тестовой базе')
+    args = parser.parse_args(argv)
+    if not args.check_plans:
+        parser.print_help()
+        return 2
+    return check_plans(args.users)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
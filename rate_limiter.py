@@ -0,0 +1,278 @@
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import logging
+import time
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета исходящих запросов (меньше - важнее).
+# Передаются в методы бота через rate_limit_args
+PRIORITY_RESULT = 0      # результат спина, купон
+PRIORITY_MENU = 1        # меню, ответы на команды (по умолчанию)
+PRIORITY_ANIMATION = 2   # кадры анимации колеса, можно пропустить
+
+
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду со всплеском до capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Сколько секунд ждать до появления токена"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Request:
+    """Запрос в очереди ожидания разрешения на отправку"""
+
+    __slots__ = ('priority', 'chat_id', 'coalesce_key', 'created', 'future')
+
+    def __init__(self, priority, chat_id, coalesce_key, future):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.coalesce_key = coalesce_key
+        self.created = time.monotonic()
+        self.future = future
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Планировщик исходящих запросов к Telegram Bot API.
+
+    - общее ведро токенов (около 30 сообщений в секунду) и ведро на каждый чат;
+    - запросы ждут в очереди по приоритету: результат спина > меню > кадры анимации;
+    - кадры анимации одного сообщения схлопываются (отправляется только последний),
+      а при перегрузке пропускаются;
+    - при RetryAfter отправка в чат (или вся, если чат неизвестен) приостанавливается
+      на retry_after, после чего запрос повторяется.
+
+    Приоритет передается через rate_limit_args, например
+    ``bot.edit_message_text(..., rate_limit_args=PRIORITY_ANIMATION)``.
+    """
+
+    def __init__(self, overall_rate=30, chat_rate=1, chat_burst=3,
+                 max_retries=3, animation_max_wait=1.0):
+        self.overall_rate = overall_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.animation_max_wait = animation_max_wait
+        self.retry_after_count = 0
+        self.dropped_count = 0
+        self._overall = TokenBucket(overall_rate, overall_rate)
+        self._chats = {}
+        self._paused_until = {}
+        # Очередь запросов: куча (приоритет, номер, запрос). Пропущенные запросы
+        # не удаляются из кучи, а отбрасываются, когда доходят до ее вершины
+        self._queue = []
+        # Запросы в чаты, которые пока не готовы: куча (когда готов, приоритет, номер, запрос)
+        self._blocked = []
+        # Кадры анимации в порядке создания - для пропуска устаревших
+        self._animations = collections.deque()
+        self._coalesce = {}
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        metrics.track_rate_limiter(self)
+
+    @property
+    def pending(self):
+        """Количество запросов, ожидающих отправки"""
+        return sum(1 for item in self._queue + self._blocked if not item[-1].future.done())
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._dispatcher
+            self._dispatcher = None
+        for item in self._queue + self._blocked:
+            if not item[-1].future.done():
+                item[-1].future.cancel()
+        self._queue.clear()
+        self._blocked.clear()
+        self._animations.clear()
+        self._coalesce.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _chat_delay(self, chat_id, now):
+        """Сколько ждать до возможности отправить в чат (с учетом паузы после 429)"""
+        paused = max(self._paused_until.get(chat_id, 0), self._paused_until.get(None, 0)) - now
+        if chat_id is None:
+            return max(paused, 0.0)
+        return max(paused, self._chat_bucket(chat_id).delay(now))
+
+    def _drop(self, request):
+        """Пропустить запрос: вызывающий получит True без обращения к API"""
+        if not request.future.done():
+            request.future.set_result(False)
+            self.dropped_count += 1
+        if self._coalesce.get(request.coalesce_key) is request:
+            del self._coalesce[request.coalesce_key]
+
+    def _prune(self, now):
+        """Удаляет ведра простаивающих чатов и истекшие паузы"""
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items()
+                        if bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity]:
+            del self._chats[chat_id]
+        for chat_id in [chat_id for chat_id, until in self._paused_until.items() if until <= now]:
+            del self._paused_until[chat_id]
+
+    def _expire_animations(self, now):
+        """Пропускает кадры анимации, ждущие дольше animation_max_wait.
+
+        Возвращает, через сколько секунд устареет следующий кадр (None - кадров нет).
+        """
+        animations = self._animations
+        while animations:
+            request = animations[0]
+            if request.future.done():
+                animations.popleft()
+                continue
+            expires_in = request.created + self.animation_max_wait - now
+            if expires_in > 0:
+                return expires_in
+            animations.popleft()
+            self._drop(request)
+        return None
+
+    async def _dispatch(self):
+        """Выдает разрешения на отправку по приоритету, соблюдая лимиты.
+
+        Каждое разрешение - O(log n) операций с кучами: запрос с вершины очереди,
+        чат которого еще не готов, откладывается в кучу _blocked до готовности чата.
+        """
+        queue = self._queue
+        blocked = self._blocked
+        while True:
+            now = time.monotonic()
+            wait = self._expire_animations(now)
+
+            # Чаты, которые снова готовы принимать сообщения
+            while blocked and blocked[0][0] <= now:
+                _, priority, seq, request = heapq.heappop(blocked)
+                if not request.future.done():
+                    heapq.heappush(queue, (priority, seq, request))
+
+            while queue and queue[0][2].future.done():
+                heapq.heappop(queue)
+
+            if queue:
+                overall_delay = self._overall.delay(now)
+                if overall_delay <= 0:
+                    priority, seq, request = heapq.heappop(queue)
+                    delay = self._chat_delay(request.chat_id, now)
+                    if delay > 0:
+                        heapq.heappush(blocked, (now + delay, priority, seq, request))
+                        continue
+
+                    if self._coalesce.get(request.coalesce_key) is request:
+                        del self._coalesce[request.coalesce_key]
+                    self._overall.consume(now)
+                    if request.chat_id is not None:
+                        self._chat_bucket(request.chat_id).consume(now)
+                    request.future.set_result(True)
+                    continue
+                wait = overall_delay if wait is None else min(wait, overall_delay)
+
+            if blocked:
+                ready_in = blocked[0][0] - now
+                wait = ready_in if wait is None else min(wait, ready_in)
+
+            self._wakeup.clear()
+            if wait is None:
+                self._prune(now)
+                await self._wakeup.wait()
+            else:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+
+    async def _acquire(self, priority, chat_id, coalesce_key):
+        """Ждет очереди на отправку; False - запрос пропущен"""
+        future = asyncio.get_running_loop().create_future()
+        request = _Request(priority, chat_id, coalesce_key, future)
+
+        if coalesce_key is not None:
+            # Новый кадр того же сообщения заменяет еще не отправленный
+            previous = self._coalesce.get(coalesce_key)
+            if previous is not None:
+                self._drop(previous)
+            self._coalesce[coalesce_key] = request
+
+        heapq.heappush(self._queue, (priority, next(self._counter), request))
+        if priority >= PRIORITY_ANIMATION:
+            self._animations.append(request)
+        self._wakeup.set()
+        return await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_MENU if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+
+        coalesce_key = None
+        if priority >= PRIORITY_ANIMATION and data.get('message_id') is not None:
+            coalesce_key = (chat_id, data.get('message_id'))
+
+        for attempt in range(self.max_retries + 1):
+            if not await self._acquire(priority, chat_id, coalesce_key):
+                return True
+
+            metrics.TELEGRAM_REQUESTS.labels(method=endpoint).inc()
+            start = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                self.retry_after_count += 1
+                retry_after = exc.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+
+                # Приостанавливаем отправку в этот чат (или всю, если чата нет)
+                self._paused_until[chat_id] = time.monotonic() + retry_after + 0.1
+                self._wakeup.set()
+                logger.warning(
+                    f"RetryAfter {retry_after} с для {endpoint} (чат {chat_id}), "
+                    f"попытка {attempt + 1}"
+                )
+
+                # Кадр анимации после паузы уже не нужен
+                if priority >= PRIORITY_ANIMATION:
+                    self.dropped_count += 1
+                    return True
+                if attempt == self.max_retries:
+                    raise
+            finally:
+                metrics.TELEGRAM_SECONDS.labels(method=endpoint).observe(time.perf_counter() - start)
@@ -0,0 +1,150 @@
+"""Предварительный рендер анимации колеса для каждого приза.
+
+Запуск: python render_wheel.py
+
+Для каждого купона из COUPON_CONFIG рисуется GIF, в котором колесо
+останавливается на этом купоне. Файлы и manifest.json с отпечатком
+конфигурации сохраняются в WHEEL_MEDIA_DIR, а сохраненные file_id Telegram
+сбрасываются: при первом спине каждый файл загрузится заново.
+Запускайте после каждого изменения COUPON_CONFIG.
+
+Для рендера нужен Pillow (pip install Pillow). Самому боту Pillow не нужен:
+он только отправляет готовые файлы, а без них использует покадровую анимацию.
+"""
+import json
+import math
+import os
+import sys
+import config
+from prize_sampler import config_fingerprint
+
+SIZE = 320
+WHEEL_RADIUS = 140
+SPIN_FRAMES = 40
+FRAME_DURATION_MS = 60
+FINAL_FRAME_MS = 2000
+TURNS = 4
+
+# Цвета секторов (повторяются по кругу)
+COLORS = ['#c0392b', '#27ae60', '#2980b9', '#f1c40f', '#8e44ad', '#16a085']
+BACKGROUND = '#0b3d2e'
+
+MANIFEST = 'manifest.json'
+
+
+def load_manifest(media_dir=None):
+    """Манифест отрендеренных файлов или None, если рендер не выполнялся"""
+    path = os.path.join(media_dir or config.WHEEL_MEDIA_DIR, MANIFEST)
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def segments(coupon_config):
+    """Секторы колеса: (купон, начальный угол, конечный угол) по весам chance"""
+    total = sum(data['chance'] for data in coupon_config.values())
+    result = []
+    angle = 0.0
+    for coupon, data in coupon_config.items():
+        sweep = 360.0 * data['chance'] / total
+        result.append((coupon, angle, angle + sweep))
+        angle += sweep
+    return result
+
+
+def draw_wheel(coupon_config):
+    """Неподвижное изображение колеса с подписями секторов"""
+    from PIL import Image, ImageDraw, ImageFont
+
+    wheel = Image.new('RGBA', (SIZE, SIZE), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(wheel)
+    center = SIZE / 2
+    box = [center - WHEEL_RADIUS, center - WHEEL_RADIUS,
+           center + WHEEL_RADIUS, center + WHEEL_RADIUS]
+    try:
+        font = ImageFont.load_default(size=22)
+    except TypeError:
+        # Pillow < 10.1 не умеет масштабировать встроенный шрифт
+        font = ImageFont.load_default()
+
+    for i, (coupon, start, end) in enumerate(segments(coupon_config)):
+        draw.pieslice(box, start, end, fill=COLORS[i % len(COLORS)], outline='white', width=2)
+        middle = math.radians((start + end) / 2)
+        x = center + WHEEL_RADIUS * 0.65 * math.cos(middle)
+        y = center + WHEEL_RADIUS * 0.65 * math.sin(middle)
+        draw.text((x, y), coupon, fill='white', font=font, anchor='mm')
+
+    draw.ellipse([center - 14, center - 14, center + 14, center + 14], fill='white')
+    return wheel
+
+
+def render_prize(wheel, start, end, path):
+    """GIF, в котором колесо с замедлением останавливается на секторе [start, end]"""
+    from PIL import Image, ImageDraw
+
+    center = SIZE / 2
+    # Указатель сверху (угол -90°); поворачиваем колесо так, чтобы середина сектора
+    # оказалась под ним. Image.rotate поворачивает против часовой стрелки
+    target = (start + end) / 2 + 90
+    total = TURNS * 360 + target
+
+    frames = []
+    for i in range(SPIN_FRAMES + 1):
+        t = i / SPIN_FRAMES
+        angle = total * (1 - (1 - t) ** 3)  # замедление к концу
+        frame = Image.new('RGBA', (SIZE, SIZE), BACKGROUND)
+        frame.alpha_composite(wheel.rotate(angle, resample=Image.BICUBIC))
+        draw = ImageDraw.Draw(frame)
+        draw.polygon(
+            [(center - 12, 6), (center + 12, 6), (center, 6 + 28)],
+            fill='white', outline='black'
+        )
+        frames.append(frame.convert('P', palette=Image.ADAPTIVE))
+
+    durations = [FRAME_DURATION_MS] * SPIN_FRAMES + [FINAL_FRAME_MS]
+    frames[0].save(
+        path, save_all=True, append_images=frames[1:],
+        duration=durations, loop=0, optimize=True
+    )
+
+
+def render_all(coupon_config=None, media_dir=None):
+    """Рендерит анимации для всех призов и записывает манифест"""
+    coupon_config = coupon_config or config.COUPON_CONFIG
+    media_dir = media_dir or config.WHEEL_MEDIA_DIR
+    os.makedirs(media_dir, exist_ok=True)
+
+    wheel = draw_wheel(coupon_config)
+    files = {}
+    for i, (coupon, start, end) in enumerate(segments(coupon_config)):
+        filename = f'wheel_{i}.gif'
+        render_prize(wheel, start, end, os.path.join(media_dir, filename))
+        files[coupon] = filename
+
+    manifest = {
+        'fingerprint': config_fingerprint(coupon_config),
+        'files': files
+    }
+    with open(os.path.join(media_dir, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+if __name__ == '__main__':
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        print("Для рендера анимации нужен Pillow: pip install Pillow")
+        sys.exit(1)
+
+    manifest = render_all()
+
+    # Старые file_id указывают на прежние анимации - сбрасываем их
+    from database import db
+    db.clear_media_file_ids()
+
+    for coupon, filename in manifest['files'].items():
+        print(f"{coupon}: {os.path.join(config.WHEEL_MEDIA_DIR, filename)}")
+    print(f"Отпечаток конфигурации: {manifest['fingerprint']}")
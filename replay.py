@@ -0,0 +1,489 @@
+"""Запись и воспроизведение входящих обновлений Telegram.
+
+Запись: задайте RECORD_UPDATES_PATH (например, traffic.jsonl.gz), и бот
+будет дописывать каждое обновление в файл JSON Lines (.gz - со сжатием).
+Идентификаторы пользователей и чатов заменяются на HMAC от RECORD_SECRET,
+имена и username удаляются. В тексте сообщений пользователей (кроме команд)
+каждое слово, кроме скидок вида 15%, заменяется псевдонимом от того же ключа:
+весь свободный текст, который принимает бот, - это Instagram (после /start,
+при отметке купона и в поиске админа), и одинаковые имена дают одинаковые
+псевдонимы. Текст сообщений бота не записывается. Без RECORD_SECRET ключ случайный на каждый запуск,
+и записи разных запусков не связаны между собой. При шардировании используйте
+{pid} в пути, чтобы процессы писали в разные файлы.
+
+Воспроизведение: обновления подаются в Application с хендлерами bot.py,
+Bot API подменяется FakeBotRequest, база создается во временном каталоге:
+
+    python replay.py traffic.jsonl.gz --output run.json          # в записанном темпе
+    python replay.py traffic.jsonl.gz --fast --expect run.json   # как можно быстрее
+
+Время базы при воспроизведении - момент записи обрабатываемого обновления
+(RecordedClock), поэтому дневной лимит спинов и сроки купонов считаются по
+дням записи, даже если запись многодневная.
+
+Отчет содержит задержки обработки, число вызовов Bot API и отпечаток
+итогового состояния базы. --expect сравнивает отпечаток и вызовы Bot API с
+отчетом предыдущего прогона (например, до изменения кода) и завершается с
+кодом 1 при расхождении. Призы выбираются генератором с зерном --seed,
+отдельным для каждого пользователя, поэтому итог не зависит от того, в каком
+порядке обрабатывались обновления разных пользователей.
+"""
+import argparse
+import asyncio
+import atexit
+import contextvars
+import functools
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import random
+import re
+import secrets
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+# Как часто сбрасывать буфер файла записи (секунды)
+FLUSH_INTERVAL = 1.0
+# Максимум обновлений, ожидающих записи; при переполнении они не записываются
+RECORD_QUEUE_SIZE = 10000
+# Личные поля пользователей и чатов, которые не попадают в запись
+PERSONAL_FIELDS = ('first_name', 'last_name', 'username', 'title', 'bio')
+# Слова текста, которые остаются как есть: скидки вида 15 или 15%
+DISCOUNT_WORD = re.compile(r'^\d+%?$')
+
+
+def anonymize_id(value, key):
+    """Стабильная замена id: HMAC-SHA256 в диапазоне 48 бит, знак сохраняется"""
+    digest = hmac.new(key, str(abs(value)).encode(), hashlib.sha256).digest()
+    anonymized = int.from_bytes(digest[:6], 'big') + 1
+    return -anonymized if value < 0 else anonymized
+
+
+def anonymize_handle(word, key):
+    """Псевдоним Instagram: HMAC от нормализованного имени (как в базе), @ сохраняется"""
+    prefix = '@' if word.startswith('@') else ''
+    name = word.lstrip('@').lower()
+    digest = hmac.new(key, b'instagram:' + name.encode(), hashlib.sha256).hexdigest()
+    return f'{prefix}ig_{digest[:12]}'
+
+
+def anonymize_text(text, key):
+    """Текст пользователя без Instagram: команды как есть, в остальном тексте
+    каждое слово, кроме скидок, заменяется псевдонимом"""
+    if text.startswith('/'):
+        return text
+    return ' '.join(
+        word if DISCOUNT_WORD.match(word) else anonymize_handle(word, key)
+        for word in text.split()
+    )
+
+
+def anonymize_update(data, key):
+    """Копия обновления (словарь JSON) без личных данных пользователей и чатов"""
+    if isinstance(data, list):
+        return [anonymize_update(item, key) for item in data]
+    if not isinstance(data, dict):
+        return data
+
+    # Пользователь (есть is_bot) или чат (есть type) - заменяем id и убираем имена
+    person = 'id' in data and ('is_bot' in data or 'type' in data)
+    message = 'message_id' in data and 'chat' in data
+    from_bot = message and (data.get('from') or {}).get('is_bot', False)
+    result = {}
+    for name, value in data.items():
+        if person and name in PERSONAL_FIELDS:
+            continue
+        if message and name in ('text', 'caption') and isinstance(value, str):
+            # Текст бота (например, результаты поиска) содержит Instagram пользователей
+            result[name] = '...' if from_bot else anonymize_text(value, key)
+            continue
+        if message and name in ('entities', 'caption_entities'):
+            # Смещения сущностей после замены слов неверны; команду в начале сохраняем
+            kept = [entity for entity in value if entity.get('type') == 'bot_command'
+                    and not from_bot and str(data.get('text', '')).startswith('/')]
+            if kept:
+                result[name] = kept
+            continue
+        if person and name == 'id' and not data.get('is_bot'):
+            result[name] = anonymize_id(value, key)
+        elif name == 'user_id' and isinstance(value, int):
+            result[name] = anonymize_id(value, key)
+        else:
+            result[name] = anonymize_update(value, key)
+    if person and 'is_bot' in data:
+        result['first_name'] = 'User'
+    return result
+
+
+def open_recording(path, mode):
+    """Файл записи в текстовом режиме; .gz - со сжатием"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class UpdateRecorder:
+    """Дописывает обезличенные обновления в файл записи.
+
+    Подключается к Application как TypeHandler(Update, recorder.record) в
+    группе -1: хендлер срабатывает раньше остальных и не мешает их работе.
+    Хендлер только кладет обновление в очередь; обезличивание, сжатие и запись
+    на диск выполняет отдельный поток, поэтому диск не задерживает обработку.
+    Если очередь переполнена, обновление не записывается (dropped_count).
+    Каждый запуск начинает в файле новый сегмент с заголовком.
+    """
+
+    def __init__(self, path, secret=None, admin_id=None):
+        self.path = path.replace('{pid}', str(os.getpid()))
+        self.key = secret.encode() if secret else secrets.token_bytes(32)
+        self.admin_id = anonymize_id(int(admin_id), self.key) if admin_id else None
+        self.recorded_count = 0
+        self.dropped_count = 0
+        self._queue = queue.Queue(RECORD_QUEUE_SIZE)
+        self._thread = None
+        self._file = None
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def _writer(self):
+        """Поток записи: пишет обновления из очереди и сбрасывает буфер раз в FLUSH_INTERVAL"""
+        self._file = open_recording(self.path, 'a')
+        self._write({'header': {
+            'version': FORMAT_VERSION,
+            'started': time.time(),
+            'admin_id': self.admin_id,
+        }})
+        logger.info(f"Запись обновлений в {self.path}")
+        dirty = True
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=FLUSH_INTERVAL if dirty else None)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                created, data = item
+                try:
+                    self._write({'t': created, 'u': anonymize_update(data, self.key)})
+                    self.recorded_count += 1
+                    dirty = True
+                except Exception as e:
+                    # Запись не должна мешать обработке обновлений
+                    logger.error(f"Не удалось записать обновление: {e}")
+
+            now = time.monotonic()
+            if dirty and now - last_flush >= FLUSH_INTERVAL:
+                self._file.flush()
+                dirty = False
+                last_flush = now
+        self._file.close()
+        self._file = None
+
+    async def record(self, update, context):
+        """Хендлер: ставит обновление в очередь записи и передает его дальше"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer, name='update-recorder', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+        try:
+            self._queue.put_nowait((round(time.time(), 3), update.to_dict()))
+        except queue.Full:
+            self.dropped_count += 1
+
+    def close(self):
+        """Дописывает очередь и закрывает файл"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def read_recording(paths):
+    """Заголовки сегментов и записи [(время, обновление)] из файлов, по времени.
+
+    Оборванная последняя строка или неполный gzip (бот остановлен аварийно)
+    не считаются ошибкой: читается все, что успело записаться.
+    """
+    headers = []
+    records = []
+    for path in paths:
+        with open_recording(path, 'r') as f:
+            try:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"{path}: пропущена поврежденная строка")
+                        continue
+                    if 'header' in item:
+                        headers.append(item['header'])
+                    else:
+                        records.append((item['t'], item['u']))
+            except EOFError:
+                logger.warning(f"{path}: файл оборван, прочитано записей: {len(records)}")
+    records.sort(key=lambda record: record[0])
+    return headers, records
+
+
+class PerUserRandom:
+    """Источник случайности призов для воспроизведения: своя последовательность
+    у каждого пользователя, поэтому приз не зависит от того, когда параллельно
+    обрабатывались спины других пользователей. Пользователя спина задает
+    обертка reserve_spin из use_per_user_prizes (в потоке пула БД).
+    """
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.current = threading.local()
+        self.generators = {}
+
+    def random(self):
+        telegram_id = getattr(self.current, 'telegram_id', 0)
+        generator = self.generators.get(telegram_id)
+        if generator is None:
+            generator = self.generators[telegram_id] = random.Random(f'{self.seed}:{telegram_id}')
+        return generator.random()
+
+
+class RecordedClock:
+    """Время базы при воспроизведении: момент записи обновления.
+
+    Момент задается в контексте задачи обработки обновления (set) и через
+    contextvars доходит до потоков пула БД. Вне обработки (например, при
+    снятии отпечатка базы) используется момент последнего поданного обновления.
+    """
+
+    def __init__(self, start):
+        self.current = contextvars.ContextVar('recorded_now')
+        self.latest = start
+
+    def set(self, recorded_at):
+        self.current.set(recorded_at)
+        self.latest = max(self.latest, recorded_at)
+
+    def __call__(self):
+        return self.current.get(self.latest)
+
+
+def use_per_user_prizes(database, seed):
+    """Подключает PerUserRandom к генератору призов базы"""
+    rng = PerUserRandom(seed)
+    reserve_spin = database.reserve_spin
+
+    @functools.wraps(reserve_spin)
+    def reserve_spin_for_user(telegram_id, *args, **kwargs):
+        rng.current.telegram_id = telegram_id
+        return reserve_spin(telegram_id, *args, **kwargs)
+
+    database.reserve_spin = reserve_spin_for_user
+    database.prize_sampler.rng = rng
+
+
+def state_digest(connection):
+    """Отпечаток итогового состояния базы без времени и порядка вставки"""
+    users = connection.execute('''
+        SELECT telegram_id, username, first_name, last_name, total_spins
+        FROM users ORDER BY telegram_id
+    ''').fetchall()
+    coupons = connection.execute('''
+        SELECT telegram_id, username, coupon, code_word, used FROM coupons
+        ORDER BY telegram_id, username, coupon, code_word, used
+    ''').fetchall()
+
+    data = json.dumps([list(row) for row in users + [('coupons',)] + coupons], ensure_ascii=False)
+    return {
+        'users': len(users),
+        'coupons': len(coupons),
+        'used_coupons': sum(1 for row in coupons if row[4]),
+        'prizes': dict(Counter(row[2] for row in coupons)),
+        'digest': hashlib.sha256(data.encode('utf-8')).hexdigest(),
+    }
+
+
+async def replay(records, args):
+    """Подает записанные обновления в Application и собирает отчет"""
+    import bot
+    from benchmark import latency_summary
+    from database import adb, db
+    from fake_bot_api import FakeBotRequest
+    from telegram import Update
+    from webhook import running
+
+    use_per_user_prizes(db, args.seed)
+    clock = RecordedClock(records[0][0] if records else time.time())
+    db.use_clock(clock)
+    request = FakeBotRequest()
+    application = bot.build_application(updater=False, request=request)
+    latencies = []
+    errors = 0
+    max_lag = 0.0
+
+    async def count_error(update, context):
+        nonlocal errors
+        errors += 1
+
+    application.add_error_handler(count_error)
+
+    async def process(update, recorded_at):
+        clock.set(recorded_at)
+        begin = time.perf_counter()
+        await application.update_processor.process_update(
+            update, application.process_update(update)
+        )
+        latencies.append(time.perf_counter() - begin)
+
+    async with running(application):
+        request.reset()
+        adb.calls.clear()
+        tasks = set()
+
+        start = time.perf_counter()
+        offset = 0.0
+        previous = records[0][0] if records else 0.0
+        for recorded_at, data in records:
+            if not args.fast:
+                # Длинные паузы (ночь, простой) сокращаются до --max-gap
+                offset += min(recorded_at - previous, args.max_gap) / args.speed
+                previous = recorded_at
+                delay = offset - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    max_lag = max(max_lag, -delay)
+
+            task = asyncio.create_task(process(Update.de_json(data, application.bot), recorded_at))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        await asyncio.gather(*tasks)
+        while bot.spin_animations:
+            await asyncio.gather(*list(bot.spin_animations.values()), return_exceptions=True)
+        duration = time.perf_counter() - start
+
+        telegram_calls = dict(request.calls)
+        db_calls = dict(adb.calls)
+        state = state_digest(db.get_connection())
+
+    return {
+        'mode': 'fast' if args.fast else f'x{args.speed:g}',
+        'seed': args.seed,
+        'updates': len(records),
+        'duration_s': round(duration, 3),
+        'updates_per_s': round(len(records) / duration, 2) if duration else None,
+        'max_lag_ms': round(max_lag * 1000, 3),
+        'errors': errors,
+        'latency_ms': latency_summary(latencies),
+        'db': {'ops': sum(db_calls.values()), 'by_method': db_calls},
+        'telegram': {'calls': sum(telegram_calls.values()), 'by_method': telegram_calls},
+        'state': state,
+    }
+
+
+def compare_runs(expected, actual):
+    """Список расхождений между отчетами двух прогонов одной записи"""
+    problems = []
+    if expected['updates'] != actual['updates']:
+        problems.append(f"обновлений: {expected['updates']} -> {actual['updates']}")
+    if expected['state']['digest'] != actual['state']['digest']:
+        problems.append("итоговое состояние базы отличается")
+        for name in ('users', 'coupons', 'used_coupons', 'prizes'):
+            if expected['state'][name] != actual['state'][name]:
+                problems.append(f"  {name}: {expected['state'][name]} -> {actual['state'][name]}")
+    if expected['seed'] != actual['seed']:
+        problems.append(f"прогоны с разным --seed: {expected['seed']} и {actual['seed']}")
+
+    before, after = expected['telegram']['by_method'], actual['telegram']['by_method']
+    for method in sorted(set(before) | set(after)):
+        if before.get(method, 0) != after.get(method, 0):
+            problems.append(f"вызовов {method}: {before.get(method, 0)} -> {after.get(method, 0)}")
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Воспроизведение записанных обновлений Telegram')
+    parser.add_argument('recordings', nargs='+', help='файлы записи (.jsonl или .jsonl.gz)')
+    parser.add_argument('--fast', action='store_true', help='без пауз, как можно быстрее')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='ускорение относительно записи (без --fast)')
+    parser.add_argument('--max-gap', type=float, default=60.0,
+                        help='максимальная пауза между обновлениями, с (без --fast)')
+    parser.add_argument('--seed', type=int, default=1, help='зерно генератора призов')
+    parser.add_argument('--animation-frames', type=int, default=None,
+                        help='кадров анимации спина (по умолчанию из config)')
+    parser.add_argument('--animation-interval', type=float, default=None,
+                        help='интервал кадров анимации, с (по умолчанию из config)')
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help='соблюдать лимиты Telegram из config')
+    parser.add_argument('--output', help='файл отчета JSON (по умолчанию stdout)')
+    parser.add_argument('--expect', help='отчет прошлого прогона для сравнения')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    from benchmark import configure_environment
+
+    args = parse_args(argv)
+    headers, records = read_recording(args.recordings)
+    if not records:
+        print("В записи нет обновлений")
+        return 1
+
+    admin_ids = {header.get('admin_id') for header in headers} - {None}
+    if len(admin_ids) > 1:
+        logger.warning("Сегменты записаны с разными ключами: админ распознается только в одном")
+
+    workdir = tempfile.mkdtemp(prefix='wheel-replay-')
+    configure_environment(
+        args, os.path.join(workdir, 'replay.db'),
+        admin_id=min(admin_ids) if admin_ids else 0
+    )
+    try:
+        import bot  # noqa: F401 - настраивает логирование бота
+        logging.getLogger().setLevel(logging.WARNING)
+        report = asyncio.run(replay(records, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    report['recordings'] = args.recordings
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    latency = report['latency_ms']
+    print(
+        f"{report['updates']} обновлений за {report['duration_s']} с, "
+        f"p50 {latency['p50']} мс, p95 {latency['p95']} мс, p99 {latency['p99']} мс, "
+        f"Bot API {report['telegram']['calls']} вызовов, ошибок {report['errors']}",
+        file=sys.stderr
+    )
+
+    if args.expect:
+        with open(args.expect, encoding='utf-8') as f:
+            problems = compare_runs(json.load(f), report)
+        for problem in problems:
+            print(f"❌ {problem}", file=sys.stderr)
+        if problems:
+            return 1
+        print("✅ Состояние базы и вызовы Bot API совпадают", file=sys.stderr)
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""Многопроцессный режим: обновления шардируются по telegram_id.
+
+Запуск: python sharding.py
+
+Фронтовой процесс получает обновления (long polling или webhook - по BOT_MODE)
+и раскладывает их по SHARD_WORKERS процессам-обработчикам: шард = telegram_id
+отправителя по модулю числа шардов. Все обновления одного пользователя
+попадают в один процесс, поэтому context.user_data, состояние диалогов и
+кэши пользователя в database.py остаются согласованными. Процессы работают
+с одной базой SQLite (WAL, busy_timeout), общий лимит исходящих сообщений
+делится между ними поровну.
+
+Сводку пользователя из чужого шарда (например, после отметки купона админом)
+процесс сбрасывает сообщением в очередь шарда этого пользователя.
+Записи лога шарды передают в очередь фронтового процесса: файл с ротацией
+пишет только он.
+
+SHARD_INLINE=1 запускает все шарды в одном процессе - тот же путь
+маршрутизации без multiprocessing, для тестов и отладки.
+"""
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import signal
+from telegram import Bot, Update
+from telegram.error import RetryAfter, TelegramError
+import config
+import logging_setup
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 30
+WORKER_STOP_TIMEOUT = 30
+
+
+def update_user_id(data):
+    """telegram_id отправителя обновления (словарь JSON) или id чата"""
+    for kind in ('message', 'edited_message', 'callback_query', 'inline_query',
+                 'chosen_inline_result', 'pre_checkout_query', 'shipping_query'):
+        payload = data.get(kind)
+        if payload:
+            user = payload.get('from')
+            if user:
+                return user['id']
+            chat = payload.get('chat')
+            if chat:
+                return chat['id']
+    return 0
+
+
+def shard_for(telegram_id, shards):
+    """Номер шарда пользователя"""
+    return telegram_id % shards
+
+
+def invalidation_hook(index, shards, send_invalidation):
+    """Hook сброса сводки для шарда index: сообщает шарду-владельцу пользователя,
+    если это не текущий шард"""
+    def invalidate(telegram_id):
+        shard = shard_for(telegram_id, shards)
+        if shard != index:
+            send_invalidation(shard, telegram_id)
+
+    return invalidate
+
+
+async def run_worker(index, shards, get_message, send_invalidation=None, request=None):
+    """Обработчик одного шарда: свой Application, общий код хендлеров.
+
+    get_message - корутина, возвращающая ('update', dict), ('invalidate', telegram_id)
+    или None для остановки; send_invalidation(shard, telegram_id) - сообщить
+    другому шарду о сбросе сводки пользователя. Без send_invalidation шард
+    делит базу и кэши с другими шардами процесса и не закрывает базу сам.
+    request - свой транспорт Bot API (например, FakeBotRequest в тестах).
+    """
+    from bot import build_application
+    from database import db
+    from webhook import running
+
+    application = build_application(
+        updater=False,
+        overall_rate=config.TELEGRAM_OVERALL_RATE / shards,
+        request=request
+    )
+
+    if send_invalidation:
+        db.invalidation_hook = invalidation_hook(index, shards, send_invalidation)
+    else:
+        application.post_shutdown = None
+
+    async with running(application):
+        logger.info(f"Шард {index} из {shards} запущен")
+        while True:
+            message = await get_message()
+            if message is None:
+                break
+            kind, payload = message
+            if kind == 'update':
+                await application.update_queue.put(Update.de_json(payload, application.bot))
+            elif kind == 'invalidate':
+                db.invalidate_user_summary(payload, propagate=False)
+    logger.info(f"Шард {index} остановлен")
+
+
+def worker_process(index, shards, queues, log_queue):
+    """Точка входа процесса-шарда"""
+    # Записи лога пишет в файл фронтовой процесс
+    logging_setup.setup_logging(log_queue, listen=False)
+    # Останавливает фронт (сообщением None), чтобы шард дообработал очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    inbox = queues[index]
+    if config.METRICS_PORT:
+        import metrics
+        metrics.start_http_server(config.METRICS_PORT + index, config.METRICS_LISTEN)
+
+    async def get_message():
+        return await asyncio.get_running_loop().run_in_executor(None, inbox.get)
+
+    def send_invalidation(shard, telegram_id):
+        queues[shard].put(('invalidate', telegram_id))
+
+    asyncio.run(run_worker(index, shards, get_message, send_invalidation))
+
+
+async def poll_updates(bot, dispatch, allowed_updates):
+    """Long polling: передает каждое обновление в dispatch(dict)"""
+    await bot.delete_webhook()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset, timeout=POLL_TIMEOUT, allowed_updates=allowed_updates
+                )
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                await asyncio.sleep(retry_after)
+                continue
+            except TelegramError as e:
+                logger.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                await dispatch(update.to_dict())
+                offset = update.update_id + 1
+    finally:
+        # Подтверждаем уже разосланные обновления, чтобы не получить их повторно
+        if offset is not None:
+            with contextlib.suppress(TelegramError):
+                await bot.get_updates(offset=offset, timeout=0, limit=1)
+
+
+async def forward_updates(update_queue, dispatch):
+    """Передает обновления из очереди Updater в dispatch(dict)"""
+    while True:
+        update = await update_queue.get()
+        await dispatch(update.to_dict())
+
+
+async def run_front(dispatch, stop_event, request=None):
+    """Получает обновления по BOT_MODE и передает их в dispatch до stop_event"""
+    from bot import ALLOWED_UPDATES
+    import webhook
+
+    async with Bot(config.BOT_TOKEN, request=request, get_updates_request=request) as bot:
+        if config.BOT_MODE == 'webhook':
+            # Сервер PTB кладет обновления в свою очередь, отсюда они расходятся по шардам
+            updates = asyncio.Queue()
+            updater = await webhook.start_webhook(bot, updates, ALLOWED_UPDATES)
+            forwarding = asyncio.create_task(forward_updates(updates, dispatch))
+            try:
+                await stop_event.wait()
+            finally:
+                await webhook.stop_webhook(updater)
+                forwarding.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await forwarding
+                # Обновления, принятые до остановки сервера, тоже отдаем шардам
+                while not updates.empty():
+                    await dispatch(updates.get_nowait().to_dict())
+        else:
+            polling = asyncio.create_task(poll_updates(bot, dispatch, ALLOWED_UPDATES))
+            await stop_event.wait()
+            polling.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await polling
+
+
+async def run_inline(shards, stop_event, request=None):
+    """Все шарды в одном процессе (SHARD_INLINE=1).
+
+    request - общий транспорт Bot API фронта и шардов (FakeBotRequest в тестах).
+    """
+    from database import adb
+
+    queues = [asyncio.Queue() for _ in range(shards)]
+
+    async def dispatch(data):
+        await queues[shard_for(update_user_id(data), shards)].put(('update', data))
+
+    # База и кэши общие для всех шардов процесса: база закрывается здесь
+    workers = [
+        asyncio.create_task(run_worker(i, shards, queues[i].get, request=request))
+        for i in range(shards)
+    ]
+    try:
+        await run_front(dispatch, stop_event, request)
+    finally:
+        for q in queues:
+            q.put_nowait(None)
+        await asyncio.gather(*workers, return_exceptions=True)
+        adb.close()
+
+
+async def run_processes(shards, stop_event):
+    """Шарды в отдельных процессах"""
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(shards)]
+    log_queue = context.Queue(config.LOG_QUEUE_SIZE)
+    logging_setup.setup_logging(log_queue)
+    processes = [
+        context.Process(target=worker_process, args=(i, shards, queues, log_queue), name=f'shard-{i}')
+        for i in range(shards)
+    ]
+    for process in processes:
+        process.start()
+
+    async def dispatch(data):
+        queues[shard_for(update_user_id(data), shards)].put(('update', data))
+
+    try:
+        await run_front(dispatch, stop_event)
+    finally:
+        for q in queues:
+            q.put(None)
+        loop = asyncio.get_running_loop()
+        for process in processes:
+            await loop.run_in_executor(None, process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"{process.name} не остановился за {WORKER_STOP_TIMEOUT} с")
+                process.terminate()
+
+
+async def main():
+    import webhook
+
+    stop_event = webhook.stop_signal_event()
+    shards = max(1, config.SHARD_WORKERS)
+    print(f"🚀 {config.BOT_NAME}: {shards} шардов, режим {config.BOT_MODE}")
+    if config.SHARD_INLINE:
+        if config.METRICS_PORT:
+            import metrics
+            metrics.start_http_server(config.METRICS_PORT, config.METRICS_LISTEN)
+        await run_inline(shards, stop_event)
+    else:
+        await run_processes(shards, stop_event)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
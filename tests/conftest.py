@@ -0,0 +1,20 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config читает окружение при импорте, а database создает глобальную базу:
+# направляем все файлы во временный каталог, чтобы не трогать рабочие
+_workdir = tempfile.mkdtemp(prefix='wheel-tests-')
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.environ['DB_PATH'] = os.path.join(_workdir, 'coupons.db')
+os.environ['LOG_FILE'] = os.path.join(_workdir, 'bot_debug.log')
+os.environ['DB_SLOW_QUERY_LOG'] = os.path.join(_workdir, 'slow_queries.log')
+os.environ['RECORD_UPDATES_PATH'] = ''
+os.environ['METRICS_PORT'] = '0'
+os.environ.setdefault('BOT_TOKEN', '123456:test')
+os.environ.setdefault('ADMIN_ID', '1')
@@ -0,0 +1,110 @@
+import csv
+import io
+import pytest
+from bulk_redeem import parse_redemptions, redeem_file
+from database import Database
+
+NOW = 1_710_000_000
+DAY = 24 * 60 * 60
+NOT_FOUND = 'Пользователь с таким Instagram не найден'
+USED_UP = 'Все купоны с этой скидкой уже использованы или истекли'
+NO_SUCH_DISCOUNT = 'У пользователя нет купонов с такой скидкой'
+
+
+@pytest.mark.parametrize('data, requests, errors', [
+    # Разделитель определяется по строке: ; , табуляция, иначе пробелы
+    (b'user_a;15\n', [(1, 'user_a', '15%')], []),
+    (b'user_a,15%\n', [(1, 'user_a', '15%')], []),
+    (b'user_a\t15\n', [(1, 'user_a', '15%')], []),
+    (b'@user_a   15%\n', [(1, 'user_a', '15%')], []),
+    # Поля в кавычках, пробелы после разделителя
+    (b'"@user_a"; "15%"\n', [(1, 'user_a', '15%')], []),
+    (b"'user_a',  '5'\n", [(1, 'user_a', '5%')], []),
+    # Заголовок после пустых строк и комментария пропускается
+    (b'\n\n# weekly\ninstagram;discount\nuser_a;10\n', [(5, 'user_a', '10%')], []),
+    ('Инстаграм,Скидка\r\nuser_a,10\r\n'.encode('cp1251'), [(2, 'user_a', '10%')], []),
+    ('\ufeffinstagram;скидка\nuser_a;10\n'.encode('utf-8'), [(2, 'user_a', '10%')], []),
+    # Повторяющиеся строки остаются отдельными запросами
+    (b'user_a;5\nuser_a;5\n', [(1, 'user_a', '5%'), (2, 'user_a', '5%')], []),
+    # После первой строки данных нераспознанная строка - ошибка, а не заголовок
+    (b'user_a;5\nuser_b;five\nuser_c\n', [(1, 'user_a', '5%')], [
+        (2, 'user_b;five', 'Неверный формат, нужно: instagram скидка'),
+        (3, 'user_c', 'Неверный формат, нужно: instagram скидка'),
+    ]),
+])
+def test_parse_redemptions(data, requests, errors):
+    assert parse_redemptions(data) == (requests, errors)
+
+
+def test_parse_redemptions_limits_lines():
+    with pytest.raises(ValueError):
+        parse_redemptions(b'a 5\nb 5\nc 5\n', max_lines=2)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Временная база с купонами (instagram, скидка, использован, просрочен)"""
+    db = Database(str(tmp_path / 'redeem.db'), clock=lambda: NOW)
+    coupons = [
+        ('User_A', '5%', 0, False),
+        ('User_A', '5%', 0, False),
+        ('User_A', '10%', 1, False),
+        ('user_b', '15%', 0, True),
+    ]
+    db.get_connection().executemany('''
+        INSERT INTO coupons (telegram_id, username, instagram, coupon, code_word,
+                             created_at, valid_until, used)
+        VALUES (?, ?, lower(?), ?, 'word', ?, ?, ?)
+    ''', [
+        (index + 1, instagram, instagram, coupon, NOW - DAY + index,
+         NOW - 1 if expired else NOW + DAY, used)
+        for index, (instagram, coupon, used, expired) in enumerate(coupons)
+    ])
+    db.get_connection().commit()
+    yield db
+    db.close()
+
+
+@pytest.mark.parametrize('instagram, coupon, reason', [
+    ('nobody', '5%', NOT_FOUND),
+    ('user_a', '10%', USED_UP),
+    ('user_b', '15%', USED_UP),
+    ('user_a', '50%', NO_SUCH_DISCOUNT),
+    ('user_b', '5%', NO_SUCH_DISCOUNT),
+])
+def test_bulk_failure_reasons(db, instagram, coupon, reason):
+    result, = db.mark_coupons_used_bulk([(1, instagram, coupon)])
+    assert result['success'] is False
+    assert result['reason'] == reason
+
+
+def test_bulk_redeems_duplicates_in_creation_order(db):
+    results = db.mark_coupons_used_bulk([
+        (3, 'user_a', '5%'),
+        (1, '@USER_A', '5%'),
+        (2, 'User_A ', '5%'),
+    ])
+    assert [result['line'] for result in results] == [1, 2, 3]
+    assert [result['success'] for result in results] == [True, True, False]
+    assert [results[0]['coupon_id'], results[1]['coupon_id']] == [1, 2]
+    assert results[2]['reason'] == USED_UP
+
+    # Повторная загрузка того же файла ничего не отмечает
+    again, = db.mark_coupons_used_bulk([(1, 'user_a', '5%')])
+    assert again['reason'] == USED_UP
+
+
+def test_redeem_file_reports_every_line(db):
+    data = 'instagram;скидка\n\nuser_a;5\nuser_a;5\nuser_a;5\nnobody;5\nбез скидки\n'.encode()
+    output, filename, summary = redeem_file(db, data)
+
+    assert filename == 'redeem_report.csv'
+    assert summary == {'lines': 5, 'redeemed': 2, 'not_found': 2, 'invalid': 1}
+    rows = list(csv.reader(io.TextIOWrapper(output, encoding='utf-8-sig')))
+    assert [(row[0], row[3], row[7]) for row in rows[1:]] == [
+        ('3', 'Отмечен', ''),
+        ('4', 'Отмечен', ''),
+        ('5', 'Не найден', USED_UP),
+        ('6', 'Не найден', NOT_FOUND),
+        ('7', 'Ошибка', 'Неверный формат, нужно: instagram скидка'),
+    ]
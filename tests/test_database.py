@@ -0,0 +1,168 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+import pytest
+import pytz
+import database
+from database import Database, campaign_day
+
+# Схема базы до миграций (как ее создавала первая версия бота)
+BASELINE_SCHEMA = '''
+    CREATE TABLE coupons (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        coupon TEXT NOT NULL,
+        code_word TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        valid_until TIMESTAMP NOT NULL,
+        used BOOLEAN DEFAULT 0
+    );
+    CREATE TABLE users (
+        telegram_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        total_spins INTEGER DEFAULT 0
+    );
+    CREATE INDEX idx_user_date ON coupons(telegram_id, date(created_at));
+    CREATE INDEX idx_valid_until ON coupons(valid_until);
+'''
+
+
+class Clock:
+    """Подменяемое время базы"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def open_db(tmp_path):
+    """Базы на временном файле; все открытые закрываются после теста"""
+    opened = []
+
+    def open_db(name='test.db', **kwargs):
+        db = Database(str(tmp_path / name), **kwargs)
+        opened.append(db)
+        return db
+
+    yield open_db
+    for db in opened:
+        db.close()
+
+
+def coupon_rows(db, telegram_id):
+    return db.get_connection().execute(
+        'SELECT coupon, spin_day FROM coupons WHERE telegram_id = ? ORDER BY id',
+        (telegram_id,)
+    ).fetchall()
+
+
+def test_concurrent_same_day_spins_give_one_coupon(open_db):
+    # Два экземпляра на одном файле - как два процесса-шарда
+    databases = [open_db(), open_db()]
+    threads_per_db = 4
+    barrier = threading.Barrier(len(databases) * threads_per_db)
+    results = []
+
+    def spin(db):
+        barrier.wait()
+        results.append(db.reserve_spin(42, 'insta_42'))
+
+    threads = [
+        threading.Thread(target=spin, args=(db,))
+        for db in databases for _ in range(threads_per_db)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == len(threads)
+    assert sum(result is not None for result in results) == 1
+    assert len(coupon_rows(databases[0], 42)) == 1
+    total_spins = databases[0].get_connection().execute(
+        'SELECT total_spins FROM users WHERE telegram_id = 42'
+    ).fetchone()[0]
+    assert total_spins == 1
+    assert all(db.has_user_played_today(42) for db in databases)
+
+
+def test_unique_index_rejects_second_coupon_of_the_day(open_db):
+    db = open_db()
+    assert db.reserve_spin(7, 'insta_7')
+    spin_day = coupon_rows(db, 7)[0]['spin_day']
+    with pytest.raises(sqlite3.IntegrityError):
+        db.get_connection().execute('''
+            INSERT INTO coupons (telegram_id, username, coupon, code_word, valid_until, spin_day)
+            VALUES (7, 'insta_7', '5%', 'word', 0, ?)
+        ''', (spin_day,))
+
+
+def test_day_boundary_follows_campaign_timezone(open_db, monkeypatch):
+    # UTC+10: полночь кампании приходится на 14:00 UTC предыдущего дня
+    tz = pytz.timezone('Asia/Vladivostok')
+    monkeypatch.setattr(database, 'CAMPAIGN_TZ', tz)
+    midnight = tz.localize(datetime(2024, 3, 1)).timestamp()
+    clock = Clock(midnight - 60)
+    db = open_db(clock=clock)
+
+    assert not db.has_user_played_today(9)
+    assert db.reserve_spin(9, 'insta_9')
+    clock.now = midnight - 1
+    assert db.has_user_played_today(9)
+    assert db.reserve_spin(9) is None
+
+    # Для UTC это все еще 29 февраля, для кампании - уже новый день
+    clock.now = midnight + 60
+    assert datetime.fromtimestamp(clock.now, timezone.utc).date().isoformat() == '2024-02-29'
+    assert not db.has_user_played_today(9)
+    assert db.reserve_spin(9)
+    assert [row['spin_day'] for row in coupon_rows(db, 9)] == ['2024-02-29', '2024-03-01']
+
+
+def test_migration_backfills_spin_day_from_baseline_schema(open_db, tmp_path):
+    path = tmp_path / 'baseline.db'
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    created = [
+        (1, '2024-03-01 10:00:00'),
+        (1, '2024-03-01 11:30:00'),  # второй купон за день (до уникального индекса)
+        (1, '2024-03-02 10:00:00'),
+        (2, '2024-03-01 12:00:00'),
+    ]
+    conn.executemany('''
+        INSERT INTO coupons (telegram_id, username, coupon, code_word, created_at, valid_until)
+        VALUES (?, 'Insta_' || ?, '5%', 'word', ?, ?)
+    ''', [(telegram_id, telegram_id, at, at) for telegram_id, at in created])
+    conn.commit()
+    conn.close()
+
+    db = open_db('baseline.db')
+    connection = db.get_connection()
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == len(Database.MIGRATIONS)
+
+    rows = connection.execute(
+        'SELECT telegram_id, created_at, spin_day, instagram FROM coupons ORDER BY id'
+    ).fetchall()
+    days = [campaign_day(datetime.fromisoformat(at)) for _, at in created]
+    assert [row['spin_day'] for row in rows] == [days[0], None, days[2], days[3]]
+    # Даты переведены в секунды Unix (строки были в локальном времени сервера)
+    assert [row['created_at'] for row in rows] == [
+        int(datetime.fromisoformat(at).timestamp()) for _, at in created
+    ]
+    assert rows[0]['instagram'] == 'insta_1'
+
+    indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'idx_coupons_user_day', 'idx_coupons_spin_day'} <= indexes
+    assert 'idx_user_date' not in indexes
+
+    # Перенесенный день учитывается дневным лимитом
+    db.use_clock(Clock(rows[0]['created_at'] + 60))
+    assert db.has_user_played_today(1)
+    assert db.reserve_spin(1) is None
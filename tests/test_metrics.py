@@ -0,0 +1,98 @@
+import asyncio
+import socket
+import urllib.request
+import pytest
+from prometheus_client import CollectorRegistry, generate_latest
+import logging_setup
+import metrics
+
+
+def sample(name, labels=None, registry=metrics.REGISTRY):
+    return registry.get_sample_value(name, labels or {})
+
+
+def test_timed_handler_records_duration_errors_and_log_context():
+    seen = []
+
+    @metrics.timed_handler
+    async def sample_handler(fail):
+        seen.append(logging_setup.handler_var.get())
+        if fail:
+            raise ValueError('boom')
+        return 'ok'
+
+    labels = {'handler': 'sample_handler'}
+    assert asyncio.run(sample_handler(False)) == 'ok'
+    with pytest.raises(ValueError):
+        asyncio.run(sample_handler(True))
+
+    assert seen == ['sample_handler', 'sample_handler']
+    assert logging_setup.handler_var.get() is None
+    assert sample('wheel_handler_duration_seconds_count', labels) == 2
+    assert sample('wheel_handler_duration_seconds_bucket', {**labels, 'le': '+Inf'}) == 2
+    assert sample('wheel_handler_duration_seconds_sum', labels) > 0
+    assert sample('wheel_handler_errors_total', labels) == 1
+
+
+def test_exposition_format():
+    metrics.SPINS.labels(prize='5%').inc()
+    metrics.DB_SECONDS.labels(method='get_user_summary').observe(0.003)
+    text = generate_latest(metrics.REGISTRY).decode('utf-8')
+
+    assert '# TYPE wheel_spins_total counter' in text
+    assert 'wheel_spins_total{prize="5%"}' in text
+    assert '# TYPE wheel_db_duration_seconds histogram' in text
+    assert 'wheel_db_duration_seconds_bucket{le="0.0025",method="get_user_summary"} 0.0' in text
+    assert 'wheel_db_duration_seconds_bucket{le="0.005",method="get_user_summary"} 1.0' in text
+    assert 'wheel_db_duration_seconds_bucket{le="+Inf",method="get_user_summary"} 1.0' in text
+    assert 'wheel_db_duration_seconds_count{method="get_user_summary"} 1.0' in text
+    # Метрики без меток видны сразу, серий *_created нет
+    assert 'wheel_updates_in_flight ' in text
+    assert '_created' not in text
+
+
+def test_callback_collector_escapes_labels_and_survives_errors():
+    registry = CollectorRegistry()
+    metrics.CallbackCollector(
+        'test_cache_hits_total', 'Попадания', 'counter',
+        lambda: [({'cache': 'a"b\\c\nd'}, 3)], ['cache'], registry=registry
+    )
+    metrics.CallbackCollector('test_pending', 'Очередь', 'gauge', lambda: [({}, 7)], registry=registry)
+
+    def broken():
+        raise RuntimeError('нет данных')
+
+    metrics.CallbackCollector('test_broken', 'Ошибка', 'gauge', broken, registry=registry)
+
+    text = generate_latest(registry).decode('utf-8')
+    assert 'test_cache_hits_total{cache="a\\"b\\\\c\\nd"} 3.0' in text
+    assert 'test_pending 7.0' in text
+    # Ошибка одной метрики не ломает остальные
+    assert 'test_broken' not in text
+
+
+def test_cache_and_rate_limiter_values_are_read_on_scrape():
+    from cache import TTLCache
+
+    cache = TTLCache('metrics_test', 10, 60)
+    cache.set('key', 'value')
+    cache.get('key')
+    cache.get('missing')
+    assert sample('wheel_cache_hits_total', {'cache': 'metrics_test'}) == 1
+    assert sample('wheel_cache_misses_total', {'cache': 'metrics_test'}) == 1
+    assert sample('wheel_cache_entries', {'cache': 'metrics_test'}) == 1
+
+
+def test_http_endpoint_serves_metrics():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = metrics.start_http_server(port)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+            body = response.read().decode('utf-8')
+            content_type = response.headers['Content-Type']
+    finally:
+        server.shutdown()
+    assert content_type.startswith('text/plain')
+    assert 'wheel_updates_total' in body
@@ -0,0 +1,72 @@
+import random
+import config
+from prize_sampler import PrizeSampler, check_distribution
+
+DRAWS = 200_000
+
+
+def test_distribution_matches_coupon_config_weights():
+    sampler = PrizeSampler(rng=random.Random(20241231))
+    chi_square, p_value, rows = check_distribution(sampler, DRAWS)
+
+    total = sum(data['chance'] for data in config.COUPON_CONFIG.values())
+    assert [row[0] for row in rows] == list(config.COUPON_CONFIG)
+    for coupon, expected, observed in rows:
+        assert expected == config.COUPON_CONFIG[coupon]['chance'] / total
+        assert abs(observed - expected) < 0.01
+    assert p_value > 0.001, f"хи-квадрат {chi_square:.2f}"
+
+
+def test_skewed_distribution_is_rejected():
+    sampler = PrizeSampler(rng=random.Random(1))
+    # Выбираем по другим весам, а сравниваем с исходными
+    sampler.weights = [weight + 10 for weight in sampler.weights]
+    _, p_value, _ = check_distribution(sampler, DRAWS)
+    assert p_value < 0.001
+
+
+def test_zero_chance_prize_is_never_drawn():
+    coupon_config = {
+        '5%': {'chance': 1, 'code_word': 'a', 'emoji': 'a'},
+        '50%': {'chance': 0, 'code_word': 'b', 'emoji': 'b'},
+    }
+    sampler = PrizeSampler(coupon_config, rng=random.Random(2))
+    assert {prize['coupon'] for prize in sampler.sample(10_000)} == {'5%'}
+
+
+def test_ensure_current_follows_replaced_config(monkeypatch):
+    sampler = PrizeSampler(rng=random.Random(3))
+    monkeypatch.setattr(config, 'COUPON_CONFIG', {
+        '99%': {'chance': 1, 'code_word': 'Новый', 'emoji': '🎉'},
+    })
+    sampler.ensure_current()
+    assert sampler.draw() == {'coupon': '99%', 'code_word': 'Новый', 'emoji': '🎉'}
+
+
+def test_reload_picks_up_config_changed_in_place():
+    coupon_config = {
+        '5%': {'chance': 1, 'code_word': 'a', 'emoji': 'a'},
+        '10%': {'chance': 0, 'code_word': 'b', 'emoji': 'b'},
+    }
+    sampler = PrizeSampler(coupon_config, rng=random.Random(4))
+    fingerprint = sampler.fingerprint
+
+    coupon_config['5%']['chance'] = 0
+    coupon_config['10%']['chance'] = 1
+    # Словарь тот же - ensure_current изменения на месте не замечает
+    sampler.ensure_current()
+    assert sampler.draw()['coupon'] == '5%'
+
+    sampler.reload()
+    assert sampler.fingerprint != fingerprint
+    assert {prize['coupon'] for prize in sampler.sample(1000)} == {'10%'}
+
+
+def test_explicit_config_is_not_replaced_by_global(monkeypatch):
+    coupon_config = {'5%': {'chance': 1, 'code_word': 'a', 'emoji': 'a'}}
+    sampler = PrizeSampler(coupon_config, rng=random.Random(5))
+    monkeypatch.setattr(config, 'COUPON_CONFIG', {
+        '99%': {'chance': 1, 'code_word': 'b', 'emoji': 'b'},
+    })
+    sampler.ensure_current()
+    assert sampler.draw()['coupon'] == '5%'
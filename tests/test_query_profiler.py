@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# check_plans настраивает и открывает глобальную базу - запускаем в отдельном процессе
+UNPLANNABLE = '''
+import sqlite3, sys
+import query_profiler
+
+def full_scans(conn, sql, parameters=None):
+    raise sqlite3.OperationalError('no such table: gone')
+
+query_profiler.full_scans = full_scans
+sys.exit(query_profiler.main(['--check-plans', '--users', '50']))
+'''
+
+
+def run(args):
+    return subprocess.run(
+        [sys.executable, *args], cwd=ROOT, capture_output=True, text=True, timeout=120
+    )
+
+
+def test_plans_of_hot_path_use_indexes():
+    result = run(['query_profiler.py', '--check-plans', '--users', '200'])
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert '❌' not in result.stdout
+
+
+def test_unplannable_hot_query_fails_the_check():
+    result = run(['-c', UNPLANNABLE])
+    assert result.returncode == 1, result.stdout + result.stderr
+    assert '❌ reserve_spin: не удалось получить план (no such table: gone)' in result.stdout
+    # Вне горячего пути - только предупреждение
+    assert '?  get_admin_stats: не удалось получить план' in result.stdout
+    assert 'или без плана' in result.stdout
@@ -0,0 +1,142 @@
+import asyncio
+import time
+from datetime import timedelta
+from rate_limiter import (
+    PRIORITY_ANIMATION, PRIORITY_MENU, PRIORITY_RESULT, PriorityRateLimiter,
+)
+from telegram.error import RetryAfter
+
+# Лимиты, которые сами по себе не задерживают запросы тестов
+UNLIMITED = dict(overall_rate=1000, chat_rate=1000, chat_burst=1000)
+
+
+def send(limiter, log, name, data, priority=None, endpoint='sendMessage'):
+    """Запрос через лимитер; в log попадают только реально отправленные"""
+    async def callback():
+        log.append(name)
+        return name
+
+    return limiter.process_request(callback, (), {}, endpoint, data, priority)
+
+
+def pause(limiter, chat_id, seconds):
+    """Пауза отправки в чат (None - во все), как после RetryAfter"""
+    limiter._paused_until[chat_id] = time.monotonic() + seconds
+
+
+def run(scenario, **kwargs):
+    async def main():
+        limiter = PriorityRateLimiter(**{**UNLIMITED, **kwargs})
+        await limiter.initialize()
+        try:
+            return await scenario(limiter)
+        finally:
+            await limiter.shutdown()
+
+    return asyncio.run(main())
+
+
+def test_waiting_requests_are_sent_by_priority():
+    async def scenario(limiter):
+        log = []
+        # Пока отправка приостановлена, запросы копятся в очереди
+        pause(limiter, None, 0.05)
+        await asyncio.gather(
+            send(limiter, log, 'animation', {'chat_id': 1}, PRIORITY_ANIMATION),
+            send(limiter, log, 'menu-1', {'chat_id': 2}),
+            send(limiter, log, 'result', {'chat_id': 3}, PRIORITY_RESULT),
+            send(limiter, log, 'menu-2', {'chat_id': 4}, PRIORITY_MENU),
+        )
+        return log
+
+    assert run(scenario) == ['result', 'menu-1', 'menu-2', 'animation']
+
+
+def test_animation_frames_of_one_message_are_coalesced():
+    async def scenario(limiter):
+        log = []
+        pause(limiter, 1, 0.05)
+        results = await asyncio.gather(*(
+            send(limiter, log, f'frame-{message_id}-{frame}',
+                 {'chat_id': '1', 'message_id': message_id},
+                 PRIORITY_ANIMATION, 'editMessageText')
+            for message_id, frame in ((10, 1), (11, 1), (10, 2), (10, 3))
+        ))
+        return log, results, limiter.dropped_count
+
+    log, results, dropped = run(scenario)
+    # Устаревшие кадры не отправляются, но вызывающий получает True
+    assert sorted(log) == ['frame-10-3', 'frame-11-1']
+    assert results == [True, 'frame-11-1', True, 'frame-10-3']
+    assert dropped == 2
+
+
+def test_stale_animation_frame_is_dropped():
+    async def scenario(limiter):
+        log = []
+        pause(limiter, 1, 0.3)
+        start = time.monotonic()
+        frame = await send(limiter, log, 'frame', {'chat_id': 1, 'message_id': 5}, PRIORITY_ANIMATION)
+        waited = time.monotonic() - start
+        # Запрос с обычным приоритетом дожидается конца паузы
+        menu = await send(limiter, log, 'menu', {'chat_id': 1})
+        return log, frame, waited, menu, limiter.dropped_count
+
+    log, frame, waited, menu, dropped = run(scenario, animation_max_wait=0.05)
+    assert frame is True
+    assert waited < 0.25
+    assert menu == 'menu'
+    assert log == ['menu']
+    assert dropped == 1
+
+
+def test_retry_after_pauses_only_that_chat():
+    async def scenario(limiter):
+        log = []
+        sent_at = {}
+        attempts = 0
+
+        async def flooded():
+            nonlocal attempts
+            attempts += 1
+            if attempts == 1:
+                raise RetryAfter(timedelta(seconds=0.3))
+            log.append('chat-1')
+            return 'chat-1'
+
+        start = time.monotonic()
+        first = asyncio.create_task(
+            limiter.process_request(flooded, (), {}, 'sendMessage', {'chat_id': 1}, PRIORITY_RESULT)
+        )
+        await asyncio.sleep(0.05)
+        # Другой чат не ждет, пока истечет пауза первого
+        await send(limiter, log, 'chat-2', {'chat_id': 2})
+        sent_at['chat-2'] = time.monotonic() - start
+        assert await first == 'chat-1'
+        sent_at['chat-1'] = time.monotonic() - start
+        return log, sent_at, attempts, limiter.retry_after_count
+
+    log, sent_at, attempts, retry_after_count = run(scenario)
+    assert log == ['chat-2', 'chat-1']
+    assert sent_at['chat-2'] < 0.2
+    # Повтор в первый чат - не раньше конца паузы
+    assert sent_at['chat-1'] >= 0.3
+    assert attempts == 2
+    assert retry_after_count == 1
+
+
+def test_retry_after_drops_animation_frame():
+    async def scenario(limiter):
+        calls = 0
+
+        async def flooded():
+            nonlocal calls
+            calls += 1
+            raise RetryAfter(1)
+
+        result = await limiter.process_request(
+            flooded, (), {}, 'editMessageText', {'chat_id': 1, 'message_id': 2}, PRIORITY_ANIMATION
+        )
+        return result, calls, limiter.dropped_count
+
+    assert run(scenario) == (True, 1, 1)
@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import time
+import pytest
+import bot
+import config
+import database
+import replay
+from fake_bot_api import callback_update, message_update
+
+USER_ID = 501
+# 2024-03-01 12:00 UTC и сутки спустя
+DAY_1 = 1709294400.0
+DAY_2 = DAY_1 + 86400
+KEY = b'test-key'
+
+
+@pytest.fixture
+def replay_environment(monkeypatch):
+    """Воспроизведение на общей тестовой базе; подмены базы откатываются после теста"""
+    monkeypatch.setattr(config, 'SPIN_ANIMATION_FRAMES', 0)
+    monkeypatch.setattr(config, 'WHEEL_ANIMATION', 'frames')
+    monkeypatch.setattr(config, 'TELEGRAM_OVERALL_RATE', 1_000_000)
+    monkeypatch.setattr(config, 'TELEGRAM_CHAT_RATE', 1_000_000)
+    monkeypatch.setattr(config, 'TELEGRAM_CHAT_BURST', 1_000_000)
+    adb = database.AsyncDatabase(database.db, max_workers=2)
+    monkeypatch.setattr(database, 'adb', adb)
+    monkeypatch.setattr(bot, 'adb', adb)
+    # replay подменяет reserve_spin и часы глобальной базы
+    monkeypatch.setattr(database.db, 'reserve_spin', database.db.reserve_spin)
+    yield
+    database.db.use_clock(time.time)
+
+
+def test_multi_day_recording_replays_on_recorded_days(replay_environment):
+    records = [
+        (DAY_1, message_update(1, USER_ID, '/start')),
+        (DAY_1 + 1, message_update(2, USER_ID, 'replay_user')),
+        (DAY_1 + 2, message_update(3, USER_ID, '/spin')),
+        (DAY_2, message_update(4, USER_ID, '/spin')),
+    ]
+    args = argparse.Namespace(fast=True, seed=1, speed=1.0, max_gap=60.0)
+    report = asyncio.run(replay.replay(records, args))
+
+    assert report['errors'] == 0
+    coupons = database.db.get_connection().execute(
+        'SELECT created_at, spin_day FROM coupons WHERE telegram_id = ? ORDER BY created_at',
+        (USER_ID,)
+    ).fetchall()
+    # Повторный спин в первый день отклонен, во второй - разрешен
+    assert [tuple(row) for row in coupons] == [
+        (int(DAY_1 + 1), database.campaign_day(DAY_1)),
+        (int(DAY_2), database.campaign_day(DAY_2)),
+    ]
+
+
+def test_recorded_clock_follows_update_context():
+    clock = replay.RecordedClock(DAY_1)
+    assert clock() == DAY_1
+
+    async def handle(recorded_at):
+        clock.set(recorded_at)
+        await asyncio.sleep(0)
+        return await asyncio.to_thread(clock)
+
+    async def main():
+        return await asyncio.gather(handle(DAY_2), handle(DAY_1 + 5))
+
+    assert asyncio.run(main()) == [DAY_2, DAY_1 + 5]
+    # Вне обработки - последнее поданное обновление
+    assert clock() == DAY_2
+
+
+@pytest.mark.parametrize('text', ['Some.User', '@Some.User', 'some.user 15%'])
+def test_user_text_hides_instagram(text):
+    data = message_update(1, USER_ID, text)
+    anonymized = replay.anonymize_update(data, KEY)['message']['text']
+    assert 'some.user' not in anonymized.lower()
+    # Одинаковые имена дают одинаковые псевдонимы (как после нормализации в базе)
+    assert anonymized.split()[0].lstrip('@') == replay.anonymize_handle('some.user', KEY)
+    assert anonymized.startswith('@') == text.startswith('@')
+    if '15%' in text:
+        assert anonymized.endswith(' 15%')
+
+
+def test_commands_are_kept_and_bot_text_is_dropped():
+    command = replay.anonymize_update(message_update(1, USER_ID, '/start'), KEY)['message']
+    assert command['text'] == '/start'
+    assert command['entities'] == [{'type': 'bot_command', 'offset': 0, 'length': 6}]
+
+    callback = callback_update(2, USER_ID, 'admin_search')
+    callback['callback_query']['message']['text'] = 'Купоны @some.user: 15%'
+    anonymized = replay.anonymize_update(callback, KEY)['callback_query']
+    assert anonymized['message']['text'] == '...'
+    assert anonymized['data'] == 'admin_search'
+    assert anonymized['from']['id'] != USER_ID
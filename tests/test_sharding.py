@@ -0,0 +1,142 @@
+import asyncio
+import itertools
+import pytest
+import bot
+import config
+import database
+import sharding
+from fake_bot_api import FakeBotRequest, callback_update, document_update, message_update
+
+SHARDS = 3
+ADMIN_ID = 3
+USERS = (101, 102, 103, 104)
+
+
+@pytest.fixture
+def inline_shards(monkeypatch):
+    """Все шарды в одном процессе с поддельным Bot API; запоминает, какой шард что получил"""
+    monkeypatch.setattr(config, 'ADMIN_ID', str(ADMIN_ID))
+    monkeypatch.setattr(config, 'BOT_MODE', 'polling')
+    monkeypatch.setattr(config, 'SPIN_ANIMATION_FRAMES', 0)
+    monkeypatch.setattr(config, 'WHEEL_ANIMATION', 'frames')
+    monkeypatch.setattr(config, 'TELEGRAM_OVERALL_RATE', 1_000_000)
+    monkeypatch.setattr(config, 'TELEGRAM_CHAT_RATE', 1_000_000)
+    monkeypatch.setattr(config, 'TELEGRAM_CHAT_BURST', 1_000_000)
+    # run_inline закрывает пул базы при остановке - даем ему отдельный
+    adb = database.AsyncDatabase(database.db, max_workers=2)
+    monkeypatch.setattr(database, 'adb', adb)
+    monkeypatch.setattr(bot, 'adb', adb)
+
+    received = []
+    run_worker = sharding.run_worker
+
+    async def recording_worker(index, shards, get_message, send_invalidation=None, request=None):
+        async def get_and_record():
+            message = await get_message()
+            if message and message[0] == 'update':
+                received.append((index, message[1]))
+            return message
+
+        await run_worker(index, shards, get_and_record, send_invalidation, request)
+
+    monkeypatch.setattr(sharding, 'run_worker', recording_worker)
+    return received
+
+
+async def wait_until(predicate, timeout=10):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        assert loop.time() < deadline, "не дождались обработки обновлений"
+        await asyncio.sleep(0.01)
+
+
+def coupons_of(telegram_id):
+    return database.db.get_connection().execute(
+        'SELECT username, coupon, used FROM coupons WHERE telegram_id = ?',
+        (telegram_id,)
+    ).fetchall()
+
+
+def run_inline(scenario):
+    async def main():
+        request = FakeBotRequest()
+        stop_event = asyncio.Event()
+        sharding_task = asyncio.create_task(sharding.run_inline(SHARDS, stop_event, request))
+        try:
+            await asyncio.wait_for(scenario(request), timeout=30)
+        finally:
+            stop_event.set()
+            await sharding_task
+
+    asyncio.run(main())
+
+
+def test_updates_are_routed_by_telegram_id(inline_shards):
+    update_ids = itertools.count(1)
+
+    async def scenario(request):
+        for user_id in USERS:
+            request.add_update(message_update(next(update_ids), user_id, '/start'))
+            request.add_update(message_update(next(update_ids), user_id, f'shard_user_{user_id}'))
+        await wait_until(lambda: all(coupons_of(user_id) for user_id in USERS))
+        for user_id in USERS:
+            request.add_update(message_update(next(update_ids), user_id, '/mycoupons'))
+        await wait_until(lambda: len(inline_shards) == len(USERS) * 3)
+
+    run_inline(scenario)
+
+    shards_by_user = {}
+    for index, data in inline_shards:
+        shards_by_user.setdefault(data['message']['from']['id'], set()).add(index)
+    # Все обновления пользователя - в одном шарде, и это telegram_id % N
+    assert shards_by_user == {user_id: {user_id % SHARDS} for user_id in USERS}
+    # Состояние диалога (ожидание Instagram после /start) сохранилось в шарде
+    for user_id in USERS:
+        assert coupons_of(user_id)[0][0] == f'shard_user_{user_id}'
+
+
+def test_bulk_redemption_on_admin_shard_invalidates_users_summary(inline_shards):
+    user_id = 200
+    assert user_id % SHARDS != ADMIN_ID % SHARDS
+    update_ids = itertools.count(1000)
+
+    async def scenario(request):
+        request.add_update(message_update(next(update_ids), user_id, '/start'))
+        request.add_update(message_update(next(update_ids), user_id, 'bulk_shard_user'))
+        await wait_until(lambda: coupons_of(user_id))
+
+        # Сводка пользователя попадает в кэш
+        request.add_update(message_update(next(update_ids), user_id, '/mycoupons'))
+        await wait_until(lambda: database.db.user_summary_cache.get(user_id) is not database.MISSING)
+        assert len(database.db.user_summary_cache.get(user_id)['active_coupons']) == 1
+
+        # Админ в другом шарде отмечает купон файлом
+        instagram, discount, _ = coupons_of(user_id)[0]
+        content = f'instagram;скидка\n{instagram};{discount}\n'.encode('utf-8')
+        file_id = request.add_file(content)
+        request.add_update(message_update(next(update_ids), ADMIN_ID, '/admin'))
+        request.add_update(callback_update(next(update_ids), ADMIN_ID, 'admin_mark_used'))
+        request.add_update(document_update(
+            next(update_ids), ADMIN_ID, file_id, 'redeem.csv', len(content)
+        ))
+        await wait_until(lambda: coupons_of(user_id)[0][2] == 1)
+        await wait_until(lambda: request.calls['sendDocument'] == 1)
+
+    run_inline(scenario)
+
+    admin_shards = {index for index, data in inline_shards
+                    if data.get('message', data.get('callback_query', {})).get('from', {}).get('id') == ADMIN_ID}
+    assert admin_shards == {ADMIN_ID % SHARDS}
+    # Закэшированная сводка сброшена: пользователь больше не видит погашенный купон
+    assert database.db.user_summary_cache.get(user_id) is database.MISSING
+    assert database.db.get_user_summary(user_id)['active_coupons'] == []
+
+
+def test_invalidation_hook_notifies_only_the_owning_shard():
+    sent = []
+    hook = sharding.invalidation_hook(1, SHARDS, lambda shard, telegram_id: sent.append((shard, telegram_id)))
+    hook(101)  # 101 % 3 == 2 - чужой шард
+    hook(100)  # 100 % 3 == 1 - свой шард, сообщать некому
+    hook(102)  # 102 % 3 == 0
+    assert sent == [(2, 101), (0, 102)]
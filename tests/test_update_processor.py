@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime
+from telegram import Chat, Message, Update, User
+from update_processor import PerUserUpdateProcessor
+
+
+def make_update(update_id, user_id):
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(user_id, Chat.PRIVATE),
+        from_user=User(user_id, 'User', False),
+    )
+    return Update(update_id, message=message)
+
+
+async def handle(log, name, delay):
+    await asyncio.sleep(delay)
+    log.append(name)
+
+
+def test_other_users_are_not_delayed_by_one_users_burst():
+    async def scenario():
+        processor = PerUserUpdateProcessor(4)
+        log = []
+        # Пользователь 1 присылает столько медленных обновлений, сколько всего мест
+        burst = [
+            asyncio.create_task(processor.process_update(
+                make_update(i, 1), handle(log, f'user1-{i}', 0.2)
+            ))
+            for i in range(4)
+        ]
+        await asyncio.sleep(0.01)
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await processor.process_update(make_update(100, 2), handle(log, 'user2', 0))
+        elapsed = loop.time() - start
+
+        await asyncio.gather(*burst)
+        return elapsed, log
+
+    elapsed, log = asyncio.run(scenario())
+    assert elapsed < 0.1
+    assert log[0] == 'user2'
+
+
+def test_updates_of_one_user_are_processed_in_order():
+    async def scenario():
+        processor = PerUserUpdateProcessor(8)
+        log = []
+        # Более ранние обновления работают дольше, но все равно завершаются первыми
+        await asyncio.gather(*(
+            processor.process_update(make_update(i, 1), handle(log, i, 0.05 - i * 0.01))
+            for i in range(5)
+        ))
+        return log, processor
+
+    log, processor = asyncio.run(scenario())
+    assert log == [0, 1, 2, 3, 4]
+    assert not processor._locks and not processor._waiters
+
+
+def test_global_concurrency_cap_is_enforced():
+    async def scenario():
+        processor = PerUserUpdateProcessor(3)
+        running = 0
+        peak = 0
+
+        async def work():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.02)
+            running -= 1
+
+        # Все обновления от разных пользователей - упорядочивание не мешает
+        await asyncio.gather(*(
+            processor.process_update(make_update(i, 1000 + i), work())
+            for i in range(12)
+        ))
+        return peak
+
+    assert asyncio.run(scenario()) == 3
+
+
+def test_pending_updates_are_bounded_by_ptb_semaphore():
+    processor = PerUserUpdateProcessor(2, max_pending_updates=5)
+    assert processor.concurrency_limit == 2
+    assert processor.max_concurrent_updates == 5
+    # process_update из PTB не переопределен: лимит задает do_process_update
+    assert 'process_update' not in PerUserUpdateProcessor.__dict__
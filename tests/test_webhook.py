@@ -0,0 +1,207 @@
+import asyncio
+import json
+import socket
+import pytest
+from telegram import Bot
+import config
+import webhook
+from fake_bot_api import FakeBotRequest, message_update
+
+ALLOWED_UPDATES = ['message', 'callback_query']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def webhook_config(monkeypatch):
+    port = free_port()
+    monkeypatch.setattr(config, 'WEBHOOK_LISTEN', '127.0.0.1')
+    monkeypatch.setattr(config, 'WEBHOOK_PORT', port)
+    monkeypatch.setattr(config, 'WEBHOOK_PATH', '/telegram')
+    monkeypatch.setattr(config, 'WEBHOOK_URL', '')
+    monkeypatch.setattr(config, 'WEBHOOK_SECRET', '')
+    monkeypatch.setattr(config, 'WEBHOOK_CERT', '')
+    monkeypatch.setattr(config, 'WEBHOOK_KEY', '')
+    return port
+
+
+async def read_response(reader):
+    """Статус ответа; тело дочитывается, чтобы соединение можно было использовать снова"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    length = 0
+    for line in lines[1:]:
+        if line.lower().startswith('content-length:'):
+            length = int(line.split(':', 1)[1])
+    if length:
+        await reader.readexactly(length)
+    return status
+
+
+async def send_request(reader, writer, body=b'', headers=None, chunked=False):
+    lines = ['POST /telegram HTTP/1.1', 'Host: 127.0.0.1']
+    headers = {'Content-Type': 'application/json', **(headers or {})}
+    if chunked:
+        headers['Transfer-Encoding'] = 'chunked'
+    elif body is not None:
+        headers['Content-Length'] = str(len(body))
+    lines += [f'{name}: {value}' for name, value in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    if chunked:
+        # Тело частями по 10 байт
+        for i in range(0, len(body), 10):
+            part = body[i:i + 10]
+            writer.write(f'{len(part):x}\r\n'.encode() + part + b'\r\n')
+        writer.write(b'0\r\n\r\n')
+    elif body:
+        writer.write(body)
+    await writer.drain()
+    return await read_response(reader)
+
+
+async def post(port, body, headers=None, chunked=False):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        return await send_request(reader, writer, body, headers, chunked)
+    finally:
+        writer.close()
+
+
+def update_body(update_id, user_id=42):
+    return json.dumps(message_update(update_id, user_id, 'hello')).encode('utf-8')
+
+
+def run_server(scenario):
+    """Запускает webhook-сервер с поддельным Bot API и выполняет scenario(request, updates)"""
+    async def main():
+        request = FakeBotRequest()
+        updates = asyncio.Queue()
+        async with Bot('123456:test', request=request) as bot:
+            updater = await webhook.start_webhook(bot, updates, ALLOWED_UPDATES)
+            try:
+                return await scenario(request, updates)
+            finally:
+                await webhook.stop_webhook(updater)
+
+    return asyncio.run(main())
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def test_secret_token_is_checked_and_registered(webhook_config, monkeypatch):
+    monkeypatch.setattr(config, 'WEBHOOK_URL', 'https://example.com/telegram')
+    monkeypatch.setattr(config, 'WEBHOOK_SECRET', 'top-secret')
+
+    async def scenario(request, updates):
+        missing = await post(webhook_config, update_body(1))
+        wrong = await post(webhook_config, update_body(2),
+                           {'X-Telegram-Bot-Api-Secret-Token': 'nope'})
+        right = await post(webhook_config, update_body(3),
+                           {'X-Telegram-Bot-Api-Secret-Token': 'top-secret'})
+        return (missing, wrong, right), drain(updates), dict(request.calls)
+
+    statuses, received, calls = run_server(scenario)
+    assert statuses == (403, 403, 200)
+    assert [update.update_id for update in received] == [3]
+    assert calls.get('setWebhook') == 1
+
+
+def test_local_mode_accepts_posts_without_secret_and_skips_set_webhook(webhook_config):
+    async def scenario(request, updates):
+        status = await post(webhook_config, update_body(1))
+        return status, drain(updates), dict(request.calls)
+
+    status, received, calls = run_server(scenario)
+    assert status == 200
+    assert [update.effective_user.id for update in received] == [42]
+    assert 'setWebhook' not in calls
+
+
+def test_bad_body_is_rejected(webhook_config):
+    async def scenario(request, updates):
+        not_json = await post(webhook_config, b'{not json')
+        not_update = await post(webhook_config, b'[1, 2, 3]')
+        wrong_type = await post(webhook_config, update_body(1), {'Content-Type': 'text/plain'})
+        return (not_json, not_update, wrong_type), drain(updates)
+
+    statuses, received = run_server(scenario)
+    assert all(status >= 400 for status in statuses)
+    assert received == []
+
+
+def test_missing_content_length_is_an_empty_body(webhook_config):
+    async def scenario(request, updates):
+        reader, writer = await asyncio.open_connection('127.0.0.1', webhook_config)
+        try:
+            status = await send_request(reader, writer, body=None)
+        finally:
+            writer.close()
+        # Сервер продолжает принимать обновления
+        after = await post(webhook_config, update_body(5))
+        return status, after, drain(updates)
+
+    status, after, received = run_server(scenario)
+    assert status >= 400
+    assert after == 200
+    assert [update.update_id for update in received] == [5]
+
+
+def test_chunked_requests_keep_the_connection_in_sync(webhook_config):
+    async def scenario(request, updates):
+        reader, writer = await asyncio.open_connection('127.0.0.1', webhook_config)
+        try:
+            # Два запроса по одному keep-alive соединению: chunked, затем обычный
+            first = await send_request(reader, writer, update_body(7), chunked=True)
+            second = await send_request(reader, writer, update_body(8))
+        finally:
+            writer.close()
+        return (first, second), drain(updates)
+
+    statuses, received = run_server(scenario)
+    assert statuses == (200, 200)
+    assert [update.update_id for update in received] == [7, 8]
+
+
+def test_post_updates_reports_rejected_lines(webhook_config, monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(config, 'WEBHOOK_SECRET', 'top-secret')
+    path = tmp_path / 'updates.jsonl'
+    path.write_text(
+        update_body(1).decode() + '\n\n' + '{not json\n' + update_body(2).decode() + '\n',
+        encoding='utf-8'
+    )
+    url = f'http://127.0.0.1:{webhook_config}/telegram'
+
+    async def scenario(request, updates):
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, webhook.post_updates, url, str(path), 'top-secret'
+        )
+        return result, drain(updates)
+
+    (sent, failed), received = run_server(scenario)
+    assert (sent, failed) == (2, 1)
+    assert [update.update_id for update in received] == [1, 2]
+    assert 'Строка 3: HTTP' in capsys.readouterr().err
+
+
+def test_webhook_options_fit_run_webhook(webhook_config, monkeypatch):
+    import inspect
+    from telegram.ext import Application
+
+    monkeypatch.setattr(config, 'WEBHOOK_URL', 'https://example.com/telegram')
+    monkeypatch.setattr(config, 'WEBHOOK_CERT', 'cert.pem')
+    monkeypatch.setattr(config, 'WEBHOOK_KEY', 'key.pem')
+    options = webhook.webhook_options(ALLOWED_UPDATES)
+    inspect.signature(Application.run_webhook).bind(None, **options)
+    # Без WEBHOOK_SECRET за прокси генерируется случайный секрет
+    assert options['secret_token']
+    assert options['webhook_url'] == 'https://example.com/telegram'
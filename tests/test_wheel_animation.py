@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+from telegram import Animation, Chat, Message
+from telegram.error import BadRequest
+import bot
+from database import adb
+
+SPIN = {'coupon': '10%', 'code_word': 'Слово', 'emoji': '🌟', 'valid_until': '01.01.2030'}
+
+
+class FakeBot:
+    """send_animation отвечает ошибками из очереди errors, затем успехом"""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.animations = []
+        self.messages = 0
+
+    async def send_animation(self, chat_id, animation, **kwargs):
+        uploaded = not isinstance(animation, str)
+        self.animations.append('upload' if uploaded else animation)
+        if self.errors:
+            raise self.errors.pop(0)
+        return Message(
+            1, None, Chat(chat_id, Chat.PRIVATE),
+            animation=Animation('uploaded-id', 'uploaded-unique', 320, 320, 3) if uploaded else None
+        )
+
+    async def send_message(self, **kwargs):
+        self.messages += 1
+
+
+@pytest.fixture
+def wheel_media(monkeypatch, tmp_path):
+    path = tmp_path / 'wheel.gif'
+    path.write_bytes(b'GIF89a')
+    fingerprint = f'test-{tmp_path.name}'
+    monkeypatch.setattr(bot, 'get_wheel_media', lambda coupon: (str(path), fingerprint))
+    monkeypatch.setattr(bot, 'format_spin_result', lambda spin: 'результат')
+    return fingerprint
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_rejected_file_id_is_dropped_and_reuploaded(wheel_media):
+    adb.database.save_media_file_id('10%', wheel_media, 'dead-id')
+    fake = FakeBot([BadRequest('Wrong file identifier/http url specified')])
+
+    assert run(bot.send_wheel_animation(fake, 5, SPIN))
+    assert fake.animations == ['dead-id', 'upload']
+    assert adb.database.get_media_file_id('10%', wheel_media) == 'uploaded-id'
+    assert fake.messages == 1
+
+
+@pytest.mark.parametrize('error', [
+    "Can't parse entities: can't find end of the entity starting at byte offset 10",
+    'Chat not found',
+])
+def test_other_bad_requests_keep_the_file_id(wheel_media, error):
+    adb.database.save_media_file_id('10%', wheel_media, 'good-id')
+    fake = FakeBot([BadRequest(error)])
+
+    with pytest.raises(BadRequest):
+        run(bot.send_wheel_animation(fake, 5, SPIN))
+    # Без повторной загрузки, file_id на месте
+    assert fake.animations == ['good-id']
+    assert adb.database.get_media_file_id('10%', wheel_media) == 'good-id'
+
+
+def test_concurrent_spins_upload_once(wheel_media):
+    fake = FakeBot()
+
+    async def spins():
+        return await asyncio.gather(*(bot.send_wheel_animation(fake, i, SPIN) for i in range(5)))
+
+    assert run(spins()) == [True] * 5
+    assert fake.animations.count('upload') == 1
+    assert fake.animations.count('uploaded-id') == 4
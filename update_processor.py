@@ -0,0 +1,93 @@
+import asyncio
+import contextlib
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+import logging_setup
+import metrics
+
+# Во сколько раз принятых обновлений может быть больше, чем обрабатываемых
+PENDING_UPDATES_FACTOR = 16
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления разных пользователей обрабатываются одновременно (не более
+    max_concurrent_updates), а обновления одного telegram_id - строго по очереди,
+    чтобы не ломать состояния ConversationHandler и user_data.
+
+    Место в лимите max_concurrent_updates обновление занимает только после того,
+    как дошла его очередь у пользователя: иначе серия обновлений одного
+    пользователя, ждущих друг друга, заняла бы все места и задержала остальных.
+    Поэтому лимит - собственный семафор класса в do_process_update, а семафор
+    PTB (BaseUpdateProcessor.process_update, помечен @final) ограничивает
+    max_pending_updates - сколько обновлений принято в обработку вместе с
+    ожидающими своей очереди. Рассчитано на python-telegram-bot 22.x
+    (см. requirements.txt).
+    """
+
+    __slots__ = ('_locks', '_waiters', '_slots', 'concurrency_limit')
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = None):
+        if max_pending_updates is None:
+            max_pending_updates = max_concurrent_updates * PENDING_UPDATES_FACTOR
+        if max_pending_updates < max_concurrent_updates:
+            raise ValueError("max_pending_updates не может быть меньше max_concurrent_updates")
+        super().__init__(max_pending_updates)
+        self.concurrency_limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}
+        self._waiters = {}
+
+    @staticmethod
+    def get_key(update: object):
+        """Ключ упорядочивания: telegram_id пользователя или id чата"""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine):
+        """Дожидается очереди пользователя, затем места в лимите, и обрабатывает"""
+        metrics.UPDATES_IN_FLIGHT.inc()
+        log_context = logging_setup.bind_update(update)
+        try:
+            async with self._user_turn(update):
+                async with self._slots:
+                    await coroutine
+        finally:
+            logging_setup.reset_update(log_context)
+            metrics.UPDATES_IN_FLIGHT.dec()
+            metrics.UPDATES.inc()
+    @contextlib.asynccontextmanager
+    async def _user_turn(self, update):
+        """Ждет, пока обработаются предыдущие обновления того же пользователя"""
+        key = self.get_key(update)
+        if key is None:
+            yield
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+
+        try:
+            async with lock:
+                yield
+        finally:
+            # Удаляем блокировку, когда у пользователя не осталось обновлений в очереди
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    async def initialize(self):
+        """Ничего не требуется"""
+
+    async def shutdown(self):
+        """Сбрасывает блокировки пользователей"""
+        self._locks.clear()
+        self._waiters.clear()
@@ -0,0 +1,191 @@
+"""Прием обновлений Telegram через webhook.
+
+HTTP-сервер - встроенный в python-telegram-bot (Updater.start_webhook на
+tornado, зависимость python-telegram-bot[webhooks]): он проверяет заголовок
+X-Telegram-Bot-Api-Secret-Token и кладет обновление в update_queue. В обычном
+режиме бот запускается через Application.run_webhook (webhook_options),
+шардирующий диспетчер (sharding.py) забирает обновления из своей очереди
+Updater и раскладывает их по шардам (start_webhook).
+
+Обычно сервер слушает 127.0.0.1 за обратным прокси, который терминирует TLS
+(WEBHOOK_URL - публичный https-адрес прокси). Для прямого TLS задайте
+WEBHOOK_CERT и WEBHOOK_KEY.
+
+Локальная проверка без Telegram: запустите бота с BOT_MODE=webhook и пустым
+WEBHOOK_URL (адрес webhook в Telegram не меняется) и отправьте записанные
+обновления:
+
+    python webhook.py http://127.0.0.1:8443/telegram updates.jsonl
+
+В локальном режиме без WEBHOOK_SECRET секретный токен не проверяется; если
+WEBHOOK_SECRET задан, webhook.py отправляет его в заголовке.
+"""
+import asyncio
+import contextlib
+import logging
+import secrets
+import signal
+import sys
+import urllib.error
+import urllib.request
+from telegram import Update
+from telegram.ext import Updater
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class LocalModeBot:
+    """Бот для Updater в локальном режиме (без WEBHOOK_URL).
+
+    Updater.start_webhook всегда регистрирует адрес через set_webhook, а
+    локально менять webhook бота в Telegram нельзя: эти вызовы пропускаются,
+    остальные передаются настоящему боту.
+    """
+
+    def __init__(self, bot):
+        self._bot = bot
+
+    def __getattr__(self, name):
+        return getattr(self._bot, name)
+
+    async def set_webhook(self, *args, **kwargs):
+        return True
+
+    async def delete_webhook(self, *args, **kwargs):
+        return True
+
+
+def webhook_options(allowed_updates):
+    """Параметры Updater.start_webhook и Application.run_webhook из config"""
+    # Без явного секрета генерируем случайный: его знает только Telegram.
+    # В локальном режиме (без WEBHOOK_URL) такой секрет некому передать - не проверяем
+    secret_token = config.WEBHOOK_SECRET
+    if not secret_token and config.WEBHOOK_URL:
+        secret_token = secrets.token_urlsafe(32)
+    options = {
+        'listen': config.WEBHOOK_LISTEN,
+        'port': config.WEBHOOK_PORT,
+        'url_path': config.WEBHOOK_PATH,
+        'webhook_url': config.WEBHOOK_URL or None,
+        'secret_token': secret_token or None,
+        'max_connections': config.WEBHOOK_MAX_CONNECTIONS,
+        'allowed_updates': allowed_updates,
+    }
+    # При прямом TLS PTB передает сертификат в set_webhook (нужно для самоподписанного)
+    if config.WEBHOOK_CERT and config.WEBHOOK_KEY:
+        options['cert'] = config.WEBHOOK_CERT
+        options['key'] = config.WEBHOOK_KEY
+    return options
+
+
+def stop_signal_event():
+    """Событие, которое устанавливается по SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+
+@contextlib.asynccontextmanager
+async def running(application):
+    """Запущенный Application без встроенного Updater.
+
+    Повторяет жизненный цикл run_polling, включая post_init/post_stop/post_shutdown:
+    при выходе обновления, уже стоящие в update_queue, обрабатываются до остановки.
+    """
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.start()
+        yield application
+    finally:
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def start_webhook(bot, update_queue, allowed_updates):
+    """Запускает webhook-сервер PTB, принятые обновления кладутся в update_queue.
+
+    Возвращает Updater; остановка - stop_webhook. Бот остается за вызывающим.
+    """
+    if not config.WEBHOOK_URL:
+        bot = LocalModeBot(bot)
+    updater = Updater(bot, update_queue)
+    await updater.initialize()
+    await updater.start_webhook(**webhook_options(allowed_updates))
+    if config.WEBHOOK_URL:
+        logger.info(f"Webhook установлен: {config.WEBHOOK_URL}")
+    else:
+        logger.warning(
+            "WEBHOOK_URL не задан: set_webhook не вызывается (локальный режим)"
+            + ("" if config.WEBHOOK_SECRET else ", секретный токен не проверяется")
+        )
+    return updater
+
+
+async def stop_webhook(updater):
+    """Останавливает webhook-сервер (бот не закрывается)"""
+    if updater.running:
+        await updater.stop()
+
+
+async def serve_local(application, allowed_updates):
+    """Локальный режим: Application и webhook-сервер без set_webhook до SIGINT/SIGTERM"""
+    stop_event = stop_signal_event()
+    async with running(application):
+        updater = await start_webhook(application.bot, application.update_queue, allowed_updates)
+        try:
+            await stop_event.wait()
+        finally:
+            await stop_webhook(updater)
+
+
+def post_updates(url, path, secret_token=None):
+    """Отправляет обновления из JSON Lines файла на webhook (для локальной проверки).
+
+    Ответ не 2xx выводится для каждой строки, отправка продолжается.
+    Возвращает (принято, отклонено); если сервер недоступен - URLError.
+    """
+    headers = {'Content-Type': 'application/json'}
+    if secret_token:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+
+    sent = 0
+    failed = 0
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            request = urllib.request.Request(url, data=line.encode('utf-8'), headers=headers)
+            try:
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+            except urllib.error.HTTPError as e:
+                failed += 1
+                print(f"Строка {line_number}: HTTP {e.code} {e.reason}", file=sys.stderr)
+                continue
+            sent += 1
+    return sent, failed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Использование: python webhook.py <url webhook> <файл обновлений .jsonl>")
+        sys.exit(1)
+    try:
+        sent, failed = post_updates(sys.argv[1], sys.argv[2], config.WEBHOOK_SECRET)
+    except urllib.error.URLError as e:
+        print(f"Webhook недоступен: {e.reason}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Принято обновлений: {sent}, отклонено: {failed}")
+    if failed:
+        sys.exit(1)